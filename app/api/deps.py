@@ -1,6 +1,8 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+import time
+from sqlalchemy import select
+from sqlalchemy.orm import Session, lazyload
 from jose import JWTError, jwt
 from app.core.config import settings
 from app.core.database import get_db
@@ -9,6 +11,19 @@ from app.models.models import User, Role, Permission
 # Configuración de seguridad
 security = HTTPBearer()
 
+# Permisos por usuario en memoria: evita recorrer roles y permisos en la base en cada petición.
+# Se invalidan al editar usuarios, roles o permisos; el TTL acota el desfase entre workers
+PERMISSIONS_CACHE_TTL = 60
+PERMISSIONS_CACHE_MAXSIZE = 10000
+_permissions_cache: dict = {}
+
+# Ids de roles y permisos por nombre: son tablas chicas que cambian poco, así que las asignaciones
+# por nombre no consultan la base en cada edición. Vencen con el mismo TTL que los permisos, así un
+# rol borrado y recreado en otro worker no deja un id viejo para siempre
+_role_ids: dict = {}
+_permission_ids: dict = {}
+_ids_expires: dict = {}
+
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
@@ -44,7 +59,8 @@ def get_current_user(
         print(f"❌ Debug: Error decodificando JWT: {e}")
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
+    # Los roles solo se cargan si se consultan (p. ej. cuando los permisos no están en caché)
+    user = db.query(User).options(lazyload(User.roles)).filter(User.id == user_id).first()
     if user is None:
         print(f"❌ Debug: Usuario con ID {user_id} no encontrado")
         raise credentials_exception
@@ -67,6 +83,47 @@ def get_user_permissions(user: User) -> list:
                 permissions.append(permission.name)
     return permissions
 
+def get_cached_permissions(user: User) -> frozenset:
+    """Obtiene los permisos del usuario desde la caché, cargándolos de la base si expiraron"""
+    now = time.monotonic()
+    entry = _permissions_cache.get(user.id)
+    if entry and entry[0] > now:
+        return entry[1]
+    permissions = frozenset(get_user_permissions(user))
+    if user.id not in _permissions_cache and len(_permissions_cache) >= PERMISSIONS_CACHE_MAXSIZE:
+        # Descarta la entrada más antigua
+        _permissions_cache.pop(next(iter(_permissions_cache)))
+    _permissions_cache[user.id] = (now + PERMISSIONS_CACHE_TTL, permissions)
+    return permissions
+
+def _ids_by_name(db: Session, model, cache: dict, names: list) -> list:
+    # Un nombre desconocido o el TTL vencido recarga la tabla completa (p. ej. un rol creado en
+    # otro worker); los que no existen se ignoran, igual que con un filtro IN
+    now = time.monotonic()
+    if _ids_expires.get(model, 0) <= now or any(name not in cache for name in names):
+        cache.clear()
+        cache.update(db.execute(select(model.name, model.id)).all())
+        _ids_expires[model] = now + PERMISSIONS_CACHE_TTL
+    return [cache[name] for name in dict.fromkeys(names) if name in cache]
+
+def get_role_ids(db: Session, names: list) -> list:
+    """Obtiene los ids de los roles con esos nombres"""
+    return _ids_by_name(db, Role, _role_ids, names)
+
+def get_permission_ids(db: Session, names: list) -> list:
+    """Obtiene los ids de los permisos con esos nombres"""
+    return _ids_by_name(db, Permission, _permission_ids, names)
+
+def invalidate_permissions_cache(user_id: int = None) -> None:
+    """Invalida los permisos en caché de un usuario, o de todos (junto con los ids por nombre) si no se indica"""
+    if user_id is None:
+        _permissions_cache.clear()
+        _role_ids.clear()
+        _permission_ids.clear()
+        _ids_expires.clear()
+    else:
+        _permissions_cache.pop(user_id, None)
+
 def get_user_roles(user: User) -> list:
     """Obtiene todos los roles del usuario"""
     return [role.name for role in user.roles]
@@ -74,8 +131,7 @@ def get_user_roles(user: User) -> list:
 def has_permission(permission: str):
     """Decorator para verificar si el usuario tiene un permiso específico"""
     def permission_checker(current_user: User = Depends(get_current_active_user)):
-        user_permissions = get_user_permissions(current_user)
-        if permission not in user_permissions:
+        if permission not in get_cached_permissions(current_user):
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="No tiene permiso para realizar esta acción"
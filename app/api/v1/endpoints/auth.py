@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from jose import jwt
@@ -12,14 +13,16 @@ from app.api.deps import get_current_active_user
 router = APIRouter()
 
 # Configuración de encriptación
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifica si la contraseña coincide con el hash"""
     return pwd_context.verify(plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
-    """Genera hash de la contraseña"""
+def get_password_hash(password: str, rounds: int = None) -> str:
+    """Genera hash de la contraseña (con otro costo de bcrypt si se indica rounds)"""
+    if rounds is not None:
+        return pwd_context.handler().using(rounds=rounds).hash(password)
     return pwd_context.hash(password)
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -97,7 +100,9 @@ def login(login_data: LoginRequest, db: Session = Depends(get_db)):
     }
     
     print(f"✅ Debug: Respuesta de login enviada")
-    return response_data
+    # La respuesta ya tiene la forma de TokenResponse: se serializa directo con orjson sin volver
+    # a validarla (response_model se mantiene para la documentación)
+    return ORJSONResponse(response_data)
 
 @router.post("/refresh")
 def refresh_token_endpoint(refresh_token: str = Body(...)):
@@ -1,13 +1,39 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import JSON, func, select
 from sqlalchemy.orm import Session
 from typing import List
 
 from app.core.database import get_db
-from app.models.models import Center
-from app.schemas.schemas import CenterCreate, CenterUpdate, CenterResponse
+from app.models.models import Center, InformeCentro
+from app.schemas.schemas import CenterCreate, CenterUpdate, CenterResponse, from_orm_fast
 
 router = APIRouter()
 
+# Listado de centros con sus informes armados por MySQL (JSON_ARRAYAGG) en la misma consulta:
+# sin N+1 ni objetos ORM/pydantic por informe. Las fechas salen en el mismo formato ISO que pydantic
+_ISO_DATETIME = "%Y-%m-%dT%H:%i:%s"
+CENTERS_WITH_INFORMES = (
+    select(
+        Center.id, Center.name, Center.latitude, Center.longitude, Center.code,
+        Center.name1, Center.name2, Center.created_at, Center.updated_at,
+        func.json_arrayagg(func.json_object(
+            "id", InformeCentro.id,
+            "center_id", InformeCentro.center_id,
+            "report_type", InformeCentro.report_type,
+            "file_path", InformeCentro.file_path,
+            "filename", InformeCentro.filename,
+            "is_analyzed", InformeCentro.is_analyzed,
+            "created_at", func.date_format(InformeCentro.created_at, _ISO_DATETIME),
+            "updated_at", func.date_format(InformeCentro.updated_at, _ISO_DATETIME),
+        ), type_=JSON).label("informes")
+    )
+    .select_from(Center)
+    .outerjoin(InformeCentro, InformeCentro.center_id == Center.id)
+    .group_by(Center.id)
+    .order_by(Center.id)
+)
+
 @router.post("/", response_model=CenterResponse, status_code=status.HTTP_201_CREATED)
 def create_center(center: CenterCreate, db: Session = Depends(get_db)):
     db_center = Center(**center.dict())
@@ -18,15 +44,24 @@ def create_center(center: CenterCreate, db: Session = Depends(get_db)):
 
 @router.get("/", response_model=List[CenterResponse])
 def read_centers(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    centers = db.query(Center).offset(skip).limit(limit).all()
-    return centers
+    # La respuesta se serializa directo con orjson (sin la pasada de jsonable_encoder de FastAPI)
+    rows = db.execute(CENTERS_WITH_INFORMES.offset(skip).limit(limit)).all()
+    centers = []
+    for row in rows:
+        center = row._asdict()
+        # Un centro sin informes trae una sola entrada con todo en null (por el LEFT JOIN)
+        center["informes"] = [informe for informe in row.informes if informe["id"] is not None]
+        for informe in center["informes"]:
+            informe["is_analyzed"] = bool(informe["is_analyzed"])
+        centers.append(center)
+    return ORJSONResponse(centers)
 
 @router.get("/{center_id}", response_model=CenterResponse)
 def read_center(center_id: int, db: Session = Depends(get_db)):
     center = db.query(Center).filter(Center.id == center_id).first()
     if center is None:
         raise HTTPException(status_code=404, detail="Centro no encontrado")
-    return center
+    return ORJSONResponse(from_orm_fast(CenterResponse, center).model_dump())
 
 @router.put("/{center_id}", response_model=CenterResponse)
 def update_center(center_id: int, center: CenterUpdate, db: Session = Depends(get_db)):
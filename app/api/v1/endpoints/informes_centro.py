@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import os
@@ -8,7 +9,7 @@ from app.core.config import settings # Importar settings para MONGO_URI, etc.
 
 from app.core.database import get_db
 from app.models.models import InformeCentro, Center
-from app.schemas.schemas import InformeCentroCreate, InformeCentroResponse, InformeCentroUpdate, CenterResponse
+from app.schemas.schemas import InformeCentroCreate, InformeCentroResponse, InformeCentroUpdate, CenterResponse, from_orm_fast
 
 router = APIRouter()
 
@@ -75,7 +76,7 @@ def read_informes_by_center(center_id: int, db: Session = Depends(get_db)):
         return [] 
 
     # Convertir a Pydantic Response Model y verificar estado de análisis en MongoDB
-    informes_response: List[InformeCentroResponse] = []
+    informes_response: List[dict] = []
     for informe in informes_db:
         # Buscar en MongoDB si este informe ya tiene un análisis
         analyzed_doc = analyzed_reports_collection.find_one({
@@ -83,12 +84,12 @@ def read_informes_by_center(center_id: int, db: Session = Depends(get_db)):
             "original_filename": informe.filename
         })
         
-        informe_data = InformeCentroResponse.from_orm(informe).dict()
-        informe_data["is_analyzed"] = bool(analyzed_doc) # True si se encontró un documento en MongoDB
+        informe_response = from_orm_fast(InformeCentroResponse, informe)
+        informe_response.is_analyzed = bool(analyzed_doc) # True si se encontró un documento en MongoDB
         
-        informes_response.append(InformeCentroResponse(**informe_data))
+        informes_response.append(informe_response.model_dump())
 
-    return informes_response
+    return ORJSONResponse(informes_response)
 
 @router.put("/{informe_id}", response_model=InformeCentroResponse)
 def update_informe_centro(
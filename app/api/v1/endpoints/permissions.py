@@ -4,7 +4,7 @@ from typing import List
 from app.core.database import get_db
 from app.models.models import Permission, User
 from app.schemas.schemas import PermissionCreate, PermissionUpdate, PermissionResponse
-from app.api.deps import get_current_active_user, has_permission
+from app.api.deps import get_current_active_user, has_permission, invalidate_permissions_cache
 
 router = APIRouter()
 
@@ -74,6 +74,7 @@ def update_permission(
         setattr(permission, field, value)
     
     db.commit()
+    invalidate_permissions_cache()
     db.refresh(permission)
     return permission
 
@@ -93,4 +94,5 @@ def delete_permission(
     
     db.delete(permission)
     db.commit()
+    invalidate_permissions_cache()
     return {"message": "Permiso eliminado"} 
\ No newline at end of file
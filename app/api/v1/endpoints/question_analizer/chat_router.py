@@ -2,15 +2,17 @@
 
 import json
 import re
-import base64
+import asyncio
+import binascii
 import logging
+from contextlib import AsyncExitStack
 from pymongo import MongoClient
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from openai import AsyncAzureOpenAI
 from app.core.database import get_db
 from app.core.config import settings
-from .models import QuestionRequest, FinalResponse, ChartData
+from .models import QuestionRequest, FinalResponse, ChartData, MonthlyAggregationRequest
 from .llm_orchestrator import create_execution_plan, synthesize_response
 from .data_tools import ToolExecutor
 from typing import List, Dict, Any
@@ -20,6 +22,10 @@ from pydantic import BaseModel
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Bloques ```json ... ``` de la respuesta sintetizada (el primero trae el gráfico)
+_CHART_RE = re.compile(r'```json\s*({[\s\S]*?})\s*```')
+_JSON_BLOCK_RE = re.compile(r'```json[\s\S]*?```')
+
 # Conexión a MongoDB para el historial de preguntas
 try:
     mongo_db_client = MongoClient(settings.mongo_uri)
@@ -98,6 +104,40 @@ def clima_simple(
 
     return "nublado"
 
+PLACEHOLDER_RE = re.compile(r'^\$\{(.*)\.(.*)\}$')
+
+
+def _resolve_placeholders(value: Any, collected_data: dict) -> Any:
+    """Sustituye los placeholders ${paso.campo} por resultados de pasos anteriores."""
+    if isinstance(value, list):
+        return [_resolve_placeholders(item, collected_data) for item in value]
+    if isinstance(value, str):
+        match = PLACEHOLDER_RE.match(value)
+        if match:
+            prev_step_key, value_key = match.groups()
+            if prev_step_key in collected_data and value_key in collected_data[prev_step_key]:
+                return collected_data[prev_step_key][value_key]
+            raise ValueError(f"No se pudo resolver el placeholder: {value}")
+    return value
+
+
+def _step_dependencies(step: dict) -> set:
+    """Devuelve las claves de pasos previos referenciadas por los parámetros del paso."""
+    deps = set()
+    for value in step.get("parameters", {}).values():
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, str):
+                match = PLACEHOLDER_RE.match(item)
+                if match:
+                    deps.add(match.group(1))
+    return deps
+
+
+@router.on_event("startup")
+async def create_tool_indexes():
+    await ToolExecutor(db_session=None).ensure_indexes()
+
+
 @router.post("/analyze-question/", response_model=FinalResponse)
 async def analyze_question_endpoint(request: QuestionRequest, db: Session = Depends(get_db)):
     
@@ -116,71 +156,60 @@ async def analyze_question_endpoint(request: QuestionRequest, db: Session = Depe
     collected_data = {}
     executor = ToolExecutor(db_session=db)
 
-    # ETAPA 2: EJECUCIÓN
-    logger.info(f"Ejecutando plan: {json.dumps(plan, indent=2)}")
-    for step in plan.get("plan", []):
+    async def run_step(step: dict) -> dict:
         tool_name = step.get("tool")
         parameters = step.get("parameters", {}).copy()
         result_key = step.get("store_result_as")
-
-        if not all([tool_name, result_key]):
-            logger.warning(f"Paso de plan inválido, omitiendo: {step}")
-            continue
+        outputs = {}
 
         try:
-            
             for param_key, param_value in parameters.items():
-                
-                # Caso 1: El valor es un string simple
-                if isinstance(param_value, str):
-                    match = re.match(r'^\$\{(.*)\.(.*)\}$', param_value)
-                    if match:
-                        prev_step_key, value_key = match.groups()
-                        if prev_step_key in collected_data and value_key in collected_data[prev_step_key]:
-                            parameters[param_key] = collected_data[prev_step_key][value_key]
-                        else:
-                            raise ValueError(f"No se pudo resolver el placeholder: {param_value}")
-                
-                # Caso 2: El valor es una lista que puede contener placeholders
-                elif isinstance(param_value, list):
-                    processed_list = []
-                    for item in param_value:
-                        if isinstance(item, str):
-                            match = re.match(r'^\$\{(.*)\.(.*)\}$', item)
-                            if match:
-                                prev_step_key, value_key = match.groups()
-                                if prev_step_key in collected_data and value_key in collected_data[prev_step_key]:
-                                    processed_list.append(collected_data[prev_step_key][value_key])
-                                else:
-                                    raise ValueError(f"No se pudo resolver el placeholder en la lista: {item}")
-                            else:
-                                processed_list.append(item) 
-                        else:
-                            processed_list.append(item) 
-                    parameters[param_key] = processed_list
+                parameters[param_key] = _resolve_placeholders(param_value, collected_data)
 
             # Ejecución de la herramienta
             if hasattr(executor, tool_name):
                 tool_method = getattr(executor, tool_name)
-                result = tool_method(**parameters)
-                collected_data[result_key] = result
+                result = await tool_method(**parameters)
+                outputs[result_key] = result
 
                 is_data_tool = tool_name in ["get_timeseries_data", "correlate_timeseries_data", "get_monthly_aggregation"]
                 if is_data_tool and result.get("count") == 0 and "center_id" in parameters:
                     logger.info(f"'{tool_name}' no encontró datos. Buscando rango de fechas disponible...")
                     source = parameters.get('source') or parameters.get('primary_source', 'clima')
                     if source:
-                        range_info = executor.get_data_range_for_source(center_id=parameters['center_id'], source=source)
-                        collected_data[f"{result_key}_available_range"] = range_info
+                        range_info = await executor.get_data_range_for_source(center_id=parameters['center_id'], source=source)
+                        outputs[f"{result_key}_available_range"] = range_info
 
             elif tool_name == "direct_answer":
-                collected_data[result_key] = {"answer": parameters.get("response", "No pude procesar tu solicitud.")}
+                outputs[result_key] = {"answer": parameters.get("response", "No pude procesar tu solicitud.")}
             else:
                 raise AttributeError(f"Herramienta '{tool_name}' no encontrada.")
 
         except Exception as e:
             logger.error(f"Error en el paso '{tool_name}': {e}", exc_info=True)
-            collected_data[result_key] = {"error": f"Falló la ejecución de la herramienta '{tool_name}'."}
+            outputs = {result_key: {"error": f"Falló la ejecución de la herramienta '{tool_name}'."}}
+        return outputs
+
+    # ETAPA 2: EJECUCIÓN
+    # Los pasos consecutivos que no dependen entre sí se ejecutan en paralelo;
+    # los resultados se guardan en el orden del plan.
+    logger.info(f"Ejecutando plan: {json.dumps(plan, indent=2)}")
+    batches, batch, batch_keys = [], [], set()
+    for step in plan.get("plan", []):
+        if not all([step.get("tool"), step.get("store_result_as")]):
+            logger.warning(f"Paso de plan inválido, omitiendo: {step}")
+            continue
+        if _step_dependencies(step) & batch_keys:
+            batches.append(batch)
+            batch, batch_keys = [], set()
+        batch.append(step)
+        batch_keys.add(step["store_result_as"])
+    if batch:
+        batches.append(batch)
+
+    for batch in batches:
+        for outputs in await asyncio.gather(*(run_step(step) for step in batch)):
+            collected_data.update(outputs)
 
     logger.info(f"Sintetizando respuesta con datos: {json.dumps(collected_data, indent=2, default=str)}")
     raw_synthesis = await synthesize_response(request.user_question, collected_data)
@@ -188,14 +217,14 @@ async def analyze_question_endpoint(request: QuestionRequest, db: Session = Depe
     final_text = raw_synthesis
     final_chart_object = None
 
-    chart_match = re.search(r'```json\s*({[\s\S]*?})\s*```', raw_synthesis, re.DOTALL)
+    chart_match = _CHART_RE.search(raw_synthesis)
     if chart_match:
         try:
             chart_json_str = chart_match.group(1)
             chart_obj = json.loads(chart_json_str)
             if 'chart' in chart_obj:
                 final_chart_object = ChartData(**chart_obj['chart'])
-                final_text = re.sub(r'```json[\s\S]*?```', '', final_text).strip()
+                final_text = _JSON_BLOCK_RE.sub('', final_text).strip()
         except Exception as e:
             logger.error(f"Error al procesar el JSON del gráfico de la IA: {e}")
             final_chart_object = None
@@ -291,6 +320,19 @@ async def analyze_question_endpoint(request: QuestionRequest, db: Session = Depe
     
 class AudioResponse(BaseModel):
     text: str
+
+# Tamaño de los trozos de audio leídos del TTS; múltiplo de 3 para poder codificar cada trozo
+# en base64 por separado y concatenar el resultado
+TTS_CHUNK_SIZE = 3 * 8192
+
+def tts_stream(text: str):
+    """Context manager asíncrono con la respuesta del TTS en streaming (no se descarga entera antes de leerla)."""
+    return tts_client.audio.speech.with_streaming_response.create(
+        input=text,
+        model=settings.azure_openai_tts_deployment,
+        voice="nova",
+        response_format="mp3"
+    )
     
 @router.post("/analyze-question-audio/")
 async def analyze_question_audio(
@@ -298,15 +340,13 @@ async def analyze_question_audio(
     db: Session = Depends(get_db)
     ):
     final_text = request.text
+    audio_base64 = None
     if tts_client and final_text:
         try:
-            audio_response = await tts_client.audio.speech.create(
-                input=final_text,
-                model=settings.azure_openai_tts_deployment,
-                voice="nova",
-                response_format="mp3"
-            )
-            audio_base64 = base64.b64encode(audio_response.content).decode("utf-8")
+            # Cada trozo se codifica a medida que llega, en vez de esperar el mp3 completo
+            async with tts_stream(final_text) as audio_response:
+                encoded = [binascii.b2a_base64(chunk, newline=False) async for chunk in audio_response.iter_bytes(TTS_CHUNK_SIZE)]
+            audio_base64 = b"".join(encoded).decode("ascii")
         except Exception as e:
             logger.error(f"Error al generar audio: {e}")
             
@@ -360,6 +400,7 @@ async def get_centers_data(
 
 
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 import io
 
 @router.post("/analyze-question-audio-streaming/")
@@ -372,20 +413,27 @@ async def analyze_question_audio_streaming(
         return {"error": "Texto no proporcionado"}, 400
 
     try:
-        audio_response = await tts_client.audio.speech.create(
-            input=final_text,
-            model=settings.azure_openai_tts_deployment,
-            voice="nova",
-            response_format="mp3"
-        )
-
-        # Generador síncrono
-        def audio_streamer():
-            for chunk in audio_response.iter_bytes(chunk_size=1024):
+        # La conexión con el TTS se abre aquí (los errores iniciales siguen devolviendo 500) y los
+        # trozos se reenvían al cliente a medida que llegan; se cierra al terminar la respuesta
+        stack = AsyncExitStack()
+        audio_response = await stack.enter_async_context(tts_stream(final_text))
+
+        async def audio_streamer():
+            async for chunk in audio_response.iter_bytes(chunk_size=1024):
                 yield chunk
 
-        return StreamingResponse(audio_streamer(), media_type="audio/mpeg")
+        return StreamingResponse(audio_streamer(), media_type="audio/mpeg", background=BackgroundTask(stack.aclose))
 
     except Exception as e:
         logger.error(f"Error al generar audio en streaming: {e}")
-        return {"error": "No se pudo generar el audio"}, 500
\ No newline at end of file
+        return {"error": "No se pudo generar el audio"}, 500
+
+
+@router.post("/monthly-aggregation-stream/")
+async def monthly_aggregation_stream(request: MonthlyAggregationRequest, db: Session = Depends(get_db)):
+    """Devuelve la agregación mensual como NDJSON, un documento por línea, sin armar la lista completa en memoria."""
+    executor = ToolExecutor(db_session=db)
+    stream = await executor.stream_monthly_aggregation(**request.dict())
+    if isinstance(stream, dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=stream["error"])
+    return StreamingResponse(stream, media_type="application/x-ndjson")
@@ -1,16 +1,25 @@
 # app/chat/data_tools.py
 
 import json
+import orjson
+import copy
+import time
 import logging
-from pymongo import MongoClient
+import threading
+from collections import OrderedDict
+from pymongo.errors import OperationFailure
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
+from bson.decimal128 import Decimal128
 from sqlalchemy.orm import Session
 from dateutil import parser as date_parser
 from app.core.config import settings
+from app.core.clients import mongo_client
 from app.models.models import MasterCenter, Center
 from typing import Optional, List, Dict, Any
 import re
 from datetime import datetime, timedelta
 from typing import Union
+from types import SimpleNamespace
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -48,6 +57,86 @@ FULL_METRIC_MAP = {
     }
 }
 
+# Vista plana de FULL_METRIC_MAP (campo fecha, campo centro y campos de métricas sin '$'),
+# calculada una sola vez para no re-indexar diccionarios ni crear strings en cada llamada.
+SOURCE_CONFIG = {
+    source: SimpleNamespace(
+        date=config["fecha"],
+        center=config["center_name_field"],
+        metrics={metric: field.lstrip('$') for metric, field in config["metrics"].items()}
+    )
+    for source, config in FULL_METRIC_MAP.items()
+}
+
+# Tamaño de lote de los cursores de agregación con muchos resultados
+AGGREGATE_BATCH_SIZE = 500
+# Tiempo máximo de ejecución de una agregación en el servidor
+AGGREGATE_MAX_TIME_MS = 15000
+# Código de error de Mongo cuando una etapa supera el límite de memoria sin allowDiskUse
+MEMORY_LIMIT_NO_DISK_USE = 292
+# Código de error (BadValue) de Mongo cuando el hint apunta a un índice que no existe; el código
+# es genérico, así que además se compara el mensaje
+BAD_HINT = 2
+BAD_HINT_MESSAGE = "hint provided does not correspond to an existing index"
+
+
+def _parse_date(value: str, end: bool = False) -> datetime:
+    """
+    Convierte una fecha AAAA-MM-DD (o ISO) a datetime con fromisoformat, usando dateutil
+    solo si el formato no es ISO. Con end=True devuelve el último segundo de ese día.
+    """
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        parsed = date_parser.parse(value)
+    return parsed.replace(hour=23, minute=59, second=59) if end else parsed
+
+
+class Decimal128ToFloat(TypeDecoder):
+    """Decodifica los Decimal128 de Mongo directamente a float, listos para serializar a JSON."""
+    bson_type = Decimal128
+
+    def transform_bson(self, value):
+        return float(value.to_decimal())
+
+
+CODEC_OPTIONS = CodecOptions(tz_aware=False, type_registry=TypeRegistry([Decimal128ToFloat()]))
+
+# Mismo pool de conexiones que el resto de los routers (app.core.clients); solo cambian los
+# codec options de la base
+mongo_db = mongo_client.get_database(settings.mongo_db_name, codec_options=CODEC_OPTIONS)
+
+# Caché LRU con expiración para agregaciones que los dashboards repiten con los mismos
+# parámetros. Los datos de origen cambian a lo sumo cada hora, así que 5 minutos es seguro.
+RESULT_CACHE_MAXSIZE = 512
+RESULT_CACHE_TTL = 300
+_result_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def _cache_get(key: tuple) -> Optional[dict]:
+    """Devuelve una copia del resultado cacheado, o None si no existe o ya expiró."""
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del _result_cache[key]
+            return None
+        _result_cache.move_to_end(key)
+    return copy.deepcopy(value)
+
+
+def _cache_set(key: tuple, value: dict):
+    """Guarda una copia del resultado, descartando el menos usado si se supera el tamaño máximo."""
+    value = copy.deepcopy(value)
+    with _result_cache_lock:
+        _result_cache[key] = (time.monotonic() + RESULT_CACHE_TTL, value)
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_MAXSIZE:
+            _result_cache.popitem(last=False)
+
 class ToolExecutor:
     """
     Contiene todas las herramientas disponibles que la IA puede ejecutar para
@@ -55,13 +144,75 @@ class ToolExecutor:
     """
     def __init__(self, db_session: Session):
         self.db = db_session
-        self.mongo_client = MongoClient(settings.mongo_uri)
-        self.mongo_db = self.mongo_client[settings.mongo_db_name]
+        self.mongo_client = mongo_client
+        self.mongo_db = mongo_db
         # Asegúrate que los nombres de las colecciones aquí sean los correctos
         self.collections = {
             "clima": self.mongo_db["climaV2"],
             "alimentacion": self.mongo_db["alimentacionV2"]
         }
+        self._cfg = SOURCE_CONFIG
+
+    @staticmethod
+    def _center_date_index(source: str) -> List[tuple]:
+        """Especificación del índice compuesto (centro, fecha descendente) de una fuente."""
+        cfg = SOURCE_CONFIG[source]
+        return [(cfg.center, 1), (cfg.date, -1)]
+
+    async def ensure_indexes(self):
+        """Crea los índices compuestos centro+fecha que usan los filtros y ordenamientos de las herramientas."""
+        for source, collection in self.collections.items():
+            try:
+                await collection.create_index(self._center_date_index(source), background=True)
+            except Exception as e:
+                logger.warning(f"No se pudo crear el índice centro/fecha para '{source}': {e}")
+
+    @staticmethod
+    def _retry_options(collection, error: OperationFailure, pipeline: List[dict], options: dict) -> Optional[dict]:
+        """
+        Política de reintento de las agregaciones: opciones con las que reintentar después de
+        `error`, o None si el error no tiene reintento. Si el índice del hint no existe
+        (ensure_indexes solo avisa si falla) se reintenta sin hint; si una etapa no cabe en
+        memoria se reintenta con allowDiskUse y se deja un warning con el pipeline.
+        """
+        if error.code == BAD_HINT and BAD_HINT_MESSAGE in str(error) and "hint" in options:
+            logger.warning(f"El índice del hint no existe en '{collection.name}', reintentando sin hint: {error}")
+            return {key: value for key, value in options.items() if key != "hint"}
+        if error.code == MEMORY_LIMIT_NO_DISK_USE and not options.get("allowDiskUse"):
+            logger.warning(f"Agregación en '{collection.name}' superó el límite de memoria, reintentando con allowDiskUse: {pipeline}")
+            return {**options, "allowDiskUse": True}
+        return None
+
+    async def _aggregate(self, collection, pipeline: List[dict], length: Optional[int] = None, **options) -> List[dict]:
+        """Ejecuta una agregación con tiempo máximo y sin uso de disco, con la política de reintento de _retry_options."""
+        options = {"maxTimeMS": AGGREGATE_MAX_TIME_MS, "allowDiskUse": False, **options}
+        while True:
+            try:
+                return await collection.aggregate(pipeline, **options).to_list(length=length)
+            except OperationFailure as e:
+                retry = self._retry_options(collection, e, pipeline, options)
+                if retry is None:
+                    raise
+                options = retry
+
+    async def _iter_aggregate(self, collection, pipeline: List[dict], **options):
+        """
+        Como _aggregate, pero emite los documentos a medida que llegan del cursor. Solo se
+        reintenta si el error llega antes del primer documento (no se repiten filas ya emitidas).
+        """
+        options = {"maxTimeMS": AGGREGATE_MAX_TIME_MS, "allowDiskUse": False, **options}
+        while True:
+            started = False
+            try:
+                async for doc in collection.aggregate(pipeline, **options):
+                    started = True
+                    yield doc
+                return
+            except OperationFailure as e:
+                retry = None if started else self._retry_options(collection, e, pipeline, options)
+                if retry is None:
+                    raise
+                options = retry
 
     def _get_master_center_by_id(self, center_id: int) -> Optional[MasterCenter]:
         """Función auxiliar para obtener un objeto de centro desde la DB relacional."""
@@ -102,6 +253,19 @@ class ToolExecutor:
             
         return alias_value
 
+    def _resolve_center_aliases(self, center_ids: List[int], source: str) -> List[Any]:
+        """Traduce IDs de centros a sus alias en Mongo; avisa si alguno no se pudo resolver."""
+        alias_values = []
+        for center_id in center_ids:
+            center = self._get_master_center_by_id(center_id)
+            if center:
+                alias = self._get_alias_value(center, source)
+                if alias:
+                    alias_values.append(alias)
+        if alias_values and len(alias_values) != len(center_ids):
+            logger.warning(f"Solo {len(alias_values)} de {len(center_ids)} centros {center_ids} tienen alias para '{source}'; el resultado no los incluye a todos.")
+        return alias_values
+
     def _build_mongo_filter(self, center_id: int, source: str) -> Optional[Dict[str, Any]]:
         """Construye el filtro de MongoDB usando el valor del alias correcto."""
         master_center = self._get_master_center_by_id(center_id)
@@ -117,7 +281,7 @@ class ToolExecutor:
         logger.info(f"Filtro construido para MongoDB: {{'{mongo_field}': '{alias_value}'}}")
         return {mongo_field: alias_value}
 
-    def get_center_id_by_name(self, center_name: str) -> dict:
+    async def get_center_id_by_name(self, center_name: str) -> dict:
         """Busca el ID de un centro por su nombre."""
         logger.info(f"Buscando ID para el centro: '{center_name}'")
         try:
@@ -131,7 +295,7 @@ class ToolExecutor:
 
     # En data_tools.py, dentro de la clase ToolExecutor
 
-    def get_all_centers(self) -> dict:
+    async def get_all_centers(self) -> dict:
         """
         Obtiene una lista de todos los centros de cultivo disponibles,
         incluyendo una lista simple de sus IDs para facilitar su uso en el planificador.
@@ -159,7 +323,7 @@ class ToolExecutor:
             return {"error": "No se pudo obtener la lista de centros."}
     # En data_tools.py, dentro de la clase ToolExecutor
 
-    def find_centers_with_data(self, source: str) -> dict:
+    async def find_centers_with_data(self, source: str) -> dict:
         """
         Verifica cuáles de todos los centros registrados tienen al menos un documento
         en la colección de MongoDB especificada por la fuente.
@@ -169,7 +333,7 @@ class ToolExecutor:
             return {"error": f"La fuente de datos '{source}' no es válida."}
 
         # 1. Obtenemos todos los centros posibles desde la base de datos SQL.
-        all_centers_result = self.get_all_centers()
+        all_centers_result = await self.get_all_centers()
         if "error" in all_centers_result or not all_centers_result.get("centers"):
             return {"count": 0, "centers_with_data": []}
 
@@ -185,7 +349,7 @@ class ToolExecutor:
             
             if match_filter:
                 # Hacemos una consulta muy rápida para ver si existe al menos un documento.
-                has_data = collection_to_check.find_one(match_filter, {"_id": 1})
+                has_data = await collection_to_check.find_one(match_filter, {"_id": 1})
                 if has_data:
                     centers_with_data.append(center["name"])
 
@@ -195,7 +359,7 @@ class ToolExecutor:
             "centers_with_data": sorted(centers_with_data)
         }    
 
-    def get_data_range_for_source(self, center_id: int, source: str) -> dict:
+    async def get_data_range_for_source(self, center_id: int, source: str) -> dict:
         """Encuentra la primera y última fecha con registros para una fuente y centro."""
         if source not in FULL_METRIC_MAP: return {"error": f"Fuente '{source}' no reconocida."}
         
@@ -208,14 +372,14 @@ class ToolExecutor:
         
         pipeline = [{"$match": match_filter}, {"$group": {"_id": None, "min_date": {"$min": f"${date_field}"}, "max_date": {"$max": f"${date_field}"}}}]
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             if not result or not result[0].get("min_date"): return {"has_data": False}
             return {"has_data": True, "first_record": result[0]["min_date"].strftime('%Y-%m-%d'), "last_record": result[0]["max_date"].strftime('%Y-%m-%d')}
         except Exception as e:
             logger.error(f"Error buscando rango de datos: {e}")
             return {"error": "No se pudo determinar el rango de fechas."}
 
-    def get_timeseries_data(self, center_ids: Union[int, List[int]], source: str, metrics: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
+    async def get_timeseries_data(self, center_ids: Union[int, List[int]], source: str, metrics: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
         """
         Obtiene una serie de tiempo para una o más métricas.
         Ahora acepta un solo ID de centro o una lista de IDs.
@@ -240,14 +404,7 @@ class ToolExecutor:
             return {"error": f"Fuente '{source}' no reconocida."}
 
         # --- LÓGICA DE FILTRO MEJORADA PARA MÚLTIPLES CENTROS ---
-        alias_values = []
-        for center_id in ids_a_procesar:
-            center = self._get_master_center_by_id(center_id)
-            if center:
-                alias = self._get_alias_value(center, source)
-                if alias:
-                    alias_values.append(alias)
-        
+        alias_values = self._resolve_center_aliases(ids_a_procesar, source)
         if not alias_values:
             return {"error": "Ninguno de los IDs de centro proporcionados es válido."}
             
@@ -260,7 +417,7 @@ class ToolExecutor:
         # --- FIN DE LÓGICA DE FILTRO MEJORADA ---
 
         if start_date and end_date:
-            match_filter[date_field] = {"$gte": date_parser.parse(start_date), "$lte": date_parser.parse(end_date).replace(hour=23, minute=59, second=59)}
+            match_filter[date_field] = {"$gte": _parse_date(start_date), "$lte": _parse_date(end_date, end=True)}
 
         projection = {"_id": 0, "fecha": f"${date_field}", config["center_name_field"]: 1} # <-- Añadimos el nombre del centro al resultado
         valid_metrics_found = False
@@ -279,7 +436,7 @@ class ToolExecutor:
         pipeline.extend([{"$project": projection}, {"$sort": {"fecha": 1}}])
         
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             if not result:
                 return {"count": 0, "data": [], "summary": "No se encontraron datos."}
             return {"count": len(result), "data": result, "default_limit_used": default_limit_applied}
@@ -287,7 +444,7 @@ class ToolExecutor:
             logger.error(f"Error en get_timeseries_data: {e}", exc_info=True)
             return {"error": "Ocurrió un error al consultar la base de datos."}
 
-    def correlate_timeseries_data(self, center_id: int, primary_source: str, primary_metrics: List[str], secondary_source: str, secondary_metrics: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
+    async def correlate_timeseries_data(self, center_id: int, primary_source: str, primary_metrics: List[str], secondary_source: str, secondary_metrics: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
         """
         Correlaciona métricas de dos fuentes distintas. Si no se especifican fechas,
         encuentra automáticamente el período de tiempo donde ambos conjuntos de datos se superponen.
@@ -301,13 +458,13 @@ class ToolExecutor:
         if not start_date and not end_date:
             logger.info("No se especificaron fechas. Buscando superposición de datos automáticamente.")
             # Obtenemos los rangos de ambas fuentes
-            range1 = self.get_data_range_for_source(center_id, primary_source)
-            range2 = self.get_data_range_for_source(center_id, secondary_source)
+            range1 = await self.get_data_range_for_source(center_id, primary_source)
+            range2 = await self.get_data_range_for_source(center_id, secondary_source)
 
             if range1.get("has_data") and range2.get("has_data"):
                 # Calculamos la superposición (intersección) de los rangos
-                overlap_start = max(date_parser.parse(range1["first_record"]), date_parser.parse(range2["first_record"]))
-                overlap_end = min(date_parser.parse(range1["last_record"]), date_parser.parse(range2["last_record"]))
+                overlap_start = max(_parse_date(range1["first_record"]), _parse_date(range2["first_record"]))
+                overlap_end = min(_parse_date(range1["last_record"]), _parse_date(range2["last_record"]))
 
                 if overlap_start <= overlap_end:
                     logger.info(f"Superposición encontrada: de {overlap_start.date()} a {overlap_end.date()}")
@@ -344,7 +501,7 @@ class ToolExecutor:
 
         match_filter = { p_config["center_name_field"]: primary_alias_value }
         if final_start_date and final_end_date:
-            match_filter[p_config["fecha"]] = {"$gte": date_parser.parse(final_start_date), "$lte": date_parser.parse(final_end_date).replace(hour=23, minute=59, second=59)}
+            match_filter[p_config["fecha"]] = {"$gte": _parse_date(final_start_date), "$lte": _parse_date(final_end_date, end=True)}
         
         # ... (El resto del pipeline de agregación con $lookup se mantiene exactamente igual)
         initial_project = {"_id": 0, "fecha": f"${p_config['fecha']}", **{metric: p_config["metrics"][metric] for metric in primary_metrics if metric in p_config["metrics"]}}
@@ -374,7 +531,7 @@ class ToolExecutor:
         ])
 
         try:
-            result = list(primary_collection.aggregate(pipeline))
+            result = await self._aggregate(primary_collection, pipeline)
             return {
                 "count": len(result),
                 "data": result,
@@ -442,7 +599,7 @@ class ToolExecutor:
         except Exception as e:
             logger.error(f"Error en la agregación mensual: {e}")
             return {"error": "Error al calcular la agregación mensual."}  """   
-    def get_monthly_aggregation(self, center_id: int, source: str, metrics: List[str], aggregation: str, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
+    async def get_monthly_aggregation(self, center_id: int, source: str, metrics: List[str], aggregation: str, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
         """
         Calcula una agregación mensual para una LISTA de métricas,
         opcionalmente filtrando por fechas o limitando a los N meses más recientes.
@@ -464,14 +621,14 @@ class ToolExecutor:
         date_field = config["fecha"]
 
         if start_date and end_date:
-            match_filter[date_field] = {"$gte": date_parser.parse(start_date), "$lte": date_parser.parse(end_date).replace(hour=23, minute=59, second=59)}
+            match_filter[date_field] = {"$gte": _parse_date(start_date), "$lte": _parse_date(end_date, end=True)}
 
         group_stage = {"_id": {"year": {"$year": f"${date_field}"}, "month": {"$month": f"${date_field}"}}}
         project_stage = {"_id": 0, "periodo": {"$concat": [{"$toString": "$_id.year"}, "-", {"$toString": "$_id.month"}]}}
 
         for metric in metrics:
             if metric in config["metrics"]:
-                metric_db_field = config["metrics"][metric].replace('$', '')
+                metric_db_field = self._cfg[source].metrics[metric]
                 group_stage[f"val_{metric}"] = {mongo_operator: f"${metric_db_field}"}
                 project_stage[metric] = {"$round": [f"$val_{metric}", 2]}
         
@@ -495,13 +652,13 @@ class ToolExecutor:
         pipeline.append({"$project": project_stage})
 
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error en la agregación mensual: {e}")
             return {"error": "Error al calcular la agregación mensual."}
             
-    def get_extrema_for_metric(self, center_id: int, source: str, metric: str, mode: str = 'max') -> dict:
+    async def get_extrema_for_metric(self, center_id: int, source: str, metric: str, mode: str = 'max') -> dict:
         """Encuentra el registro con el valor máximo ('max') o mínimo ('min') de una métrica."""
         if source not in FULL_METRIC_MAP or metric not in FULL_METRIC_MAP[source]["metrics"]:
             return {"error": "Fuente o métrica no válida."}
@@ -509,20 +666,18 @@ class ToolExecutor:
         match_filter = self._build_mongo_filter(center_id, source)
         if not match_filter: return {"error": f"No se pudo crear un filtro para el centro {center_id}."}
         
-        config = FULL_METRIC_MAP[source]
         collection = self.collections[source]
-        metric_db_field = config["metrics"][metric].replace('$', '')
+        metric_db_field = self._cfg[source].metrics[metric]
         sort_order = -1 if mode == 'max' else 1
 
-        pipeline = [{"$match": match_filter}, {"$sort": {metric_db_field: sort_order}}, {"$limit": 1}]
+        pipeline = [{"$match": match_filter}, {"$sort": {metric_db_field: sort_order}}, {"$limit": 1}, {"$project": {"_id": 0}}]
         try:
-            result = list(collection.aggregate(pipeline))
-            if result and '_id' in result[0]: result[0]['_id'] = str(result[0]['_id'])
+            result = await self._aggregate(collection, pipeline, length=1)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error buscando extremo: {e}")
             return {"error": "Error al buscar el valor extremo."}
-    def get_monthly_summary_for_all_centers(self, source: str, metric_to_sum: str) -> dict:
+    async def get_monthly_summary_for_all_centers(self, source: str, metric_to_sum: str) -> dict:
         """
         Calcula la suma mensual de una métrica para TODOS los centros de cultivo a la vez.
         """
@@ -538,7 +693,7 @@ class ToolExecutor:
         collection = self.collections[source]
         date_field = config["fecha"]
         center_name_field = config["center_name_field"]
-        metric_db_field = config["metrics"][metric_to_sum].replace('$', '')
+        metric_db_field = self._cfg[source].metrics[metric_to_sum]
 
         pipeline = [
             {
@@ -571,12 +726,12 @@ class ToolExecutor:
             }
         ]
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error en la agregación mensual para todos los centros: {e}")
             return {"error": "Error al calcular el resumen mensual para todos los centros."}    
-    def get_annual_aggregation(self, center_id: int, source: str, metrics: List[str], aggregation: str, year: int) -> dict:
+    async def get_annual_aggregation(self, center_id: int, source: str, metrics: List[str], aggregation: str, year: int) -> dict:
         """
         Calcula una agregación anual (suma o promedio) para una lista de métricas.
         """
@@ -604,7 +759,7 @@ class ToolExecutor:
 
         for metric in metrics:
             if metric in config["metrics"]:
-                metric_db_field = config["metrics"][metric].replace('$', '')
+                metric_db_field = self._cfg[source].metrics[metric]
                 group_stage[f"val_{metric}"] = {mongo_operator: f"${metric_db_field}"}
                 project_stage[f"{metric}_{aggregation}"] = {"$round": [f"$val_{metric}", 2]}
             else:
@@ -615,12 +770,12 @@ class ToolExecutor:
 
         pipeline = [{"$match": match_filter}, {"$group": group_stage}, {"$project": project_stage}]
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error en la agregación anual: {e}")
             return {"error": "Error al calcular la agregación anual."}
-    def get_last_reading_for_metric(self, center_id: int, source: str, metric: str) -> dict:
+    async def get_last_reading_for_metric(self, center_id: int, source: str, metric: str) -> dict:
         """Obtiene el registro más reciente basado en la fecha para una métrica."""
         if source not in FULL_METRIC_MAP: return {"error": "Fuente o métrica no válida."}
         
@@ -631,172 +786,297 @@ class ToolExecutor:
         collection = self.collections[source]
         date_field = config["fecha"]
 
-        pipeline = [{"$match": match_filter}, {"$sort": {date_field: -1}}, {"$limit": 1}]
+        pipeline = [{"$match": match_filter}, {"$sort": {date_field: -1}}, {"$limit": 1}, {"$project": {"_id": 0}}]
         try:
-            result = list(collection.aggregate(pipeline))
-            if result and '_id' in result[0]: result[0]['_id'] = str(result[0]['_id'])
+            # El índice (centro, fecha desc) resuelve el $sort + $limit sin ordenar en memoria
+            result = await self._aggregate(collection, pipeline, length=1, hint=self._center_date_index(source))
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error buscando última lectura: {e}")
             return {"error": "Error al buscar el último registro."}
     # En data_tools.py, dentro de la clase ToolExecutor
 
-    def get_mortality_rate(self, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None) -> dict:
+    @staticmethod
+    def _mortality_stages(date_field: str, center_name_field: str) -> List[dict]:
+        """Etapas del KPI de mortalidad ponderada que van después del $match."""
+        return [
+            # Se renombran una sola vez los campos con tildes/espacios a nombres cortos
+            {"$project": {
+                center_name_field: 1, "Unidad": 1, date_field: 1,
+                "mort": "$Mortalidad", "init": "$Número Ingreso"
+            }},
+            # $top se queda con el registro más reciente de cada jaula sin ordenar toda la colección
+            {"$group": {
+                "_id": {"centro": f"${center_name_field}", "unidad": "$Unidad"},
+                "last_doc": {"$top": {
+                    "sortBy": {date_field: -1},
+                    "output": {"mort": "$mort", "init": "$init"}
+                }}
+            }},
+            {"$project": {
+                "_id": 0, "centro": "$_id.centro", "initial_stock": "$last_doc.init",
+                "mortalities_count": {"$multiply": [{"$divide": ["$last_doc.mort", 100]}, "$last_doc.init"]}
+            }},
+            {"$group": {
+                "_id": "$centro",
+                "total_mortalities": {"$sum": "$mortalities_count"},
+                "total_initial_stock": {"$sum": "$initial_stock"}
+            }},
+            {"$project": {
+                "_id": 0,
+                "centro": "$_id",
+                "total_peces_ingresados": "$total_initial_stock",
+                "total_peces_muertos": "$total_mortalities",
+                "porcentaje_mortalidad_total": {
+                    "$cond": {
+                        "if": {"$gt": ["$total_initial_stock", 0]},
+                        "then": {"$multiply": [{"$divide": ["$total_mortalities", "$total_initial_stock"]}, 100]},
+                        "else": 0
+                    }
+                }
+            }},
+            {"$sort": {"centro": 1}}
+        ]
+
+    @staticmethod
+    def _round_mortality(rows: List[dict]) -> List[dict]:
+        """Redondea los totales del KPI de mortalidad."""
+        for item in rows:
+            item["total_peces_muertos"] = round(item["total_peces_muertos"], 0)
+            item["porcentaje_mortalidad_total"] = round(item["porcentaje_mortalidad_total"], 2)
+        return rows
+
+    async def get_mortality_rate(self, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None) -> dict:
         """
         Calcula el KPI de mortalidad ponderada, devolviendo el porcentaje y los totales absolutos.
         - Filtra por una lista de centros si se proporciona.
         - Filtra por fecha si se proporciona.
         - Devuelve el estado para todos los centros si no se proporcionan parámetros.
         """
+        cache_key = ("mortality", tuple(sorted(center_ids or ())), start_date, end_date)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
         source = "alimentacion"
         config = FULL_METRIC_MAP[source]
         collection = self.collections[source]
         date_field = config["fecha"]
         center_name_field = config["center_name_field"]
 
-        # 1. Construir el filtro base
-        match_filter = {
-            # Filtro de calidad: asegurar que el campo del centro exista y no sea nulo
-            center_name_field: {"$exists": True, "$ne": None}
-        }
-        
-        # 2. Añadir filtro por centros si se especifica
+        # 1. Filtro por centros si se especifica; si no, solo registros con centro (filtro de calidad)
         if center_ids:
             logger.info(f"Calculando KPI de mortalidad para los centros: {center_ids}")
-            alias_values = []
-            for center_id in center_ids:
-                master_center = self._get_master_center_by_id(center_id)
-                if master_center:
-                    alias = self._get_alias_value(master_center, source)
-                    if alias:
-                        alias_values.append(alias)
-            
+            alias_values = self._resolve_center_aliases(center_ids, source)
             if not alias_values:
                 return {"error": "Ninguno de los IDs de centro proporcionados tiene un alias válido."}
-            
-            # Añadimos el operador $in al filtro existente
-            match_filter[center_name_field]["$in"] = alias_values
+            match_filter = {center_name_field: {"$in": alias_values}}
         else:
             logger.info("Calculando KPI de mortalidad para todos los centros.")
+            match_filter = {center_name_field: {"$exists": True, "$ne": None}}
 
-        # 3. Añadir filtro por fecha si se especifica
+        # 2. Añadir filtro por fecha si se especifica
         if end_date:
             try:
                 # Nos interesa todo lo que sea ANTERIOR O IGUAL a la fecha de fin.
-                match_filter[date_field] = {"$lte": date_parser.parse(end_date).replace(hour=23, minute=59, second=59)}
+                match_filter[date_field] = {"$lte": _parse_date(end_date, end=True)}
             except ValueError:
                 return {"error": "Formato de fecha inválido. Use AAAA-MM-DD."}
 
-        # 4. Pipeline de agregación
-        pipeline = [
-            {"$match": match_filter},
-            {"$sort": {center_name_field: 1, "Unidad": 1, date_field: -1}},
-            {"$group": {
-                "_id": {"centro": f"${center_name_field}", "unidad": "$Unidad"},
-                "last_mortality_percent": {"$first": "$Mortalidad"},
-                "initial_stock": {"$first": "$Número Ingreso"}
-            }},
-            {"$project": {
-                "_id": 0, "centro": "$_id.centro", "initial_stock": 1,
-                "mortalities_count": {"$multiply": [{"$divide": ["$last_mortality_percent", 100]}, "$initial_stock"]}
-            }},
-            {"$group": {
-                "_id": "$centro",
-                "total_mortalities": {"$sum": "$mortalities_count"},
-                "total_initial_stock": {"$sum": "$initial_stock"}
-            }},
-            {"$project": {
-                "_id": 0,
-                "centro": "$_id",
-                "total_peces_ingresados": "$total_initial_stock",
-                "total_peces_muertos": {"$round": ["$total_mortalities", 0]},
-                "porcentaje_mortalidad_total": {
-                    "$cond": {
-                        "if": {"$gt": ["$total_initial_stock", 0]},
-                        "then": {"$multiply": [{"$divide": ["$total_mortalities", "$total_initial_stock"]}, 100]},
-                        "else": 0
-                    }
-                }
-            }},
-            {"$sort": {"centro": 1}}
-        ]
+        # 3. Pipeline de agregación
+        pipeline = [{"$match": match_filter}, *self._mortality_stages(date_field, center_name_field)]
 
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline, batchSize=AGGREGATE_BATCH_SIZE)
             if not result: return {"count": 0, "data": []}
-            
-            for item in result:
-                item["porcentaje_mortalidad_total"] = round(item["porcentaje_mortalidad_total"], 2)
 
-            return {"count": len(result), "data": result}
+            self._round_mortality(result)
+            response = {"count": len(result), "data": result}
+            _cache_set(cache_key, response)
+            return response
         except Exception as e:
             logger.error(f"Error calculando la tasa de mortalidad: {e}")
             return {"error": "Error al calcular la tasa de mortalidad."}
-    # En data_tools.py, REEMPLAZA tu función get_monthly_aggregation
-# y ELIMINA get_monthly_summary_for_all_centers
-
-    def get_monthly_aggregation(self, source: str, metrics: List[str], aggregation: str, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
+    async def get_dashboard(self, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None) -> dict:
         """
-        Calcula una agregación mensual (suma o promedio) para una LISTA de métricas.
-        Puede filtrar por uno, varios o todos los centros.
+        Devuelve en una sola consulta el último registro de alimentación de cada centro y el KPI
+        de mortalidad de los centros indicados (o de todos), usando un $match común y $facet.
         """
-        logger.info(f"Calculando '{aggregation}' mensual para centros {center_ids or 'TODOS'}, métricas: {metrics}")
+        source = "alimentacion"
+        cfg = self._cfg[source]
+        collection = self.collections[source]
+        date_field = cfg.date
+        center_name_field = cfg.center
+
+        # El $match va antes del $facet para que use el índice centro/fecha
+        if center_ids:
+            alias_values = self._resolve_center_aliases(center_ids, source)
+            if not alias_values:
+                return {"error": "Ninguno de los IDs de centro proporcionados tiene un alias válido."}
+            match_filter = {center_name_field: {"$in": alias_values}}
+        else:
+            match_filter = {center_name_field: {"$exists": True, "$ne": None}}
+
+        # Igual que get_mortality_rate, el $match común solo corta por la fecha de fin; la de
+        # inicio se aplica dentro de la faceta "latest"
+        latest_stages = []
+        try:
+            if end_date:
+                match_filter[date_field] = {"$lte": _parse_date(end_date, end=True)}
+            if start_date:
+                latest_stages.append({"$match": {date_field: {"$gte": _parse_date(start_date)}}})
+        except ValueError:
+            return {"error": "Formato de fecha inválido. Use AAAA-MM-DD."}
+
+        latest_stages += [
+            # Último registro de cada centro con $top, sin ordenar toda la faceta
+            {"$group": {
+                "_id": f"${center_name_field}",
+                "last_doc": {"$top": {"sortBy": {date_field: -1}, "output": "$$ROOT"}}
+            }},
+            {"$replaceRoot": {"newRoot": "$last_doc"}},
+            {"$project": {"_id": 0}}
+        ]
+        pipeline = [
+            {"$match": match_filter},
+            {"$facet": {
+                "latest": latest_stages,
+                "mortality": self._mortality_stages(date_field, center_name_field)
+            }}
+        ]
+
+        try:
+            result = await self._aggregate(collection, pipeline, length=1)
+            facets = result[0] if result else {"latest": [], "mortality": []}
+            return {
+                "latest": facets["latest"],
+                "mortality": {"count": len(facets["mortality"]), "data": self._round_mortality(facets["mortality"])}
+            }
+        except Exception as e:
+            logger.error(f"Error armando el resumen del dashboard: {e}")
+            return {"error": "Error al obtener el resumen del dashboard."}
 
+    # En data_tools.py, REEMPLAZA tu función get_monthly_aggregation
+# y ELIMINA get_monthly_summary_for_all_centers
+
+    def _build_monthly_aggregation(self, source: str, metrics: List[str], aggregation: str, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
+        """Arma el pipeline de la agregación mensual; devuelve {"error": ...} si los parámetros no son válidos."""
         MONGO_AGG_OPERATORS = {"sum": "$sum", "avg": "$avg"}
         mongo_operator = MONGO_AGG_OPERATORS.get(aggregation.lower())
         if not mongo_operator: return {"error": f"Agregación no válida: '{aggregation}'."}
         if source not in FULL_METRIC_MAP: return {"error": f"Fuente '{source}' no reconocida."}
 
-        config = FULL_METRIC_MAP[source]
-        collection = self.collections[source]
-        date_field = config["fecha"]
-        center_name_field = config["center_name_field"]
-        
+        cfg = self._cfg[source]
+        date_field = cfg.date
+        center_name_field = cfg.center
+
         match_filter = {}
         if center_ids:
-            alias_values = []
-            for center_id in center_ids:
-                center = self._get_master_center_by_id(center_id)
-                if center:
-                    alias = self._get_alias_value(center, source)
-                    if alias: alias_values.append(alias)
+            alias_values = self._resolve_center_aliases(center_ids, source)
             if not alias_values: return {"error": "Ningún ID de centro proporcionado es válido."}
             match_filter[center_name_field] = {"$in": alias_values}
 
         if start_date and end_date:
-            match_filter[date_field] = {"$gte": date_parser.parse(start_date), "$lte": date_parser.parse(end_date).replace(hour=23, minute=59, second=59)}
+            match_filter[date_field] = {"$gte": _parse_date(start_date), "$lte": _parse_date(end_date, end=True)}
 
-        group_stage = {"_id": {"centro": f"${center_name_field}", "year": {"$year": f"${date_field}"}, "month": {"$month": f"${date_field}"}}}
-        project_stage = {"_id": 0, "centro": "$_id.centro", "periodo": {"$concat": [{"$toString": "$_id.year"}, "-", {"$toString": "$_id.month"}]}}
+        # Un solo $dateTrunc por documento en vez de $year + $month
+        group_stage = {"_id": {"centro": f"${center_name_field}", "periodo": {"$dateTrunc": {"date": f"${date_field}", "unit": "month"}}}}
+        # El "periodo" se formatea en Python al leer el resultado, no con $dateToString en Mongo
+        project_stage = {"_id": 0, "centro": "$_id.centro", "periodo": "$_id.periodo"}
+        # Solo los campos que necesita el $group, para no arrastrar documentos completos
+        fields_stage = {"_id": 0, center_name_field: 1, date_field: 1}
 
         for metric in metrics:
-            if metric in config["metrics"]:
-                metric_db_field = config["metrics"][metric].replace('$', '')
+            metric_db_field = cfg.metrics.get(metric)
+            if metric_db_field:
                 group_stage[f"val_{metric}"] = {mongo_operator: f"${metric_db_field}"}
-                project_stage[metric] = {"$round": [f"$val_{metric}", 2]}
-        
-        if len(project_stage) <= 2: return {"error": f"Ninguna de las métricas {metrics} es válida."}
+                project_stage[metric] = f"$val_{metric}"
+                fields_stage[metric_db_field] = 1
 
-        pipeline = [
-            {"$match": match_filter}, {"$group": group_stage},
-            {"$sort": {"_id.year": -1, "_id.month": -1}},
-        ]
+        if len(project_stage) <= 3: return {"error": f"Ninguna de las métricas {metrics} es válida."}
+
+        # Un $match vacío no filtra nada, así que solo se agrega si hay filtros
+        pipeline = []
+        if match_filter:
+            pipeline.append({"$match": match_filter})
+        pipeline.extend([
+            {"$project": fields_stage},
+            {"$group": group_stage},
+            {"$sort": {"_id.periodo": -1}},
+        ])
         if limit:
             pipeline.append({"$limit": limit})
         
         pipeline.extend([
-            {"$sort": {"_id.centro": 1, "_id.year": 1, "_id.month": 1}},
+            {"$sort": {"_id.centro": 1, "_id.periodo": 1}},
             {"$project": project_stage}
         ])
-        
+
+        # Solo se fuerza el índice cuando el filtro usa su prefijo (el campo del centro)
+        aggregate_options = {"batchSize": AGGREGATE_BATCH_SIZE}
+        if center_name_field in match_filter:
+            aggregate_options["hint"] = self._center_date_index(source)
+
+        return {"pipeline": pipeline, "options": aggregate_options}
+
+    @staticmethod
+    def _format_monthly_item(item: dict, metrics: List[str]) -> dict:
+        """Arma el "periodo" y redondea las métricas de un documento de la agregación mensual."""
+        # El redondeo se hace aquí y no con $round dentro del pipeline
+        # Los registros sin fecha quedan agrupados en periodo null, como antes de $dateTrunc
+        periodo = item["periodo"]
+        item["periodo"] = periodo.strftime("%Y-%m") if periodo else None
+        for metric in metrics:
+            if item.get(metric) is not None:
+                item[metric] = round(item[metric], 2)
+        return item
+
+    async def get_monthly_aggregation(self, source: str, metrics: List[str], aggregation: str, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None) -> dict:
+        """
+        Calcula una agregación mensual (suma o promedio) para una LISTA de métricas.
+        Puede filtrar por uno, varios o todos los centros.
+        """
+        logger.info(f"Calculando '{aggregation}' mensual para centros {center_ids or 'TODOS'}, métricas: {metrics}")
+
+        cache_key = ("monthly", source, tuple(sorted(center_ids or ())), start_date, end_date, tuple(metrics), aggregation.lower(), limit)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        query = self._build_monthly_aggregation(source, metrics, aggregation, center_ids, start_date, end_date, limit)
+        if "error" in query: return query
+
         try:
-            result = list(collection.aggregate(pipeline))
-            return {"count": len(result), "data": result}
+            rows = await self._aggregate(self.collections[source], query["pipeline"], **query["options"])
+            result = [self._format_monthly_item(item, metrics) for item in rows]
+            response = {"count": len(result), "data": result}
+            _cache_set(cache_key, response)
+            return response
         except Exception as e:
             logger.error(f"Error en la agregación mensual: {e}")
-            return {"error": "Error al calcular la agregación mensual."}    
+            return {"error": "Error al calcular la agregación mensual."}
+
+    async def stream_monthly_aggregation(self, source: str, metrics: List[str], aggregation: str, center_ids: Optional[List[int]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None):
+        """
+        Igual que get_monthly_aggregation, pero devuelve un generador que emite cada
+        documento como una línea NDJSON a medida que llega del cursor.
+        """
+        query = self._build_monthly_aggregation(source, metrics, aggregation, center_ids, start_date, end_date, limit)
+        if "error" in query: return query
+
+        cursor = self._iter_aggregate(self.collections[source], query["pipeline"], **query["options"])
+
+        async def generate():
+            try:
+                async for item in cursor:
+                    yield orjson.dumps(self._format_monthly_item(item, metrics), default=str) + b"\n"
+            except Exception as e:
+                logger.error(f"Error en la agregación mensual (streaming): {e}")
+                yield orjson.dumps({"error": "Error al calcular la agregación mensual."}) + b"\n"
+
+        return generate()
         
-    def get_active_cages_for_center(self, center_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None) -> dict:
+    async def get_active_cages_for_center(self, center_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None) -> dict:
         """
         Obtiene una lista de las jaulas ('Unidad') únicas que tuvieron registros
         para un centro en un período de tiempo opcional.
@@ -811,17 +1091,17 @@ class ToolExecutor:
         date_field = config["fecha"]
 
         if start_date and end_date:
-            match_filter[date_field] = {"$gte": date_parser.parse(start_date), "$lte": date_parser.parse(end_date)}
+            match_filter[date_field] = {"$gte": _parse_date(start_date), "$lte": _parse_date(end_date)}
 
         try:
             # Usamos distinct para obtener los valores únicos del campo "Unidad"
-            cages = collection.distinct("Unidad", match_filter)
+            cages = await collection.distinct("Unidad", match_filter)
             return {"count": len(cages), "cage_ids": sorted(cages)}
         except Exception as e:
             logger.error(f"Error al buscar jaulas activas: {e}")
             return {"error": "No se pudieron obtener las jaulas activas."}
 
-    def get_cage_initial_data(self, center_id: int, cage_ids: List[int]) -> dict:
+    async def get_cage_initial_data(self, center_id: int, cage_ids: List[int]) -> dict:
         """
         Obtiene los datos iniciales (peces ingresados y peso promedio inicial) para
         una lista específica de jaulas en un centro.
@@ -855,12 +1135,12 @@ class ToolExecutor:
             {"$sort": {"jaula": 1}}
         ]
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error obteniendo datos iniciales de jaulas: {e}")
             return {"error": "Error al consultar los datos iniciales de las jaulas."}
-    def get_monthly_aggregation_for_cages(self, center_id: int, cage_ids: List[int], metrics: List[str], aggregation: str) -> dict:
+    async def get_monthly_aggregation_for_cages(self, center_id: int, cage_ids: List[int], metrics: List[str], aggregation: str) -> dict:
         """
         Calcula una agregación mensual para una lista de métricas y una lista de jaulas.
         """
@@ -900,7 +1180,7 @@ class ToolExecutor:
         valid_metrics = 0
         for metric in metrics:
             if metric in config["metrics"]:
-                metric_db_field = config["metrics"][metric].replace('$', '')
+                metric_db_field = self._cfg[source].metrics[metric]
                 group_stage[f"val_{metric}"] = {mongo_operator: f"${metric_db_field}"}
                 project_stage[metric] = {"$round": [f"$val_{metric}", 2]}
                 valid_metrics += 1
@@ -916,12 +1196,12 @@ class ToolExecutor:
         ]
 
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error en agregación mensual por jaula: {e}")
             return {"error": "Error al calcular la agregación mensual por jaula."}
-    def get_cage_harvest_data(self, center_id: int, cage_ids: List[int]) -> dict:
+    async def get_cage_harvest_data(self, center_id: int, cage_ids: List[int]) -> dict:
         """
         Calcula el total de peces cosechados para una lista de jaulas.
         La lógica es: (Peces Ingresados) - (% Mortalidad Final * Peces Ingresados).
@@ -967,7 +1247,7 @@ class ToolExecutor:
             {"$sort": {"jaula": 1}}
         ]
         try:
-            result = list(collection.aggregate(pipeline))
+            result = await self._aggregate(collection, pipeline)
             return {"count": len(result), "data": result}
         except Exception as e:
             logger.error(f"Error obteniendo datos de cosecha calculados: {e}")
@@ -97,9 +97,12 @@ PLANNER_SYSTEM_PROMPT_LINES = [
     "9. `get_mortality_rate(center_ids: Optional[List[int]], start_date: Optional[str], end_date: Optional[str])`",
     "    * **Para qué sirve:** Calcula el KPI de mortalidad real y ponderado. Se adapta si pides uno, varios o todos los centros. Si se especifican fechas, calcula la mortalidad acumulada al final de ese período.",
     "    * **Cuándo usarla:** OBLIGATORIO y ÚNICA herramienta a usar para cualquier pregunta sobre 'mortalidad'.",
+    "10. `get_dashboard(center_ids: Optional[List[int]], start_date: Optional[str], end_date: Optional[str])`",
+    "    * **Para qué sirve:** Devuelve en una sola llamada el último registro de alimentación de cada centro y la mortalidad de los centros.",
+    "    * **Cuándo usarla:** Para preguntas de estado general que piden a la vez la última lectura y la mortalidad.",
     "",
     "**D. Herramienta de Respuesta Directa:**",
-    "9. `direct_answer(response: str)`",
+    "11. `direct_answer(response: str)`",
     "",
     "--- EJEMPLO DE PLAN IDEAL (NOTA LA ESTRUCTURA DE 3 CLAVES EN CADA PASO) ---",
     'Pregunta: "Analiza cómo la temperatura del ambiente afectó al crecimiento de los peces en Pirquen durante abril."',
@@ -127,20 +130,20 @@ PLANNER_SYSTEM_PROMPT_LINES = [
     '  ]',
     '}',
     "**D. Herramientas Específicas de Jaulas (Unidades):**",
-    "10. `get_active_cages_for_center(center_id, start_date, end_date)`",
+    "12. `get_active_cages_for_center(center_id, start_date, end_date)`",
     "   * **Para qué sirve:** Devuelve una lista de los números de jaula que estuvieron operativas en un centro.",
     "   * **Cuándo usarla:** OBLIGATORIO si el usuario pregunta 'cuántas jaulas', 'qué jaulas' o 'lista de unidades'.",
     "",
-    "11. `get_cage_initial_data(center_id, cage_ids: List[int])`",
+    "13. `get_cage_initial_data(center_id, cage_ids: List[int])`",
     "   * **Para qué sirve:** Obtiene el número de peces sembrados y el peso inicial para una o varias jaulas específicas.",
     "   * **Cuándo usarla:** OBLIGATORIO para preguntas como 'cuántos peces se ingresaron por jaula' o 'peso de siembra'.",
     # ... (después de la herramienta 11 que agregamos antes) ...
 
-    "12. `get_monthly_aggregation_for_cages(center_id, cage_ids: List[int], metrics: List[str], aggregation: str)`",
+    "14. `get_monthly_aggregation_for_cages(center_id, cage_ids: List[int], metrics: List[str], aggregation: str)`",
     "   * **Para qué sirve:** Es la herramienta principal para analizar el rendimiento de jaulas específicas. Calcula agregados mensuales (suma, promedio) para KPIs como 'sgr', 'fcr_biologico', 'mortalidad', 'alimento_total'.",
     "   * **Cuándo usarla:** OBLIGATORIO para preguntas sobre la evolución o el promedio de cualquier métrica a nivel de jaula. Úsala para comparar el rendimiento entre jaulas.",
     "",
-    "13. `get_cage_harvest_data(center_id, cage_ids: List[int])`",
+    "15. `get_cage_harvest_data(center_id, cage_ids: List[int])`",
     "   * **Para qué sirve:** Calcula el número total de peces cosechados de una o varias jaulas. IMPORTANTE: Lo hace calculando (Peces Ingresados - % Mortalidad Final).",
     "   * **Cuándo usarla:** OBLIGATORIO si el usuario pregunta por 'cosecha', 'peces cosechados' o 'salidas de peces'.",
     "```"
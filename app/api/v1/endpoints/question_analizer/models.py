@@ -23,4 +23,13 @@ class FinalResponse(BaseModel):
     chart: Optional[ChartData] = None
     audio_base64: Optional[str] = None
     debug_context: Optional[Dict[str, Any]] = None # Para depuración
-    
\ No newline at end of file
+
+class MonthlyAggregationRequest(BaseModel):
+    """Parámetros de una agregación mensual que se devuelve en streaming (NDJSON)."""
+    source: str
+    metrics: List[str]
+    aggregation: str
+    center_ids: Optional[List[int]] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    limit: Optional[int] = None
@@ -1,19 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
 import os
 from dotenv import load_dotenv
 from app.core.config import settings
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional, List, Dict, Any
 import json
+import asyncio
+import hashlib
+import time
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import re # <-- Importar para detección de preguntas simples
 # --- NUEVO: Importar SQLAlchemy y modelo Center ---
 from sqlalchemy.orm import Session
 from app.core.database import get_db
-from app.models.models import Center
+from app.models.models import Center, User
+from app.api.deps import has_permission
 import base64
 from dateutil.relativedelta import relativedelta
 from dateutil import parser as date_parser
@@ -27,8 +33,8 @@ router = APIRouter()
 # Cargar variables de entorno si no están ya cargadas
 load_dotenv()
 
-# Configurar el cliente de Azure OpenAI
-client = AzureOpenAI(
+# Configurar el cliente de Azure OpenAI (asíncrono, para no bloquear el event loop)
+client = AsyncAzureOpenAI(
     api_version=settings.azure_openai_api_version,
     azure_endpoint=settings.azure_openai_endpoint,
     api_key=settings.azure_openai_api_key,
@@ -51,20 +57,177 @@ MONGO_CHAT_HISTORY_COLLECTION_NAME = os.getenv("MONGO_CHAT_HISTORY_COLLECTION_NA
 MONGO_CENTERS_COLLECTION_NAME = os.getenv("MONGO_CENTERS_COLLECTION_NAME", "centers")
 MONGO_ALIMENTACION_COLLECTION_NAME = os.getenv("MONGO_ALIMENTACION_COLLECTION_NAME", "alimentacion")
 MONGO_CLIMA_COLLECTION_NAME = os.getenv("MONGO_CLIMA_COLLECTION_NAME", "clima")
+MONGO_LLM_CACHE_COLLECTION_NAME = os.getenv("MONGO_LLM_CACHE_COLLECTION_NAME", "llm_cache")
+# Vigencia de una respuesta cacheada del LLM (segundos)
+LLM_CACHE_TTL = 3600
 
 
 try:
-    mongo_client = MongoClient(MONGO_URI)
+    mongo_client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=50)
     mongo_db = mongo_client[MONGO_DB_NAME]
     analyzed_reports_collection = mongo_db[MONGO_COLLECTION_NAME]
     chat_history_collection = mongo_db[MONGO_CHAT_HISTORY_COLLECTION_NAME]
     centers_collection = mongo_db[MONGO_CENTERS_COLLECTION_NAME]
     alimentacion_collection = mongo_db[MONGO_ALIMENTACION_COLLECTION_NAME]
     clima_collection = mongo_db[MONGO_CLIMA_COLLECTION_NAME]
+    llm_cache_collection = mongo_db[MONGO_LLM_CACHE_COLLECTION_NAME]
     logger.info(f"Conexión a MongoDB exitosa. Base de datos: {MONGO_DB_NAME}, Colección de informes: {MONGO_COLLECTION_NAME}, Colección de historial de chat: {MONGO_CHAT_HISTORY_COLLECTION_NAME}, Colección de centros: {MONGO_CENTERS_COLLECTION_NAME}, Colección de alimentación: {MONGO_ALIMENTACION_COLLECTION_NAME}")
 except Exception as e:
     logger.error(f"Error al conectar con MongoDB: {e}")
 
+# Collation sin distinción de mayúsculas: permite búsquedas por prefijo que usan el índice
+CI_COLLATION = {"locale": "es", "strength": 2}
+
+def prefix_range(text: str) -> Dict[str, str]:
+    """Filtro de rango equivalente a '^text' que Mongo resuelve con un recorrido acotado del índice."""
+    return {"$gte": text, "$lt": text + "\uffff"}
+
+@router.on_event("startup")
+async def create_report_indexes():
+    """Índices para buscar los últimos informes de un centro sin ordenar en memoria."""
+    try:
+        await analyzed_reports_collection.create_index([("center_id", 1), ("report_date", -1)], background=True)
+        await analyzed_reports_collection.create_index([("center_id", 1), ("original_filename", 1)], background=True, collation=CI_COLLATION, name="center_filename_ci")
+        await alimentacion_collection.create_index([("Name", 1)], background=True, collation=CI_COLLATION, name="name_ci")
+        await llm_cache_collection.create_index("created_at", expireAfterSeconds=LLM_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"No se pudieron crear los índices de analyzed_reports: {e}")
+
+# Caché con expiración para catálogos que cambian poco (centros y valores distinct de Mongo).
+# El lock por clave hace que, al expirar, solo una petición recargue y las demás esperen ese valor.
+CATALOG_CACHE_TTL = 60
+_catalog_cache: Dict[str, tuple] = {}
+_catalog_locks: Dict[str, asyncio.Lock] = {}
+
+async def cached_catalog(key: str, loader):
+    entry = _catalog_cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    lock = _catalog_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        entry = _catalog_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        value = await loader()
+        _catalog_cache[key] = (time.monotonic() + CATALOG_CACHE_TTL, value)
+        return value
+
+async def get_all_centers(db: Session) -> List[Dict[str, Any]]:
+    def load():
+        return [
+            {"id": c.id, "nombre": c.name, "codigo": c.code, "latitud": c.latitude, "longitud": c.longitude}
+            for c in db.query(Center).all()
+        ]
+    # La sesión es síncrona: la consulta corre en el threadpool para no bloquear el event loop
+    return await cached_catalog("all_centers", lambda: run_in_threadpool(load))
+
+async def get_alimentacion_centros() -> List[Any]:
+    return await cached_catalog("alimentacion_centros", lambda: alimentacion_collection.distinct("Name"))
+
+async def get_clima_codigos() -> List[Any]:
+    return await cached_catalog("clima_codigos", lambda: clima_collection.distinct("codigo_centro"))
+
+@router.post("/cache/invalidate/")
+async def invalidate_catalog_cache(current_user: User = Depends(has_permission("gestionar_configuracion"))):
+    """Vacía la caché de catálogos (centros y distinct de Mongo) para forzar su recarga."""
+    _catalog_cache.clear()
+    _clima_centros_cache.clear()
+    return {"message": "Caché de catálogos invalidada."}
+
+class BatchLoader:
+    """
+    Agrupa las cargas por clave que llegan casi al mismo tiempo (dentro de `delay` segundos)
+    en una sola llamada a `fetch_many(claves) -> {clave: resultado}`, y reparte los resultados.
+    """
+    def __init__(self, fetch_many, delay: float = 0.003, default=None):
+        self.fetch_many = fetch_many
+        self.delay = delay
+        self.default = default
+        self.pending: Dict[Any, List[asyncio.Future]] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def load(self, key) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(key, []).append(future)
+        if self.timer is None:
+            self.timer = loop.call_later(self.delay, lambda: asyncio.ensure_future(self.flush()))
+        return future
+
+    async def flush(self):
+        batch, self.pending, self.timer = self.pending, {}, None
+        try:
+            results = await self.fetch_many(list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(key, self.default))
+
+async def fetch_report_summaries(center_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """Metadatos de hasta 5 informes por centro, para varios centros en una sola consulta."""
+    pipeline = [
+        {"$match": {"center_id": {"$in": center_ids}}},
+        {"$project": {"_id": 0, "center_id": 1, "report_type": 1, "original_filename": 1, "extracted_at": 1, "report_date": 1}},
+        {"$group": {"_id": "$center_id", "docs": {"$firstN": {"input": "$$ROOT", "n": 5}}}}
+    ]
+    rows = await analyzed_reports_collection.aggregate(pipeline).to_list(length=None)
+    result = {}
+    for row in rows:
+        for doc in row["docs"]:
+            doc.pop("center_id", None)
+        result[row["_id"]] = row["docs"]
+    return result
+
+report_summaries_loader = BatchLoader(fetch_report_summaries, default=[])
+
+# Bloque ```json ... ``` con el gráfico dentro de la respuesta del modelo
+_CHART_RE = re.compile(r'```json\s*(\{[\s\S]*?\})\s*```')
+
+# Preguntas que dependen del momento actual: su respuesta no se cachea
+_NO_CACHE_PATTERN = re.compile(r"\b(hoy|ahora|[úu]ltim[oa]s?|actual(?:mente)?)\b")
+
+async def llm_cache_key(question: str, center_id: int, period, informe_filename: Optional[str] = None) -> Optional[str]:
+    """
+    Clave de caché de la respuesta: sha256 de la pregunta, el centro, el informe pedido y una huella de los datos
+    (fecha del último informe, periodo detectado y tamaño de las colecciones de alimentación y clima).
+    Devuelve None si la pregunta es sensible al tiempo.
+    """
+    if _NO_CACHE_PATTERN.search(question.lower()):
+        return None
+    latest_report, alimentacion_count, clima_count = await asyncio.gather(
+        analyzed_reports_collection.find_one({"center_id": center_id}, {"report_date": 1, "_id": 0}, sort=[("report_date", -1)]),
+        alimentacion_collection.estimated_document_count(),
+        clima_collection.estimated_document_count(),
+    )
+    fingerprint = {
+        "report_date": (latest_report or {}).get("report_date"),
+        "period": period,
+        "alimentacion": alimentacion_count,
+        "clima": clima_count,
+    }
+    payload = json.dumps({"q": question.strip().lower(), "c": center_id, "f": informe_filename, "ctx": fingerprint}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def synthesize_audio(text: str) -> Optional[str]:
+    """Sintetiza la respuesta a mp3 y la devuelve en base64 (None si falla)."""
+    try:
+        audio_response = tts_client.audio.speech.create(
+            input=text,
+            model=settings.azure_openai_tts_deployment,
+            voice="onyx",
+            response_format="mp3"
+        )
+        return base64.b64encode(audio_response.content).decode("utf-8")
+    except Exception as tts_e:
+        logger.error(f"Error al sintetizar audio para la respuesta: {tts_e}")
+        return None
+
 class QuestionRequest(BaseModel):
     user_question: str
     center_id: int
@@ -73,48 +236,209 @@ class QuestionRequest(BaseModel):
 # --- ELIMINADO: Detección manual de preguntas simples ---
 # Ahora la IA determina automáticamente qué tipo de pregunta es
 
+# Palabras clave y patrones de clasificación, compilados una sola vez al cargar el módulo
+_ALI_KEYWORDS = frozenset({"alimentacion", "alimento", "pez", "peces", "jaula", "biomasa", "mot", "dieta", "feed", "silo", "doser", "peso"})
+_CLIMA_KEYWORDS = frozenset({"clima", "temperatura", "oxígeno", "presión", "humedad", "radiación", "viento", "atmósfera", "meteorología", "climatología"})
+_LIST_PATTERNS = tuple(re.compile(p) for p in (
+    r"para que centros hay datos de alimentaci[óo]n",
+    r"centros.*alimentaci[óo]n",
+    r"alimentaci[óo]n.*centros",
+    r"centros.*tienen.*alimentaci[óo]n",
+    r"alimentaci[óo]n.*disponible.*centros"
+))
+# Un solo patrón con todas las palabras clave: el lookahead permite coincidencias solapadas,
+# así una pasada sobre la pregunta detecta todas las categorías presentes
+_CATEGORY_PATTERN = re.compile("(?=(?:{}|{}))".format(
+    "(?P<alimentacion>" + "|".join(map(re.escape, sorted(_ALI_KEYWORDS, key=len, reverse=True))) + ")",
+    "(?P<clima>" + "|".join(map(re.escape, sorted(_CLIMA_KEYWORDS, key=len, reverse=True))) + ")",
+))
+_YEAR_PATTERN = re.compile(r"(20\d{2})")
+_MESES = ("enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre")
+# Estaciones del hemisferio sur: (inicio (mes, día), fin (mes, día), el fin cae el año siguiente)
+_SEASONS = (
+    ("verano", (12, 21), (3, 20), True),
+    ("invierno", (6, 21), (9, 22), False),
+    ("primavera", (9, 23), (12, 20), False),
+    ("otoño", (3, 21), (6, 20), False),
+)
+
+# Enrutamiento local de la intención de informes (reemplaza la llamada de function calling
+# cuando la pregunta es clara). Si no hay señales suficientes se consulta al LLM.
+_REPORT_WORD_PATTERN = re.compile(r"\binformes?\b")
+_REPORT_DETAIL_PATTERN = re.compile(r"\b(ph|redox|materia org[áa]nica|sedimentos?|contaminantes?|conclusi[óo]n(es)?|informe detallado|an[áa]lisis (detallado|completo|t[ée]cnico))\b")
+_REPORT_TREND_PATTERN = re.compile(r"\b(compar\w*|tendencias?|evoluci[óo]n)\b")
+_REPORT_COUNT_PATTERN = re.compile(r"[úu]ltimos?\s+(\d+|dos|tres|cuatro|cinco)\s+informes")
+_REPORT_FILENAME_PATTERN = re.compile(r"(anexo\s+\d+[\w\-. ]*?\.pdf|anexo\s+\d+|[\w\-.]+\.pdf)")
+_NUMBER_WORDS = {"dos": 2, "tres": 3, "cuatro": 4, "cinco": 5}
+
+def route_report_intent(question: str, center_id: int):
+    """
+    Decide sin LLM si la pregunta necesita el análisis completo de informes.
+    Devuelve ("detailed", argumentos), ("summary", None) o (None, None) si no hay certeza.
+    """
+    q = question.lower()
+    args: Dict[str, Any] = {"center_id": center_id}
+    count_match = _REPORT_COUNT_PATTERN.search(q)
+    if count_match:
+        value = count_match.group(1)
+        args["num_reports"] = int(value) if value.isdigit() else _NUMBER_WORDS[value]
+    filename_match = _REPORT_FILENAME_PATTERN.search(q)
+    if filename_match:
+        args["informe_filename"] = filename_match.group(1).strip()
+
+    mentions_report = bool(_REPORT_WORD_PATTERN.search(q))
+    if count_match or filename_match or _REPORT_DETAIL_PATTERN.search(q) or (mentions_report and _REPORT_TREND_PATTERN.search(q)):
+        return "detailed", args
+    if not mentions_report:
+        return "summary", None
+    return None, None
+
+# Recorte del contexto: el catálogo de centros y los registros de ejemplo solo se envían al
+# modelo cuando la pregunta los necesita, y cada análisis detallado se limita en tamaño
+_CATALOG_PATTERN = re.compile(r"\b(centros|todos|cu[áa]les|lista\w*|compar\w*|otros?)\b")
+_EXAMPLES_PATTERN = re.compile(r"\b(ejemplos?|registros?|muestras?|detalles?)\b")
+MAX_ANALYSIS_CHARS = 8000
+_CATALOG_KEYS = ("todos_los_centros_disponibles", "centros_con_alimentacion", "centros_con_clima")
+
+def select_context(question: str, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Devuelve una copia de `ctx` con solo lo que la pregunta necesita."""
+    q = question.lower()
+    current_center = ctx["centro_actual_seleccionado"]["nombre"].lower()
+    mentions_other_center = any(
+        c["nombre"] and c["nombre"].lower() in q and c["nombre"].lower() != current_center
+        for c in ctx.get("todos_los_centros_disponibles", [])
+    )
+    wants_catalog = mentions_other_center or bool(_CATALOG_PATTERN.search(q)) or is_list_alimentacion_centros_question(question)
+    wants_examples = bool(_EXAMPLES_PATTERN.search(q))
+
+    slim = {}
+    for key, value in ctx.items():
+        if key in _CATALOG_KEYS and not wants_catalog:
+            continue
+        if key in ("resumen_alimentacion_centro_actual", "resumen_clima_centro_actual") and isinstance(value, dict) and not wants_examples:
+            value = {k: v for k, v in value.items() if k != "ejemplo_registros"}
+        if key == "informes_ambientales_detallados":
+            value = [{**report, "analysis": _truncate_analysis(report["analysis"])} for report in value]
+        slim[key] = value
+    return slim
+
+def _truncate_analysis(analysis: Any) -> Any:
+    """Limita el análisis de un informe a MAX_ANALYSIS_CHARS caracteres (serializado si no es texto)."""
+    text = analysis if isinstance(analysis, str) else json.dumps(analysis, separators=(",", ":"), ensure_ascii=False, default=str)
+    if len(text) <= MAX_ANALYSIS_CHARS:
+        return analysis
+    return text[:MAX_ANALYSIS_CHARS] + " …[recortado]"
+
+# full_analysis es el JSON libre que extrae el LLM del PDF, sin esquema fijo: en vez de rutas
+# con punto se filtran en el servidor sus claves de primer nivel según lo que pide la pregunta.
+# Cada entrada es (patrón sobre la pregunta, patrón sobre los nombres de clave).
+_ANALYSIS_SECTIONS = (
+    (re.compile(r"\b(ph|redox)\b"), r"ph|redox|potencial|par[áa]metro|medici[óo]n|resultado|fisico|qu[íi]mic"),
+    (re.compile(r"\b(materia org[áa]nica|sedimentos?|granulometr[íi]a)\b"), r"materia|org[áa]nic|sediment|granulometr|resultado"),
+    (re.compile(r"\b(conclusi[óo]n(es)?|recomendaci[óo]n(es)?)\b"), r"conclusi|recomendaci|resumen|hallazgo"),
+    (re.compile(r"\b(estaci[óo]n(es)?|coordenadas?|ubicaci[óo]n)\b"), r"estaci|coordenad|ubicaci|punto"),
+)
+# Metadatos del informe que se conservan siempre que se filtra
+_ANALYSIS_BASE_KEYS = r"fecha|centro|informe"
+
+def analysis_key_pattern(question: str) -> Optional[str]:
+    """Patrón de claves de full_analysis relevantes para la pregunta, o None si se necesita completo."""
+    q = question.lower()
+    patterns = [keys for question_pattern, keys in _ANALYSIS_SECTIONS if question_pattern.search(q)]
+    if not patterns:
+        return None
+    return "|".join([_ANALYSIS_BASE_KEYS] + patterns)
+
+async def find_detailed_reports(query_filter: Dict[str, Any], num_reports: int, key_pattern: Optional[str], collation=None) -> List[Dict[str, Any]]:
+    """
+    Los `num_reports` informes más recientes que cumplen `query_filter`. Con `key_pattern`, de
+    full_analysis solo viajan las claves que coinciden; si ninguna coincide (o no es un objeto)
+    se devuelve completo.
+    """
+    analysis = "$full_analysis"
+    if key_pattern:
+        filtered = {"$arrayToObject": {"$filter": {
+            "input": {"$objectToArray": "$full_analysis"},
+            "as": "kv",
+            "cond": {"$regexMatch": {"input": "$$kv.k", "regex": key_pattern, "options": "i"}}
+        }}}
+        analysis = {"$cond": [
+            {"$ne": [{"$type": "$full_analysis"}, "object"]},
+            "$full_analysis",
+            {"$let": {"vars": {"f": filtered}, "in": {"$cond": [{"$eq": ["$$f", {}]}, "$full_analysis", "$$f"]}}}
+        ]}
+    pipeline = [
+        {"$match": query_filter},
+        {"$sort": {"report_date": -1}},
+        {"$limit": num_reports},
+        {"$project": {"_id": 0, "report_date": 1, "original_filename": 1, "full_analysis": analysis}},
+    ]
+    options = {"collation": collation} if collation else {}
+    return await analyzed_reports_collection.aggregate(pipeline, **options).to_list(length=num_reports)
+
+def question_categories(question: str) -> set:
+    """Devuelve las categorías ('alimentacion', 'clima') cuyas palabras clave aparecen en la pregunta."""
+    q = question.lower()
+    return {m.lastgroup for m in _CATEGORY_PATTERN.finditer(q)}
+
 def needs_alimentacion_context(question: str) -> bool:
     # Palabras clave para decidir si incluir datos de alimentación
-    keywords = ["alimentacion", "alimento", "pez", "peces", "jaula", "biomasa", "MOT", "dieta", "feed", "silo", "doser", "peso"]
-    q = question.lower()
-    return any(k in q for k in keywords)
+    return "alimentacion" in question_categories(question)
 def needs_clima_context(question: str) -> bool:
-    keywords = ["clima", "temperatura", "oxígeno", "presión", "humedad", "radiación", "viento", "atmósfera", "meteorología", "climatología"]
-    q = question.lower()
-    return any(k in q for k in keywords)
+    return "clima" in question_categories(question)
 
 
 def is_list_alimentacion_centros_question(question: str) -> bool:
     # Detectar preguntas como '¿para qué centros hay datos de alimentación?' o similares
-    patterns = [
-        r"para que centros hay datos de alimentaci[óo]n",
-        r"centros.*alimentaci[óo]n",
-        r"alimentaci[óo]n.*centros",
-        r"centros.*tienen.*alimentaci[óo]n",
-        r"alimentaci[óo]n.*disponible.*centros"
-    ]
     q = question.lower()
-    return any(re.search(p, q) for p in patterns)
+    return any(p.search(q) for p in _LIST_PATTERNS)
+
+# Preguntas de listado que se responden solo con los catálogos, sin llamar al LLM
+_DIRECT_LIST_PATTERN = re.compile(
+    r"^\s*¿?\s*(?:(?:qu[ée]|cu[áa]les)\s+(?:son\s+)?|lista\w*\s+(?:de\s+)?)(?:los\s+)?"
+    r"(?:centros\b[^?]*?\b(?:(?P<alimentacion>alimentaci[óo]n)|(?P<clima>clim[aá]\w*))\b|(?P<informes>informes)\b)"
+    r"[^?]*\??\s*$"
+)
+# Palabras comparativas o analíticas: la pregunta necesita al LLM aunque empiece como un listado
+_ANALYTIC_WORDS_PATTERN = re.compile(r"\b(?:peor\w*|mejor\w*|m[áa]s|menos|dicen?|sobre|destac\w*|compar\w*|\d{4})\b")
+
+async def direct_answer(request: QuestionRequest, db: Session) -> Optional[str]:
+    """
+    Respuesta con plantilla para preguntas de listado (centros con alimentación, centros con
+    clima, informes del centro). Devuelve None si la pregunta necesita al LLM.
+    """
+    q = request.user_question.lower()
+    match = _DIRECT_LIST_PATTERN.search(q)
+    if not match or _ANALYTIC_WORDS_PATTERN.search(q):
+        return None
+    if match.group("alimentacion"):
+        centros = [str(c) for c in await get_alimentacion_centros() if c]
+        return f"Centros con datos de alimentación: {', '.join(sorted(centros))}." if centros else "No hay centros con datos de alimentación."
+    if match.group("clima"):
+        clima_centros = await run_in_threadpool(get_clima_centros, db, await get_clima_codigos())
+        nombres = sorted(c["nombre"] for c in clima_centros if c["nombre"])
+        return f"Centros con datos climáticos: {', '.join(nombres)}." if nombres else "No hay centros con datos climáticos."
+    # Si la pregunta pide datos de los informes (pH, tendencias, últimos N) no es un simple listado
+    if _REPORT_DETAIL_PATTERN.search(q) or _REPORT_TREND_PATTERN.search(q) or _REPORT_COUNT_PATTERN.search(q):
+        return None
+    informes = await report_summaries_loader.load(request.center_id)
+    if not informes:
+        return "No hay informes ambientales disponibles para este centro."
+    lineas = [f"- {doc.get('original_filename')} ({doc.get('report_date') or 'sin fecha'})" for doc in informes]
+    return "Informes ambientales disponibles para este centro:\n" + "\n".join(lineas)
 
 def detect_period_from_question(question: str):
     """
     Detecta un periodo temporal en la pregunta y retorna un filtro de fechas (start, end) o None.
     Soporta: verano, invierno, primavera, otoño, año, mes, semana, hoy, ayer, etc.
     """
-    import re
-    from datetime import datetime, timedelta
     q = question.lower()
     now = datetime.utcnow()
     year = now.year
-    # Mapas de estaciones (hemisferio sur)
-    seasons = {
-        "verano": (datetime(year, 12, 21), datetime(year+1, 3, 20)),
-        "invierno": (datetime(year, 6, 21), datetime(year, 9, 22)),
-        "primavera": (datetime(year, 9, 23), datetime(year, 12, 20)),
-        "otoño": (datetime(year, 3, 21), datetime(year, 6, 20)),
-    }
-    for s, (start, end) in seasons.items():
+    for s, (start_m, start_d), (end_m, end_d), crosses_year in _SEASONS:
         if s in q:
+            start = datetime(year, start_m, start_d)
+            end = datetime(year + 1 if crosses_year else year, end_m, end_d)
             # Si estamos fuera de la estación, ajustar año
             if start > end:
                 if now.month < 6:
@@ -123,13 +447,12 @@ def detect_period_from_question(question: str):
                     end = end.replace(year=year+1)
             return start, end
     # Año específico
-    m = re.search(r"(20\d{2})", q)
+    m = _YEAR_PATTERN.search(q)
     if m:
         y = int(m.group(1))
         return datetime(y, 1, 1), datetime(y, 12, 31, 23, 59, 59)
     # Mes específico
-    meses = ["enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
-    for i, mes in enumerate(meses, 1):
+    for i, mes in enumerate(_MESES, 1):
         if mes in q:
             return datetime(year, i, 1), datetime(year, i, calendar.monthrange(year, i)[1], 23, 59, 59)
     # Última semana
@@ -144,91 +467,133 @@ def detect_period_from_question(question: str):
         return ayer.replace(hour=0, minute=0, second=0, microsecond=0), ayer.replace(hour=23, minute=59, second=59, microsecond=999999)
     return None
 
-def aggregate_alimentacion(alimentacion_collection, center_name, period=None, limit=100):
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _numeric_stats_group(fields: List[str], prefix: str = "", include_sum: bool = True) -> Dict[str, Any]:
+    """
+    Arma un $group que calcula promedio, suma, min, max y conteo de cada campo numérico.
+    Los valores no numéricos se ignoran, igual que al filtrar con isinstance en Python.
+    """
+    group = {"_id": None, "total_registros": {"$sum": 1}}
+    for i, field in enumerate(fields):
+        ref = f"${prefix}{field}"
+        numeric = {"$cond": [{"$isNumber": ref}, ref, None]}
+        group[f"f{i}_avg"] = {"$avg": numeric}
+        if include_sum:
+            group[f"f{i}_sum"] = {"$sum": numeric}
+        group[f"f{i}_min"] = {"$min": numeric}
+        group[f"f{i}_max"] = {"$max": numeric}
+        group[f"f{i}_count"] = {"$sum": {"$cond": [{"$isNumber": ref}, 1, 0]}}
+    return group
+
+def _numeric_stats_from_group(fields: List[str], stats: Dict[str, Any], include_sum: bool = True) -> Dict[str, Any]:
+    """Convierte el documento del $group al formato de resumen por campo."""
+    resumen = {}
+    for i, field in enumerate(fields):
+        if not stats.get(f"f{i}_count"):
+            continue
+        resumen[field] = {"promedio": stats[f"f{i}_avg"]}
+        if include_sum:
+            resumen[field]["suma"] = stats[f"f{i}_sum"]
+        resumen[field].update({"min": stats[f"f{i}_min"], "max": stats[f"f{i}_max"], "count": stats[f"f{i}_count"]})
+    return resumen
+
+async def aggregate_alimentacion(alimentacion_collection, center_name, period=None, limit=100):
     """
     Búsqueda flexible: busca todos los registros donde 'Name' contenga el nombre del centro (case-insensitive).
     Si period es (start, end), filtra por ese rango. Si no, usa los últimos N registros.
     Devuelve agregados: promedio, suma, min, max, count para cada campo numérico relevante.
     Además, incluye una muestra de hasta 5 registros representativos (los más recientes).
+    Las estadísticas se calculan en Mongo con $group; solo viajan el resumen y la muestra.
     """
     if not center_name:
         return {"resumen": "No se especificó centro para la búsqueda de alimentación."}
-    regex = re.compile(re.escape(center_name), re.IGNORECASE)
-    match = {"Name": {"$regex": regex}}
+    date_match = {}
+    max_docs = limit
     if period:
         start, end = period
-        match["FechaHora"] = {"$gte": start, "$lte": end}
-        pipeline = [
-            {"$match": match},
-            {"$sort": {"FechaHora": -1}},
-            {"$limit": 10000}
-        ]
-        docs = list(alimentacion_collection.aggregate(pipeline))
-    else:
-        docs = list(alimentacion_collection.find(match).sort("FechaHora", -1).limit(limit))
-    for doc in docs:
-        doc.pop("_id", None)
-    if not docs:
+        date_match["FechaHora"] = {"$gte": start, "$lte": end}
+        max_docs = 10000
+
+    # Primero por prefijo sobre el índice con collation; si no hay resultados, como substring
+    match = {"Name": prefix_range(center_name), **date_match}
+    aggregate_options = {"collation": CI_COLLATION}
+    samples = await alimentacion_collection.find(match, {"_id": 0}).sort("FechaHora", -1).limit(5).collation(CI_COLLATION).to_list(length=5)
+    if not samples:
+        match = {"Name": {"$regex": re.compile(re.escape(center_name), re.IGNORECASE)}, **date_match}
+        aggregate_options = {}
+        samples = await alimentacion_collection.find(match, {"_id": 0}).sort("FechaHora", -1).limit(5).to_list(length=5)
+    if not samples:
         return {"resumen": "No hay datos de alimentación para el periodo/centro consultado."}
-    numeric_fields = [k for k, v in docs[0].items() if isinstance(v, (int, float))]
-    resumen = {}
-    for field in numeric_fields:
-        values = [d[field] for d in docs if isinstance(d.get(field), (int, float))]
-        if not values:
-            continue
-        resumen[field] = {
-            "promedio": sum(values)/len(values),
-            "suma": sum(values),
-            "min": min(values),
-            "max": max(values),
-            "count": len(values)
-        }
-    resumen["total_registros"] = len(docs)
-    resumen["ejemplo_registros"] = docs[:5]
+    numeric_fields = [k for k, v in samples[0].items() if _is_number(v)]
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"FechaHora": -1}},
+        {"$limit": max_docs},
+        {"$group": _numeric_stats_group(numeric_fields)}
+    ]
+    stats = (await alimentacion_collection.aggregate(pipeline, **aggregate_options).to_list(length=1))[0]
+    resumen = _numeric_stats_from_group(numeric_fields, stats)
+    resumen["total_registros"] = stats["total_registros"]
+    resumen["ejemplo_registros"] = samples
     return resumen
-def aggregate_clima(clima_collection, codigo_centro, period=None, limit=100):
+
+async def aggregate_clima(clima_collection, codigo_centro, period=None, limit=100):
     """
     Agrega datos climáticos para un centro específico por código y periodo (si se indica).
     Devuelve promedios, min, max, count y una muestra representativa.
+    Las estadísticas se calculan en Mongo con $group; solo viajan el resumen y la muestra.
     """
     if not codigo_centro:
         return {"resumen": "No se especificó código de centro para la búsqueda de clima."}
 
     match = {"codigo_centro": codigo_centro}
-
+    max_docs = limit
     if period:
         start, end = period
         match["fecha"] = {"$gte": start, "$lte": end}
-        docs = list(clima_collection.find(match).sort("fecha", -1).limit(10000))
-    else:
-        docs = list(clima_collection.find(match).sort("fecha", -1).limit(limit))
-
-    for doc in docs:
-        doc.pop("_id", None)
-        doc["fecha"] = str(doc["fecha"])
+        max_docs = 10000
 
-    if not docs:
+    samples = await clima_collection.find(match, {"_id": 0, "datos": 1}).sort("fecha", -1).limit(5).to_list(length=5)
+    datos_muestra = [d["datos"] for d in samples if "datos" in d]
+    if not samples:
         return {"resumen": "No hay datos de clima disponibles para el periodo/centro."}
+    numeric_fields = [k for k, v in datos_muestra[0].items() if _is_number(v)] if datos_muestra else []
 
-    datos_climaticos = [d["datos"] for d in docs if "datos" in d]
-    numeric_fields = [k for k, v in datos_climaticos[0].items() if isinstance(v, (int, float))]
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"fecha": -1}},
+        {"$limit": max_docs},
+        {"$match": {"datos": {"$exists": True}}},
+        {"$group": _numeric_stats_group(numeric_fields, prefix="datos.", include_sum=False)}
+    ]
+    result = await clima_collection.aggregate(pipeline).to_list(length=1)
+    stats = result[0] if result else {"total_registros": 0}
+    resumen = _numeric_stats_from_group(numeric_fields, stats, include_sum=False)
+    resumen["total_registros"] = stats["total_registros"]
+    resumen["ejemplo_registros"] = datos_muestra
+    return resumen
 
-    resumen = {}
-    for field in numeric_fields:
-        values = [d[field] for d in datos_climaticos if isinstance(d.get(field), (int, float))]
-        if not values:
-            continue
-        resumen[field] = {
-            "promedio": sum(values)/len(values),
-            "min": min(values),
-            "max": max(values),
-            "count": len(values)
-        }
 
-    resumen["total_registros"] = len(datos_climaticos)
-    resumen["ejemplo_registros"] = datos_climaticos[:5]
-    return resumen
+# Centros con datos de clima: una sola entrada (vence, códigos, centros) con el mismo TTL que
+# cached_catalog, así la caché no crece con cada conjunto de códigos distinto
+_clima_centros_cache: Dict[str, tuple] = {}
 
+def get_clima_centros(db: Session, clima_codigos: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Resuelve los códigos de la colección clima a centros de MySQL con una sola consulta IN.
+    El resultado se cachea por proceso mientras no cambie el conjunto de códigos ni venza el TTL.
+    """
+    codes = tuple(sorted({str(c) for c in clima_codigos}))
+    entry = _clima_centros_cache.get("clima_centros")
+    if entry and entry[0] > time.monotonic() and entry[1] == codes:
+        return entry[2]
+    rows = db.query(Center.id, Center.name, Center.code).filter(Center.code.in_(codes)).all() if codes else []
+    centros = [{"id": r.id, "nombre": r.name, "codigo": r.code} for r in rows]
+    _clima_centros_cache["clima_centros"] = (time.monotonic() + CATALOG_CACHE_TTL, codes, centros)
+    return centros
 
 # --- DEFINICIÓN DE HERRAMIENTA PARA EL LLM (Function Calling) ---
 # Esto debe ir en la parte superior de tu archivo, fuera de cualquier función.
@@ -258,69 +623,180 @@ GET_FULL_ANALYSIS_TOOL = {
     }
 }
 
-# --- MODIFICADO: Agregar db: Session = Depends(get_db) ---
-@router.post("/analyze-question/")
-async def analyze_question(request: QuestionRequest, db: Session = Depends(get_db)):
-    try:
-        user_question_lower = request.user_question.lower()
-        logger.info(f"Pregunta recibida: '{user_question_lower}' para centro ID: {request.center_id}")
+# Parte fija del prompt de respuesta. No lleva interpolaciones: al ser idéntica en todas las
+# peticiones, Azure OpenAI reutiliza su prefijo cacheado y solo procesa el contexto que va detrás
+_SYSTEM_PREFIX = """
+Eres un asistente de inteligencia artificial especializado en análisis ambiental y operacional de centros de cultivo de salmones en Chile. Tu objetivo es interpretar preguntas humanas de forma contextual, identificar la intención de la solicitud, y entregar una respuesta clara, útil y fundamentada basada en los datos disponibles.
 
-        # --- Preparar contexto básico e inicial (se mantiene igual) ---
-        center = db.query(Center).filter(Center.id == request.center_id).first()
-        center_name = center.name if center else "desconocido"
-        
-        all_centers = db.query(Center).all()
-        all_centers_data = [
-            {"id": c.id, "nombre": c.name, "codigo": c.code, "latitud": c.latitude, "longitud": c.longitude}
-            for c in all_centers
-        ]
+**PRIORIDAD: Sé conciso y utiliza solo la información estrictamente necesaria del contexto proporcionado para responder a la pregunta. Evita la verbosidad y la inclusión de detalles no solicitados explícitamente. Apunta a la eficiencia en el uso de tokens.**
 
-        unified_context: Dict[str, Any] = {
-            "centro_actual_seleccionado": {"id": request.center_id, "nombre": center_name},
-            "todos_los_centros_disponibles": all_centers_data,
-        }
+### 🧠 CONTEXTO OPERATIVO DISPONIBLE
 
-        # --- Flujo unificado: Dejar que la IA determine qué tipo de pregunta es y responda apropiadamente ---
-        
-        # --- NUEVO BLOQUE: FASE 1 - La IA decide si necesita datos pesados (Function Calling) ---
-        messages_for_llm_tool_check = [
-            {"role": "system", "content": f"""
+Tienes acceso a múltiples bases de datos relacionadas a centros de cultivo, cada una con información distinta. No todos los centros están presentes en todas las bases.
+
+- **`todos_los_centros_disponibles` (MySQL)**: Catálogo oficial de centros (ID, nombre, código, latitud, longitud).
+- **`centro_actual_seleccionado`**: Información del centro que se está consultando.
+
+- **INFORMES AMBIENTALES (analyzed_reports)**: Estudios técnicos del fondo marino que pueden incluir materia orgánica, algas en sedimentos, pH, redox, profundidad, etc.
+    - **`informes_ambientales_detallados`**: **Si está presente**, esta es una **lista de objetos JSON**, donde cada objeto contiene el `filename`, `report_date` y el `analysis` completo de un informe ambiental. **Úsala para responder preguntas detalladas, extraer valores específicos o realizar comparaciones y tendencias entre múltiples informes.**
+    - **`informes_resumidos_disponibles`**: Si **`informes_ambientales_detallados` NO está presente** y la pregunta no es específica, este campo contendrá metadatos básicos (tipo, nombre de archivo, fecha de extracción/informe) de informes ambientales disponibles. Úsalo para preguntas generales como "¿qué informes hay?" o listar informes.
+    - **`nombres_de_informes_disponibles_para_inferencia`**: **(Siempre presente si hay informes)** Lista de nombres de archivos recientes para el centro actual, para ayudar en la identificación.
+
+- **DATOS DE ALIMENTACIÓN (MongoDB)**:
+    - **`resumen_alimentacion_centro_actual`**: **Si está presente**, contiene estadísticas agregadas (promedio, suma, min, max) de datos de alimentación para el centro y periodo solicitado (ej. biomasa, consumo de alimento, temperatura del agua).
+    - **`centros_con_alimentacion`**: Lista los nombres de los centros que tienen datos de alimentación.
+- **DATOS CLIMÁTICOS (MongoDB)**:
+    - **`resumen_clima_centro_actual`**: Estadísticas agregadas de condiciones climáticas (temperatura, presión, viento, humedad, etc.) del centro, resumidas desde la base de datos `clima`. Se generan solo si la pregunta lo requiere.
+    - **`centros_con_clima`**: Lista de centros (id, nombre, código) que tienen registros en la base `clima`.
+
+Los centros pueden tener nombres distintos en cada base. Por ello, debes hacer *matching inteligente* entre nombres y coordenadas cuando sea necesario.
+
+---
+
+### 🧭 INSTRUCCIONES DINÁMICAS (RAZONAMIENTO FLEXIBLE)
+
+- **Responde Directamente**: Utiliza el contexto proporcionado para responder de manera clara y directa.
+- **Detalle vs. Resumen**: Prioriza la información detallada si `informes_ambientales_detallados` o `resumen_alimentacion_centro_actual` están disponibles. Si no, usa los resúmenes o datos básicos.
+- **Gráficos y Comparaciones**:
+    - Si el usuario solicita un gráfico o una comparación ("gráfico", "comparación", "tendencia", "evolución", "últimos X informes"), busca los datos relevantes dentro de la **lista `informes_ambientales_detallados`**.
+    - Si `informes_ambientales_detallados` contiene **múltiples informes**, extrae las series de datos (ej. pH, redox) de cada informe, utilizando su `report_date` o `filename` para diferenciarlos en el gráfico.
+    - Si encuentras los datos adecuados, genera un bloque JSON para visualización. Asegúrate de que los nombres de los campos en el JSON del gráfico (`xAxis`, `series.name`, `series.data`) sean consistentes con lo que tu frontend espera. Para comparaciones, cada serie podría representar un informe diferente o un valor a lo largo del tiempo/informes.
+
+- **Gráficos y Comparaciones**:
+    - Si el usuario solicita un gráfico o una comparación ("gráfico", "comparación", "visualizar", "evolución", "hazme un gráfico", "crea un gráfico"), y tienes los datos relevantes en el contexto `informes_ambientales_detallados` o `resumen_alimentacion_centro_actual`:
+        - **Tu objetivo principal es generar un bloque JSON con el gráfico solicitado.**
+        - **Para gráficos generales de parámetros como pH o Redox (cuando no se especifica 'por estación'):**
+            - **Usa los valores representativos o promedios del informe, no los datos detallados por estación.**
+            - Si hay un solo informe, el `xAxis` puede ser la fecha del informe o un nombre descriptivo (ej. "Informe [Fecha]"). El `series.data` contendrá ese único valor.
+            - Si hay varios informes, usa las fechas de los informes como `xAxis`. La serie de datos (`series.data`) debe contener los valores correspondientes extraídos para cada informe.
+        - Si el usuario pide explícitamente datos "por estación" o "por punto de muestreo" (ej. "gráfico de pH por estación"), entonces usa esos datos para el gráfico, con las estaciones como `xAxis`.
+        - Siempre genera el JSON del gráfico si los datos son adecuados para ello. Si no hay datos suficientes o el formato no es adecuado, informa al usuario.
+
+Ejemplo de formato JSON para gráfico (adaptado para múltiples informes):
+```json
+{
+    "chart": {
+    "type": "line",
+    "title": "Comparación de pH y Redox - Centro Pirquen",
+    "xAxis": ["Informe Marzo 2023", "Informe Julio 2023"], // O las fechas o nombres de archivo para cada informe
+    "series": [
+     { "name": "pH (Informe Marzo)", "data": [7.3, 7.4] }, // Ajusta las series para diferenciar por informe
+     { "name": "Redox (Informe Julio)", "data": [170, 175] }
+    ]
+ }
+}
+```
+
+"""
+
+async def build_answer_prompt(request: QuestionRequest, db: Session):
+    """
+    Reúne el contexto (centros, informes, alimentación, clima) y arma el prompt de la respuesta.
+    Devuelve (prompt, clave de caché, respuesta cacheada); si hay respuesta cacheada el prompt es None.
+    Las preguntas de listado se responden con plantilla y vuelven como respuesta cacheada sin clave.
+    """
+    user_question_lower = request.user_question.lower()
+    logger.info(f"Pregunta recibida: '{user_question_lower}' para centro ID: {request.center_id}")
+
+    direct = await direct_answer(request, db)
+    if direct:
+        logger.info("Pregunta de listado respondida con plantilla, sin llamar al LLM.")
+        return None, None, {"ai_answer": direct, "chart_data": None}
+
+    # --- Preparar contexto básico e inicial (se mantiene igual) ---
+    # Las consultas SQL usan la sesión síncrona, así que se ejecutan en el threadpool
+    center = await run_in_threadpool(lambda: db.query(Center).filter(Center.id == request.center_id).first())
+    center_name = center.name if center else "desconocido"
+    
+    all_centers_data = await get_all_centers(db)
+
+    unified_context: Dict[str, Any] = {
+        "centro_actual_seleccionado": {"id": request.center_id, "nombre": center_name},
+        "todos_los_centros_disponibles": all_centers_data,
+    }
+
+    # --- Caché de respuestas: misma pregunta, mismo centro y mismos datos => misma respuesta ---
+    period = detect_period_from_question(request.user_question)
+    cache_key = await llm_cache_key(request.user_question, request.center_id, period, request.informe_filename)
+    if cache_key:
+        cached = await llm_cache_collection.find_one({"_id": cache_key})
+        if cached:
+            logger.info("Respuesta encontrada en la caché del LLM.")
+            return None, cache_key, cached
+
+    # --- Flujo unificado: Dejar que la IA determine qué tipo de pregunta es y responda apropiadamente ---
+    
+    # --- NUEVO BLOQUE: FASE 1 - La IA decide si necesita datos pesados (Function Calling) ---
+    messages_for_llm_tool_check = [
+        {"role": "system", "content": f"""
             Eres un asistente de IA cuya tarea es determinar qué información necesita el usuario para responder a su pregunta.
             Basado en la pregunta del usuario y el contexto operativo (información sobre centros, informes, datos de alimentación), decide si necesitas usar alguna de las funciones disponibles para obtener datos específicos de la base de datos.
             **No respondas a la pregunta directamente en esta fase; solo genera la llamada a la función si es necesaria.** Si la pregunta no requiere datos específicos de las herramientas disponibles, no llames a ninguna función y continúa a la siguiente fase sin añadir información pesada.
             El centro de interés actual es {center_name} (ID: {request.center_id}). Si el usuario menciona un nombre de archivo, prioriza ese para la función get_full_report_analysis.
             """},
-            {"role": "user", "content": request.user_question}
-        ]
+        {"role": "user", "content": request.user_question}
+    ]
 
+    local_route, local_args = route_report_intent(request.user_question, request.center_id)
+    first_llm_task = None
+    if local_route is None:
         logger.info("Iniciando primera llamada al LLM para detección de intención (Function Calling)...")
-        first_llm_response = client.chat.completions.create(
+        first_llm_task = asyncio.create_task(client.chat.completions.create(
             model=settings.azure_openai_deployment,
             messages=messages_for_llm_tool_check,
             tools=[GET_FULL_ANALYSIS_TOOL],
             tool_choice="auto"
-        )
+        ))
+    else:
+        logger.info(f"Intención resuelta localmente sin LLM: '{local_route}'.")
 
-        tool_calls = first_llm_response.choices[0].message.tool_calls
-        
-        # --- Ejecución Condicional de la Herramienta (si el LLM la solicitó) ---
-        if tool_calls:
-            logger.info(f"LLM solicitó {len(tool_calls)} herramienta(s).")
-            # *** NOTA: Por ahora, tu código solo procesa la primera herramienta de la lista.
-            # *** Si el LLM realmente solicita 2 herramientas (como en tu log),
-            # *** deberías iterar sobre `tool_calls` para ejecutar cada una si es necesario.
-            # *** Por simplicidad y para resolver el problema actual, seguiremos con `tool_calls[0]`.
-            tool_call = tool_calls[0] 
-            function_name = tool_call.function.name
+    # Las consultas a Mongo no dependen de la respuesta del LLM: se lanzan en paralelo con ella
+    categories = question_categories(request.user_question)
+    alimentacion_task = None
+    if "alimentacion" in categories:
+        alimentacion_task = asyncio.create_task(aggregate_alimentacion(alimentacion_collection, center_name, period=period, limit=100))
+    clima_task = None
+    if "clima" in categories:
+        codigo_centro = center.code if center else None
+        if codigo_centro:
+            try:
+                codigo_centro = int(codigo_centro)
+            except:
+                codigo_centro = None
+        clima_task = asyncio.create_task(aggregate_clima(clima_collection, codigo_centro, period=period, limit=100))
 
-            if function_name == "get_full_report_analysis":
-                function_args = {}
+    # Si algo falla antes de esperar las tareas, se cancelan: la llamada al LLM no sigue corriendo
+    # sola ni quedan excepciones sin recuperar
+    tasks = [task for task in (first_llm_task, alimentacion_task, clima_task) if task]
+    try:
+        alimentacion_centros, clima_codigos = await asyncio.gather(
+            get_alimentacion_centros(),
+            get_clima_codigos(),
+        )
+
+        function_name, function_args = None, {}
+        if local_route == "detailed":
+            function_name, function_args = "get_full_report_analysis", local_args
+        elif first_llm_task:
+            first_llm_response = await first_llm_task
+            tool_calls = first_llm_response.choices[0].message.tool_calls
+            if tool_calls:
+                logger.info(f"LLM solicitó {len(tool_calls)} herramienta(s).")
+                # *** NOTA: Por ahora, tu código solo procesa la primera herramienta de la lista.
+                # *** Si el LLM realmente solicita 2 herramientas (como en tu log),
+                # *** deberías iterar sobre `tool_calls` para ejecutar cada una si es necesario.
+                # *** Por simplicidad y para resolver el problema actual, seguiremos con `tool_calls[0]`.
+                tool_call = tool_calls[0] 
+                function_name = tool_call.function.name
                 try:
                     function_args = json.loads(tool_call.function.arguments)
                 except json.JSONDecodeError:
                     logger.error(f"Error decodificando argumentos JSON para {function_name}: {tool_call.function.arguments}")
                     unified_context["error_tool_call"] = f"Error al decodificar argumentos para {function_name}."
 
+        # --- Ejecución Condicional de la Herramienta (resuelta localmente o solicitada por el LLM) ---
+        if function_name:
+            if function_name == "get_full_report_analysis":
                 target_center_id = function_args.get("center_id", request.center_id)
                 requested_filename = function_args.get("informe_filename") 
                 # --- AQUÍ EMPIEZAN LOS CAMBIOS DENTRO DE ESTE BLOQUE `if function_name == ...` ---
@@ -331,31 +807,29 @@ async def analyze_question(request: QuestionRequest, db: Session = Depends(get_d
 
                 if target_center_id:
                     query_filter = {"center_id": target_center_id}
-                    sort_criteria = [("report_date", -1)] 
+                    # Solo las secciones de full_analysis que la pregunta necesita (todas si no se detecta ninguna)
+                    key_pattern = analysis_key_pattern(request.user_question)
 
                     # 2. Lógica para buscar uno o múltiples informes (REEMPLAZA el bloque 'if requested_filename: ... else: ...' anterior)
                     if requested_filename:
                         logger.info(f"Buscando informe(s) para centro {target_center_id} con referencia: '{requested_filename}'.")
-                        regex_pattern = re.compile(re.escape(requested_filename), re.IGNORECASE)
-                        query_filter["original_filename"] = {"$regex": regex_pattern}
-                        
-                        # Usa find() y limit para buscar por nombre de archivo específico o patrón
-                        reports_cursor = analyzed_reports_collection.find(
-                            query_filter,
-                            {"full_analysis": 1, "report_date": 1, "original_filename": 1, "_id": 0} # Proyecta campos adicionales
-                        ).sort(sort_criteria).limit(num_reports) 
-                        
-                        found_reports_data = list(reports_cursor)
+
+                        # Primero por prefijo: rango sobre el índice con collation, sin distinguir mayúsculas
+                        found_reports_data = await find_detailed_reports(
+                            {**query_filter, "original_filename": prefix_range(requested_filename)},
+                            num_reports, key_pattern, collation=CI_COLLATION
+                        )
+
+                        if not found_reports_data:
+                            # Si la referencia no es un prefijo (ej. 'el informe de marzo'), se busca como substring
+                            regex_pattern = re.compile(re.escape(requested_filename), re.IGNORECASE)
+                            query_filter["original_filename"] = {"$regex": regex_pattern}
+                            found_reports_data = await find_detailed_reports(query_filter, num_reports, key_pattern)
                     else:
                         logger.info(f"No se especificó nombre de informe. Buscando los últimos {num_reports} informes para el centro {target_center_id}.")
-                        
-                        # Usa find() y limit para los N informes más recientes para el centro
-                        reports_cursor = analyzed_reports_collection.find(
-                            query_filter, 
-                            {"full_analysis": 1, "report_date": 1, "original_filename": 1, "_id": 0} # Proyecta campos adicionales
-                        ).sort(sort_criteria).limit(num_reports) 
-                        
-                        found_reports_data = list(reports_cursor)
+                    
+                        # Los N informes más recientes para el centro
+                        found_reports_data = await find_detailed_reports(query_filter, num_reports, key_pattern)
 
                 # 3. Cómo se agrega el resultado al unified_context (REEMPLAZA el bloque 'if full_analysis_doc: ... else: ...' anterior)
                 if found_reports_data:
@@ -383,7 +857,7 @@ async def analyze_question(request: QuestionRequest, db: Session = Depends(get_d
             query_filter_basic = {"center_id": request.center_id}
             if request.informe_filename: # Esto parece ser un remanente, `request.informe_filename` no debería usarse aquí
                 query_filter_basic["original_filename"] = request.informe_filename
-            
+        
             projection_summary = {
                 "report_type": 1, 
                 "original_filename": 1, 
@@ -391,168 +865,108 @@ async def analyze_question(request: QuestionRequest, db: Session = Depends(get_d
                 "report_date": 1,
                 "_id": 0 
             }
-            resumed_docs = list(analyzed_reports_collection.find(query_filter_basic, projection_summary).limit(5))
+            if request.informe_filename:
+                resumed_docs = await analyzed_reports_collection.find(query_filter_basic, projection_summary).limit(5).to_list(length=5)
+            else:
+                # Sin filtro por archivo, la consulta se agrupa con las de otras peticiones concurrentes
+                resumed_docs = await report_summaries_loader.load(request.center_id)
             unified_context["informes_resumidos_disponibles"] = resumed_docs
             logger.info("Contexto de informes resumidos cargado.")
 
         # --- Tu lógica existente para contexto de alimentación (se mantiene igual) ---
-        alimentacion_centros = alimentacion_collection.distinct("Name")
-        clima_codigos = clima_collection.distinct("codigo_centro")
-        clima_centros = []
-        for codigo in clima_codigos:
-            centro = db.query(Center).filter(Center.code == str(codigo)).first()
-            if centro:
-                clima_centros.append({
-                    "id": centro.id,
-                    "nombre": centro.name,
-                    "codigo": centro.code
-                })
-
-        period = detect_period_from_question(request.user_question)
-        alimentacion_summary = None
-        if needs_alimentacion_context(request.user_question):
-            alimentacion_summary = aggregate_alimentacion(alimentacion_collection, center_name, period=period, limit=100)
-        clima_summary = None
-        if needs_clima_context(request.user_question):
-            codigo_centro = center.code if center else None
-            if codigo_centro:
-                try:
-                    codigo_centro = int(codigo_centro)
-                except:
-                    codigo_centro = None
-            clima_summary = aggregate_clima(clima_collection, codigo_centro, period=period, limit=100)
-        
-        # Actualizar el contexto unificado con todos los datos recolectados
-        unified_context["centros_con_alimentacion"] = alimentacion_centros
-        unified_context["centros_con_clima"] = clima_centros
-
-        if alimentacion_summary is not None:
-            unified_context["resumen_alimentacion_centro_actual"] = alimentacion_summary
-        if clima_summary is not None:
-            unified_context["resumen_clima_centro_actual"] = clima_summary
-        # Convertir el contexto unificado a string JSON formateado
-        context_str = json.dumps(unified_context, indent=2, default=str)
-        
-        # Definir el prompt principal con el contexto operativo
-        prompt_content = f"""
-Eres un asistente de inteligencia artificial especializado en análisis ambiental y operacional de centros de cultivo de salmones en Chile. Tu objetivo es interpretar preguntas humanas de forma contextual, identificar la intención de la solicitud, y entregar una respuesta clara, útil y fundamentada basada en los datos disponibles.
-
-**PRIORIDAD: Sé conciso y utiliza solo la información estrictamente necesaria del contexto proporcionado para responder a la pregunta. Evita la verbosidad y la inclusión de detalles no solicitados explícitamente. Apunta a la eficiencia en el uso de tokens.**
-
-### 🧠 CONTEXTO OPERATIVO DISPONIBLE
-
-Tienes acceso a múltiples bases de datos relacionadas a centros de cultivo, cada una con información distinta. No todos los centros están presentes en todas las bases.
-
-- **`todos_los_centros_disponibles` (MySQL)**: Catálogo oficial de centros (ID, nombre, código, latitud, longitud).
-- **`centro_actual_seleccionado`**: Información del centro que se está consultando.
-
-- **INFORMES AMBIENTALES (analyzed_reports)**: Estudios técnicos del fondo marino que pueden incluir materia orgánica, algas en sedimentos, pH, redox, profundidad, etc.
-    - **`informes_ambientales_detallados`**: **Si está presente**, esta es una **lista de objetos JSON**, donde cada objeto contiene el `filename`, `report_date` y el `analysis` completo de un informe ambiental. **Úsala para responder preguntas detalladas, extraer valores específicos o realizar comparaciones y tendencias entre múltiples informes.**
-    - **`informes_resumidos_disponibles`**: Si **`informes_ambientales_detallados` NO está presente** y la pregunta no es específica, este campo contendrá metadatos básicos (tipo, nombre de archivo, fecha de extracción/informe) de informes ambientales disponibles. Úsalo para preguntas generales como "¿qué informes hay?" o listar informes.
-    - **`nombres_de_informes_disponibles_para_inferencia`**: **(Siempre presente si hay informes)** Lista de nombres de archivos recientes para el centro actual, para ayudar en la identificación.
-
-- **DATOS DE ALIMENTACIÓN (MongoDB)**:
-    - **`resumen_alimentacion_centro_actual`**: **Si está presente**, contiene estadísticas agregadas (promedio, suma, min, max) de datos de alimentación para el centro y periodo solicitado (ej. biomasa, consumo de alimento, temperatura del agua).
-    - **`centros_con_alimentacion`**: Lista los nombres de los centros que tienen datos de alimentación.
-- **DATOS CLIMÁTICOS (MongoDB)**:
-    - **`resumen_clima_centro_actual`**: Estadísticas agregadas de condiciones climáticas (temperatura, presión, viento, humedad, etc.) del centro, resumidas desde la base de datos `clima`. Se generan solo si la pregunta lo requiere.
-    - **`centros_con_clima`**: Lista de centros (id, nombre, código) que tienen registros en la base `clima`.
-
-Los centros pueden tener nombres distintos en cada base. Por ello, debes hacer *matching inteligente* entre nombres y coordenadas cuando sea necesario.
-
----
-
-### 🧭 INSTRUCCIONES DINÁMICAS (RAZONAMIENTO FLEXIBLE)
-
-- **Responde Directamente**: Utiliza el contexto proporcionado para responder de manera clara y directa.
-- **Detalle vs. Resumen**: Prioriza la información detallada si `informes_ambientales_detallados` o `resumen_alimentacion_centro_actual` están disponibles. Si no, usa los resúmenes o datos básicos.
-- **Gráficos y Comparaciones**:
-    - Si el usuario solicita un gráfico o una comparación ("gráfico", "comparación", "tendencia", "evolución", "últimos X informes"), busca los datos relevantes dentro de la **lista `informes_ambientales_detallados`**.
-    - Si `informes_ambientales_detallados` contiene **múltiples informes**, extrae las series de datos (ej. pH, redox) de cada informe, utilizando su `report_date` o `filename` para diferenciarlos en el gráfico.
-    - Si encuentras los datos adecuados, genera un bloque JSON para visualización. Asegúrate de que los nombres de los campos en el JSON del gráfico (`xAxis`, `series.name`, `series.data`) sean consistentes con lo que tu frontend espera. Para comparaciones, cada serie podría representar un informe diferente o un valor a lo largo del tiempo/informes.
-
-- **Gráficos y Comparaciones**:
-    - Si el usuario solicita un gráfico o una comparación ("gráfico", "comparación", "visualizar", "evolución", "hazme un gráfico", "crea un gráfico"), y tienes los datos relevantes en el contexto `informes_ambientales_detallados` o `resumen_alimentacion_centro_actual`:
-        - **Tu objetivo principal es generar un bloque JSON con el gráfico solicitado.**
-        - **Para gráficos generales de parámetros como pH o Redox (cuando no se especifica 'por estación'):**
-            - **Usa los valores representativos o promedios del informe, no los datos detallados por estación.**
-            - Si hay un solo informe, el `xAxis` puede ser la fecha del informe o un nombre descriptivo (ej. "Informe [Fecha]"). El `series.data` contendrá ese único valor.
-            - Si hay varios informes, usa las fechas de los informes como `xAxis`. La serie de datos (`series.data`) debe contener los valores correspondientes extraídos para cada informe.
-        - Si el usuario pide explícitamente datos "por estación" o "por punto de muestreo" (ej. "gráfico de pH por estación"), entonces usa esos datos para el gráfico, con las estaciones como `xAxis`.
-        - Siempre genera el JSON del gráfico si los datos son adecuados para ello. Si no hay datos suficientes o el formato no es adecuado, informa al usuario.
+        clima_centros = await run_in_threadpool(get_clima_centros, db, clima_codigos)
 
-Ejemplo de formato JSON para gráfico (adaptado para múltiples informes):
-```json
-{{
-    "chart": {{
-    "type": "line",
-    "title": "Comparación de pH y Redox - Centro Pirquen",
-    "xAxis": ["Informe Marzo 2023", "Informe Julio 2023"], // O las fechas o nombres de archivo para cada informe
-    "series": [
-     {{ "name": "pH (Informe Marzo)", "data": [7.3, 7.4] }}, // Ajusta las series para diferenciar por informe
-     {{ "name": "Redox (Informe Julio)", "data": [170, 175] }}
-    ]
- }}
-}}
-```
+        alimentacion_summary = await alimentacion_task if alimentacion_task else None
+        clima_summary = await clima_task if clima_task else None
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+    
+    # Actualizar el contexto unificado con todos los datos recolectados
+    unified_context["centros_con_alimentacion"] = alimentacion_centros
+    unified_context["centros_con_clima"] = clima_centros
 
-4. **CONTEXTO ESPECÍFICO DISPONIBLE**:
-```json
-{context_str}
-```
+    if alimentacion_summary is not None:
+        unified_context["resumen_alimentacion_centro_actual"] = alimentacion_summary
+    if clima_summary is not None:
+        unified_context["resumen_clima_centro_actual"] = clima_summary
+    unified_context = select_context(request.user_question, unified_context)
+    # Convertir el contexto unificado a JSON compacto y sin escapar tildes: se codifica más rápido y ocupa menos tokens en el prompt
+    context_str = json.dumps(unified_context, separators=(",", ":"), ensure_ascii=False, default=str)
+    
+    # El prefijo fijo va primero y el contexto dinámico al final, para aprovechar la caché de prefijos de Azure
+    prompt_content = _SYSTEM_PREFIX + f"4. **CONTEXTO ESPECÍFICO DISPONIBLE**:\n```json\n{context_str}\n```\n"
+    return prompt_content, cache_key, None
 
 
-"""
-        # Generar la respuesta de la IA
-        response = client.chat.completions.create(
-            model=settings.azure_openai_deployment,
-            messages=[
-                {"role": "system", "content": prompt_content},
-                {"role": "user", "content": request.user_question}
-            ],
-            max_tokens=30000
-        )
+def extract_chart(ai_answer: str):
+    """Separa el bloque JSON de gráfico (si existe) del texto de la respuesta."""
+    chart_data = None
+    chart_match = _CHART_RE.search(ai_answer)
+    if chart_match:
+        try:
+            chart_obj = json.loads(chart_match.group(1))
+            if 'chart' in chart_obj:
+                chart_data = chart_obj['chart']
+            # Eliminar el bloque JSON de la respuesta textual usando la posición ya encontrada
+            ai_answer = (ai_answer[:chart_match.start()] + ai_answer[chart_match.end():]).strip()
+        except Exception as e:
+            logger.error(f"Error al parsear el bloque de gráfico JSON: {e}")
+            chart_data = None
+    return ai_answer, chart_data
 
-        ai_answer = response.choices[0].message.content
+async def save_answer(request: QuestionRequest, ai_answer: str, chart_data, tokens_used, cache_key: Optional[str]):
+    """
+    Guarda la respuesta en el historial de chat y, si corresponde, en la caché del LLM.
+    Se ejecuta en segundo plano: un error de Mongo se registra pero no afecta la respuesta.
+    """
+    chat_entry = {
+        "user_question": request.user_question,
+        "ai_answer": ai_answer,
+        "center_id": request.center_id,
+        "informe_filename": request.informe_filename,
+        "timestamp": datetime.utcnow(),
+        "tokens_used": tokens_used
+    }
+    try:
+        await chat_history_collection.insert_one(chat_entry)
+        if cache_key:
+            await llm_cache_collection.replace_one(
+                {"_id": cache_key},
+                {"_id": cache_key, "ai_answer": ai_answer, "chart_data": chart_data, "created_at": datetime.utcnow()},
+                upsert=True
+            )
+    except Exception as e:
+        logger.error(f"Error al guardar la respuesta en el historial: {e}")
 
-        # Intentar extraer bloque JSON de gráfico si existe
-        import re, json as pyjson
-        chart_data = None
-        chart_match = re.search(r'```json\s*({[\s\S]*?})\s*```', ai_answer)
-        if chart_match:
-            try:
-                chart_json = chart_match.group(1)
-                chart_obj = pyjson.loads(chart_json)
-                if 'chart' in chart_obj:
-                    chart_data = chart_obj['chart']
-                # Eliminar el bloque JSON de la respuesta textual
-                ai_answer = re.sub(r'```json[\s\S]*?```', '', ai_answer).strip()
-            except Exception as e:
-                logger.error(f"Error al parsear el bloque de gráfico JSON: {e}")
-                chart_data = None
-
-        chat_entry = {
-            "user_question": request.user_question,
-            "ai_answer": ai_answer,
-            "center_id": request.center_id,
-            "informe_filename": request.informe_filename,
-            "timestamp": datetime.utcnow(),
-            "tokens_used": response.usage.total_tokens
-        }
-        chat_history_collection.insert_one(chat_entry)
-        audio_base64 = None
-        try:
-            audio_response = tts_client.audio.speech.create(
-                input=ai_answer,
-                model=settings.azure_openai_tts_deployment,
-                voice="onyx",
-                response_format="mp3"
+# --- MODIFICADO: Agregar db: Session = Depends(get_db) ---
+@router.post("/analyze-question/")
+async def analyze_question(request: QuestionRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    try:
+        prompt_content, cache_key, cached = await build_answer_prompt(request, db)
+        if cached:
+            ai_answer, chart_data = cached["ai_answer"], cached.get("chart_data")
+            background_tasks.add_task(save_answer, request, ai_answer, chart_data, 0, None)
+        else:
+            # Generar la respuesta de la IA
+            response = await client.chat.completions.create(
+                model=settings.azure_openai_deployment,
+                messages=[
+                    {"role": "system", "content": prompt_content},
+                    {"role": "user", "content": request.user_question}
+                ],
+                max_tokens=30000
             )
-            audio_bytes = audio_response.content
-            audio_base64 = base64.b64encode(audio_bytes).decode("utf-8")
-        except Exception as tts_e:
-            logger.error(f"Error al sintetizar audio para la respuesta: {tts_e}")
-            audio_base64 = None
+            # Intentar extraer bloque JSON de gráfico si existe
+            ai_answer, chart_data = extract_chart(response.choices[0].message.content)
+            background_tasks.add_task(save_answer, request, ai_answer, chart_data, response.usage.total_tokens, cache_key)
+
+        # El cliente TTS es síncrono: se ejecuta en el threadpool para no bloquear el event loop
+        # mientras otras peticiones (y el guardado en segundo plano) siguen avanzando
+        audio_base64 = await run_in_threadpool(synthesize_audio, ai_answer)
         # Incluir chart si existe
         result = {"answer": ai_answer, "audio_base64": audio_base64}
         if chart_data:
@@ -560,4 +974,70 @@ Ejemplo de formato JSON para gráfico (adaptado para múltiples informes):
         return result
     except Exception as e:
         logger.error(f"Error al analizar la pregunta: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error al procesar la pregunta: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error al procesar la pregunta: {str(e)}")
+
+@router.post("/analyze-question-stream/")
+async def analyze_question_stream(request: QuestionRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """
+    Igual que /analyze-question/, pero envía la respuesta como Server-Sent Events a medida que
+    el modelo la genera. El gráfico se emite apenas se cierra su bloque JSON y el evento final
+    trae la respuesta limpia. El historial se guarda en segundo plano al terminar.
+    """
+    try:
+        prompt_content, cache_key, cached = await build_answer_prompt(request, db)
+    except Exception as e:
+        logger.error(f"Error al analizar la pregunta: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error al procesar la pregunta: {str(e)}")
+
+    final = {"answer": None, "chart": None, "tokens_used": 0}
+
+    def sse(payload: Dict[str, Any]) -> str:
+        return f"data: {json.dumps(payload, default=str)}\n\n"
+
+    async def event_stream():
+        if cached:
+            final["answer"], final["chart"] = cached["ai_answer"], cached.get("chart_data")
+            yield sse({"delta": final["answer"]})
+        else:
+            buffer = []
+            chart_sent = False
+            try:
+                stream = await client.chat.completions.create(
+                    model=settings.azure_openai_deployment,
+                    messages=[
+                        {"role": "system", "content": prompt_content},
+                        {"role": "user", "content": request.user_question}
+                    ],
+                    max_tokens=30000,
+                    stream=True,
+                    # Sin esto ningún chunk trae usage y el historial guarda 0 tokens
+                    stream_options={"include_usage": True}
+                )
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        final["tokens_used"] = chunk.usage.total_tokens
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    buffer.append(delta)
+                    yield sse({"delta": delta})
+                    # Solo se busca el bloque del gráfico cuando llega un cierre de fence
+                    if not chart_sent and "`" in delta:
+                        _, chart_data = extract_chart("".join(buffer))
+                        if chart_data:
+                            chart_sent = True
+                            yield sse({"chart": chart_data})
+                final["answer"], final["chart"] = extract_chart("".join(buffer))
+            except Exception as e:
+                # Un fallo de Azure a mitad de la respuesta se informa como evento en vez de cortar la conexión
+                logger.error(f"Error en la respuesta en streaming: {e}")
+                yield sse({"error": f"Error al procesar la pregunta: {str(e)}"})
+                return
+        yield sse({"done": True, "answer": final["answer"], "chart": final["chart"]})
+
+    async def persist():
+        if final["answer"] is not None:
+            await save_answer(request, final["answer"], final["chart"], final["tokens_used"], None if cached else cache_key)
+
+    background_tasks.add_task(persist)
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
@@ -5,25 +5,26 @@ import re
 import json
 import logging
 import uuid
+import hashlib
+import time
 import asyncio
+import heapq
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any, Literal
-from functools import lru_cache
 from math import sqrt
+from operator import mul
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel, Field, conint, validate_call
-from openai import AsyncAzureOpenAI
-from motor.motor_asyncio import AsyncIOMotorClient
 from sqlalchemy.orm import Session
 from aiocache import Cache, cached
 from aiocache.serializers import JsonSerializer
 from dateutil import parser as date_parser
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
-from dotenv import load_dotenv
 
 from app.core.config import settings
+from app.core.clients import mongo_db, openai_client as client, REDIS_CACHE_OPTIONS
 from app.core.database import get_db
 from app.models.models import Center
 
@@ -31,28 +32,20 @@ from app.models.models import Center
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 router = APIRouter()
-load_dotenv()
 
 # --- Clientes y Configuraciones Avanzadas ---
 class CacheConfig:
-    REDIS_URL = settings.redis_url
     TOOL_TTL = 3600  # 1 hora
     PLAN_TTL = 1800  # 30 minutos
+    EMBEDDING_MEMO_SIZE = 1000  # Embeddings retenidos en memoria del proceso
+    SEMANTIC_TTL = 300  # 5 minutos
+    SEMANTIC_THRESHOLD = 0.95  # Similitud coseno mínima para reutilizar un análisis
+    SEMANTIC_MAX_ENTRIES = 1000
 
 # Configuración OpenTelemetry
 trace.set_tracer_provider(TracerProvider())
 tracer = trace.get_tracer("analysis.advanced")
 
-# Clientes asíncronos
-client = AsyncAzureOpenAI(
-    api_version=settings.azure_openai_api_version,
-    azure_endpoint=settings.azure_openai_endpoint,
-    api_key=settings.azure_openai_api_key,
-)
-
-mongo_client = AsyncIOMotorClient(settings.mongo_uri)
-mongo_db = mongo_client[settings.mongo_db_name]
-
 # --- Modelos Pydantic Mejorados ---
 class QuestionRequest(BaseModel):
     user_question: str = Field(..., min_length=5, max_length=500)
@@ -79,16 +72,97 @@ REGISTERED_TOOLS = [
     }
 ]
 
+def normalize(vector: List[float]) -> List[float]:
+    """Devuelve el vector con norma 1 (o el mismo vector si es nulo)"""
+    norm = sqrt(sum(map(mul, vector, vector)))
+    return [x / norm for x in vector] if norm else list(vector)
+
+# Los embeddings de herramientas no cambian: se normalizan una vez al cargar el módulo,
+# así la similitud coseno con la pregunta se reduce a un producto punto. Al arrancar se
+# reemplazan por los embeddings reales de sus descripciones (load_tool_embeddings)
+for _tool in REGISTERED_TOOLS:
+    _tool["embedding"] = normalize(_tool["embedding"])
+
+async def load_tool_embeddings():
+    """
+    Calcula los embeddings de todas las descripciones de herramientas en una sola llamada y los
+    guarda en Redis (la clave depende de las descripciones), para no recalcularlos en cada arranque.
+    Si Redis no responde se trata como un fallo de caché: los embeddings se calculan igual.
+    """
+    descriptions = [tool["description"] for tool in REGISTERED_TOOLS]
+    digest = hashlib.sha1("\n".join(descriptions).encode()).hexdigest()
+    key = f"emb:tools:v1:{digest}"
+    cache = Cache(Cache.REDIS, **REDIS_CACHE_OPTIONS, serializer=JsonSerializer())
+    try:
+        embeddings = await cache.get(key)
+    except Exception as e:
+        logger.error(f"Error leyendo los embeddings de herramientas de Redis: {str(e)}")
+        embeddings = None
+    if embeddings is None:
+        try:
+            response = await client.embeddings.create(
+                model=settings.azure_openai_embedding_deployment,
+                input=descriptions
+            )
+        except Exception as e:
+            logger.error(f"No se pudieron cargar los embeddings de herramientas: {str(e)}")
+            return
+        embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        try:
+            await cache.set(key, embeddings)
+        except Exception as e:
+            logger.error(f"Error guardando los embeddings de herramientas en Redis: {str(e)}")
+    for tool, embedding in zip(REGISTERED_TOOLS, embeddings):
+        tool["embedding"] = normalize(embedding)
+
+# Bloque ```json ... ``` con el gráfico dentro de la respuesta del modelo
+_CHART_RE = re.compile(r"```json\s*(\{.+?\})\s*```", re.DOTALL)
+
+# Herramientas que el plan puede invocar (cada una implementada como `<nombre>_async`)
+TOOL_WHITELIST = frozenset({"get_timeseries_data", "get_semantic_report_context"})
+
 # --- Funciones de Utilidad Avanzadas ---
 def cosine_similarity(a: List[float], b: List[float]) -> float:
-    """Calcula similitud coseno entre vectores"""
-    dot_product = sum(x*y for x, y in zip(a, b))
-    norm_a = sqrt(sum(x**2 for x in a))
-    norm_b = sqrt(sum(x**2 for x in b))
-    return dot_product / (norm_a * norm_b) if norm_a * norm_b != 0 else 0
+    """Similitud coseno entre vectores ya normalizados (norma 1): es su producto punto"""
+    return sum(map(mul, a, b))
 
-@lru_cache(maxsize=1000)
-async def get_embedding(text: str) -> List[float]:
+def rank_tools(question_unit: List[float], k: int = 3) -> List[Dict[str, Any]]:
+    """Las k herramientas más similares a la pregunta (embedding normalizado), de mayor a menor similitud"""
+    scores = [cosine_similarity(question_unit, tool["embedding"]) for tool in REGISTERED_TOOLS]
+    top = heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+    return [REGISTERED_TOOLS[i] for i in top]
+
+def question_digest(question: str) -> str:
+    """Digest de la pregunta normalizada (minúsculas y espacios colapsados), estable entre procesos"""
+    return hashlib.blake2b(" ".join(question.lower().split()).encode(), digest_size=16).hexdigest()
+
+# Entidades que cambian la respuesta aunque la pregunta sea casi igual: números (años, días,
+# "últimos N"), meses, estaciones, periodos relativos y métricas
+_ENTITY_RE = re.compile(
+    r"\d+(?:[.,]\d+)?"
+    r"|\b(?:enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)\b"
+    r"|\b(?:verano|invierno|primavera|oto[ñn]o|hoy|ayer|semana|mes|a[ñn]o|trimestre)\b"
+    r"|\b(?:temperatura|ox[íi]geno|mortalidad|alimentaci[óo]n|alimento|fcr|sgr|sfr|ph|salinidad|biomasa"
+    r"|crecimiento|presi[óo]n|humedad|viento|precipitaci[óo]n|clima)\b"
+)
+
+def question_entities(question: str) -> frozenset:
+    """Conjunto de entidades (fechas, periodos y métricas) mencionadas en la pregunta"""
+    return frozenset(_ENTITY_RE.findall(question.lower()))
+
+def plan_cache_key(request: "QuestionRequest") -> str:
+    """Clave estable entre procesos (hash() de Python cambia en cada worker): plan:centro:profundidad:digest"""
+    return f"plan:{request.center_id}:{request.analysis_depth}:{question_digest(request.user_question)}"
+
+def embedding_cache_key(text: str) -> str:
+    return f"emb:{hashlib.sha1(text.encode()).hexdigest()}"
+
+# lru_cache no sirve sobre funciones async (cachea la corrutina, no el resultado): los embeddings
+# se guardan en Redis y, para los aciertos más frecuentes, también en memoria del proceso
+_embedding_memo: Dict[str, List[float]] = {}
+
+@cached(cache=Cache.REDIS, **REDIS_CACHE_OPTIONS, ttl=CacheConfig.TOOL_TTL, serializer=JsonSerializer(), key_builder=lambda f, text: embedding_cache_key(text))
+async def fetch_embedding(text: str) -> List[float]:
     """Obtiene embeddings de texto usando OpenAI"""
     response = await client.embeddings.create(
         model=settings.azure_openai_embedding_deployment,
@@ -96,8 +170,79 @@ async def get_embedding(text: str) -> List[float]:
     )
     return response.data[0].embedding
 
+async def get_embedding(text: str) -> List[float]:
+    """Embedding del texto: memoria del proceso, luego Redis y, si no está, OpenAI"""
+    key = embedding_cache_key(text)
+    embedding = _embedding_memo.get(key)
+    if embedding is None:
+        embedding = await fetch_embedding(text)
+        if len(_embedding_memo) >= CacheConfig.EMBEDDING_MEMO_SIZE:
+            _embedding_memo.pop(next(iter(_embedding_memo)))
+        _embedding_memo[key] = embedding
+    return embedding
+
+# --- Caché Semántica de Análisis ---
+class SemanticCache:
+    """
+    Reutiliza análisis de preguntas casi idénticas: guarda el embedding normalizado de cada
+    pregunta respondida junto con su digest y sus entidades (fechas, periodos, métricas). Una
+    pregunta nueva reutiliza la respuesta guardada en Redis si es la misma pregunta normalizada,
+    o si tiene la misma huella (centro y profundidad), las mismas entidades y supera el umbral
+    de similitud.
+    """
+    def __init__(self, threshold: float, ttl: int, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (vector unitario, clave en Redis, huella, digest de la pregunta, entidades, expiración)
+        self.entries: List[tuple] = []
+        self.backend = Cache(Cache.REDIS, **REDIS_CACHE_OPTIONS, serializer=JsonSerializer())
+
+    async def lookup(self, question: str, unit_embedding: List[float], fingerprint: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        self.entries = [entry for entry in self.entries if entry[5] > now]
+        digest, entities = question_digest(question), question_entities(question)
+        best_key, best_score = None, self.threshold
+        for vector, key, entry_fingerprint, entry_digest, entry_entities, _ in self.entries:
+            # La huella evita reutilizar la respuesta de otro centro aunque la pregunta sea igual
+            if entry_fingerprint != fingerprint:
+                continue
+            if entry_digest == digest:
+                best_key = key
+                break
+            # "mortalidad de 2023" y "mortalidad de 2024" son casi iguales para el embedding
+            if entry_entities != entities:
+                continue
+            score = cosine_similarity(unit_embedding, vector)
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        try:
+            return await self.backend.get(best_key)
+        except Exception as e:
+            # Si Redis no responde se trata como un fallo de caché y se hace el análisis completo
+            logger.error(f"Error leyendo la caché semántica: {str(e)}")
+            return None
+
+    async def add(self, question: str, unit_embedding: List[float], fingerprint: str, payload: Dict[str, Any]):
+        key = f"sem:{uuid.uuid4().hex}"
+        try:
+            await self.backend.set(key, payload, ttl=self.ttl)
+        except Exception as e:
+            logger.error(f"Error guardando en la caché semántica: {str(e)}")
+            return
+        self.entries.append((
+            unit_embedding, key, fingerprint, question_digest(question), question_entities(question),
+            time.monotonic() + self.ttl
+        ))
+        if len(self.entries) > self.max_entries:
+            self.entries.pop(0)
+
+semantic_cache = SemanticCache(CacheConfig.SEMANTIC_THRESHOLD, CacheConfig.SEMANTIC_TTL, CacheConfig.SEMANTIC_MAX_ENTRIES)
+
 # --- Implementación de Herramientas con Caché y Validación ---
-@cached(cache=Cache.REDIS, key_builder=lambda f, *args, **kwargs: f"ts_data:{args[1]}:{args[0]}", serializer=JsonSerializer())
+@cached(cache=Cache.REDIS, **REDIS_CACHE_OPTIONS, key_builder=lambda f, *args, **kwargs: f"ts_data:{args[1]}:{args[0]}", serializer=JsonSerializer())
 @validate_call
 async def get_timeseries_data_async(
     data_source: Literal["alimentacion", "clima"],
@@ -170,14 +315,17 @@ async def advanced_analysis(
 
         # 1. Pre-procesamiento y priorización
         question_embedding = await get_embedding(request.user_question)
-        prioritized_tools = sorted(
-            REGISTERED_TOOLS,
-            key=lambda x: cosine_similarity(question_embedding, x["embedding"]),
-            reverse=True
-        )[:3]  # Top 3 herramientas relevantes
+        question_unit = normalize(question_embedding)
+        fingerprint = hashlib.sha1(f"{request.center_id}:{request.analysis_depth}".encode()).hexdigest()
+        cached_analysis = await semantic_cache.lookup(request.user_question, question_unit, fingerprint)
+        if cached_analysis:
+            span.set_attribute("semantic_cache_hit", True)
+            return {**cached_analysis, "analysis_id": str(uuid.uuid4()), "timestamp": datetime.utcnow().isoformat()}
+
+        prioritized_tools = rank_tools(question_unit, k=3)  # Top 3 herramientas relevantes
 
         # 2. Planificación mejorada
-        @cached(cache=Cache.REDIS, key=f"plan:{hash(request.user_question)}", serializer=JsonSerializer())
+        @cached(cache=Cache.REDIS, **REDIS_CACHE_OPTIONS, ttl=CacheConfig.PLAN_TTL, key_builder=lambda f, *args, **kwargs: plan_cache_key(request), serializer=JsonSerializer())
         async def generate_execution_plan() -> Dict:
             plan_prompt = f"""
             Genera un plan JSON para: "{request.user_question}"
@@ -195,22 +343,26 @@ async def advanced_analysis(
 
         plan = await generate_execution_plan()
         
-        # 3. Ejecución paralela optimizada
+        # 3. Ejecución paralela optimizada: los pasos son independientes y se lanzan a la vez
+        steps = [step for step in plan.get("steps", []) if step["tool"] in TOOL_WHITELIST]
+        results = await asyncio.gather(
+            *(globals()[f"{step['tool']}_async"](**step["params"]) for step in steps),
+            return_exceptions=True
+        )
         tool_results = {}
-        for step in plan.get("steps", []):
-            tool_name = step["tool"]
-            if tool_name in ["get_timeseries_data", "get_semantic_report_context"]:
-                tool_func = globals()[f"{tool_name}_async"]
-                try:
-                    tool_results[step["name"]] = await tool_func(**step["params"])
-                except Exception as e:
-                    logger.error(f"Error en {tool_name}: {str(e)}")
-                    tool_results[step["name"]] = {"error": str(e)}
+        for step, result in zip(steps, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error en {step['tool']}: {str(result)}")
+                result = {"error": str(result)}
+            tool_results[step["name"]] = result
 
         # 4. Síntesis mejorada
+        # JSON compacto y sin escapar tildes: se codifica más rápido y ocupa menos tokens; default=str
+        # cubre los datetime/ObjectId que devuelven las herramientas
+        context_json = json.dumps(tool_results, separators=(",", ":"), ensure_ascii=False, default=str)
         synthesizer_prompt = f"""
         ### Contexto Completo:
-        {json.dumps(tool_results, indent=2)}
+        {context_json}
         
         ### Instrucciones:
         - Profundidad: {request.analysis_depth}
@@ -231,16 +383,17 @@ async def advanced_analysis(
         response_content = final_response.choices[0].message.content
         chart_data = None
         
-        if "```json" in response_content:
+        chart_match = _CHART_RE.search(response_content)
+        if chart_match:
             try:
-                chart_match = re.search(r'```json\s*({.+?})\s*```', response_content, re.DOTALL)
                 chart_data = json.loads(chart_match.group(1))
-                response_content = response_content.replace(chart_match.group(0), "").strip()
+                # Se recorta por la posición ya encontrada en vez de buscar el bloque otra vez
+                response_content = (response_content[:chart_match.start()] + response_content[chart_match.end():]).strip()
             except Exception as e:
                 logger.error(f"Error parsing chart: {str(e)}")
 
         # 6. Estructura de respuesta mejorada
-        return {
+        result = {
             "analysis_id": str(uuid.uuid4()),
             "timestamp": datetime.utcnow().isoformat(),
             "answer": response_content,
@@ -256,6 +409,8 @@ async def advanced_analysis(
                 "cache_hits": getattr(generate_execution_plan, "cache_info", lambda: {})().get("hits", 0)
             }
         }
+        await semantic_cache.add(request.user_question, question_unit, fingerprint, result)
+        return result
 
 # --- Sistema de Feedback y Mejora Continua ---
 @router.post("/submit-feedback")
@@ -305,4 +460,5 @@ async def retrain_model_periodically():
 @router.on_event("startup")
 async def startup_event():
     """Inicia tareas en background al cargar el router"""
+    await load_tool_embeddings()
     asyncio.create_task(retrain_model_periodically())
\ No newline at end of file
@@ -2,7 +2,6 @@
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel, Field, conint
-from openai import AsyncAzureOpenAI
 import os
 import re
 import json
@@ -12,13 +11,16 @@ import asyncio
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any, Literal
 from dataclasses import dataclass
+from functools import lru_cache
 
-from dotenv import load_dotenv
-from motor.motor_asyncio import AsyncIOMotorClient
+from aiocache import Cache, cached
+from aiocache.serializers import PickleSerializer
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
+from app.core.clients import mongo_db, openai_client as client, REDIS_CACHE_OPTIONS
 from app.core.database import get_db
+from app.api.deps import has_permission
 from app.models.models import Center
 
 # --- Configuración Inicial ---
@@ -26,7 +28,6 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-load_dotenv()
 
 # --- Modelos de Datos ---
 class QuestionRequest(BaseModel):
@@ -48,15 +49,8 @@ class DataTool:
     days: int = 30
 
 # --- Clientes de Servicios Externos ---
+# Los clientes de OpenAI y MongoDB son los compartidos de app.core.clients
 try:
-    client = AsyncAzureOpenAI(
-        api_version=settings.azure_openai_api_version,
-        azure_endpoint=settings.azure_openai_endpoint,
-        api_key=settings.azure_openai_api_key,
-    )
-
-    mongo_client = AsyncIOMotorClient(settings.mongo_uri)
-    mongo_db = mongo_client[settings.mongo_db_name]
     analyzed_reports_collection = mongo_db["analyzed_reports"]
     chat_history_collection = mongo_db["chat_history"]
     alimentacion_collection = mongo_db["alimentacion"]
@@ -66,7 +60,100 @@ except Exception as e:
     logger.error(f"Error de inicialización: {e}")
     raise RuntimeError(f"Error de configuración: {e}") from e
 
+# --- Caché de Resultados (Redis) ---
+# Claves analysis:dominio:identificador:subidentificador (aiocache antepone el namespace tal
+# cual, por eso termina en ":"), para poder invalidarlas juntas sin tocar otras claves de Redis.
+# Pickle conserva los datetime de los resultados. Los resultados fallidos (success=False) no se
+# cachean.
+class CacheConfig:
+    KEY_PREFIX = "analysis"
+    NAMESPACE = f"{KEY_PREFIX}:"
+    ALIMENTACION_TTL = 300
+    CLIMA_TTL = 120
+    REPORTS_TTL = 1800
+    CENTERS_TTL = 3600
+    CENTER_PROFILE_TTL = 300
+
+def cached_tool(ttl: int, key_builder):
+    return cached(
+        cache=Cache.REDIS,
+        **REDIS_CACHE_OPTIONS,
+        namespace=CacheConfig.NAMESPACE,
+        serializer=PickleSerializer(),
+        ttl=ttl,
+        key_builder=key_builder,
+        skip_cache_func=lambda result: not result.get("success")
+    )
+
+# --- Concurrencia de Herramientas ---
+# Límite de consultas simultáneas y tiempo máximo por herramienta: una base lenta no debe
+# retener la respuesta completa ni saturar el pool de Motor
+TOOL_CONCURRENCY = 4
+TOOL_TIMEOUT_SECONDS = 5
+_tool_semaphore = asyncio.Semaphore(TOOL_CONCURRENCY)
+
+async def run_tool_bounded(coro) -> Dict:
+    async with _tool_semaphore:
+        return await asyncio.wait_for(coro, timeout=TOOL_TIMEOUT_SECONDS)
+
+# --- Escritura del Historial ---
+# El historial es solo analítico: los registros se encolan y una tarea de fondo los inserta por
+# lotes (insert_many) cada HISTORY_FLUSH_INTERVAL segundos, sin bloquear la respuesta
+# La cola es acotada: si el escritor se cae o no arrancó, los registros nuevos se descartan con
+# un log en vez de crecer sin límite. Al apagar se vacía lo pendiente (shutdown_tasks)
+HISTORY_FLUSH_INTERVAL = 0.1
+HISTORY_BATCH_SIZE = 100
+HISTORY_QUEUE_MAXSIZE = 10000
+_history_queue: asyncio.Queue = asyncio.Queue(maxsize=HISTORY_QUEUE_MAXSIZE)
+_history_writer_task: Optional[asyncio.Task] = None
+
+def record_history(record: Dict) -> None:
+    """Encola un registro del historial; lo guarda history_writer"""
+    try:
+        _history_queue.put_nowait(record)
+    except asyncio.QueueFull:
+        logger.error("Cola del historial llena, se descarta el registro")
+
+async def insert_history(batch: List[Dict]) -> None:
+    try:
+        await chat_history_collection.insert_many(batch)
+    except Exception as e:
+        logger.error(f"Error guardando {len(batch)} registro(s) del historial: {e}")
+
+async def flush_history(batch: List[Dict]) -> None:
+    """Inserta el lote dado y todo lo que quede en la cola, por lotes"""
+    while not _history_queue.empty():
+        batch.append(_history_queue.get_nowait())
+    for i in range(0, len(batch), HISTORY_BATCH_SIZE):
+        await insert_history(batch[i:i + HISTORY_BATCH_SIZE])
+
+async def history_writer():
+    """Consume la cola del historial e inserta los registros por lotes, en orden de llegada"""
+    batch: List[Dict] = []
+    try:
+        while True:
+            batch = [await _history_queue.get()]
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            while len(batch) < HISTORY_BATCH_SIZE and not _history_queue.empty():
+                batch.append(_history_queue.get_nowait())
+            # El lote se suelta antes de insertar: un insert en curso termina aunque se cancele la tarea
+            pending, batch = batch, []
+            await insert_history(pending)
+    except asyncio.CancelledError:
+        # Al apagar se guarda el lote en curso y lo que quede en la cola
+        await flush_history(batch)
+        raise
+
 # --- Funciones de Utilidad ---
+@cached(
+    cache=Cache.REDIS,
+    **REDIS_CACHE_OPTIONS,
+    namespace=CacheConfig.NAMESPACE,
+    serializer=PickleSerializer(),
+    ttl=CacheConfig.CENTER_PROFILE_TTL,
+    key_builder=lambda f, db, center_id: f"center:{center_id}:profile",
+    skip_cache_func=lambda result: not result
+)
 async def get_center_info(db: Session, center_id: int) -> Dict:
     """Obtiene información estructurada de un centro"""
     center = db.query(Center).filter(Center.id == center_id).first()
@@ -79,11 +166,13 @@ async def get_center_info(db: Session, center_id: int) -> Dict:
         "location": getattr(center, 'location', "No especificada")
     }
 
+@lru_cache(maxsize=256)
 def normalize_text(text: str) -> str:
     """Normaliza texto para búsquedas"""
     return text.lower().strip()
 
 # --- Herramientas de Datos ---
+@cached_tool(CacheConfig.REPORTS_TTL, lambda f, center_id, num_reports=1: f"reports:{center_id}:{num_reports}")
 async def get_report_analysis(center_id: int, num_reports: int = 1) -> Dict:
     """Obtiene análisis de informes técnicos"""
     try:
@@ -103,36 +192,32 @@ async def get_report_analysis(center_id: int, num_reports: int = 1) -> Dict:
         logger.error(f"Error en get_report_analysis: {e}")
         return {"success": False, "error": str(e)}
 
-async def get_alimentacion_data(db: Session, center_id: int, days: int = 30) -> Dict:
-    """Obtiene datos resumidos de alimentación"""
+@cached_tool(CacheConfig.ALIMENTACION_TTL, lambda f, center_info, start_date, end_date: f"alim:{center_info.get('id')}:{start_date:%Y%m%d%H%M}:{end_date:%Y%m%d%H%M}")
+async def get_alimentacion_data(center_info: Dict, start_date: datetime, end_date: datetime) -> Dict:
+    """Obtiene datos resumidos de alimentación (center_info viene resuelto desde el endpoint)"""
     try:
-        center_info = await get_center_info(db, center_id)
         if not center_info:
             return {"success": False, "error": "Centro no encontrado"}
         
-        end_date = datetime.utcnow()
-        start_date = end_date - timedelta(days=days)
-        
-        # Búsqueda optimizada
-        query = {
-            "$or": [
-                {"codigo_centro": str(center_info["code"])},
-                {"nombre_centro": {"$regex": center_info["name"], "$options": "i"}}
-            ],
-            "fecha": {"$gte": start_date, "$lte": end_date}
-        }
-        
-        pipeline = [
-            {"$match": query},
-            {"$group": {
-                "_id": None,
-                "avg_racion": {"$avg": "$racion"},
-                "total_alimento": {"$sum": "$racion"},
-                "count": {"$sum": 1}
-            }}
-        ]
-        
-        data = await alimentacion_collection.aggregate(pipeline).to_list(1)
+        def pipeline(center_filter: Dict) -> List[Dict]:
+            return [
+                {"$match": {**center_filter, "fecha": {"$gte": start_date, "$lte": end_date}}},
+                # Solo el campo que se agrega llega al $group
+                {"$project": {"racion": 1, "_id": 0}},
+                {"$group": {
+                    "_id": None,
+                    "avg_racion": {"$avg": "$racion"},
+                    "total_alimento": {"$sum": "$racion"},
+                    "count": {"$sum": 1}
+                }}
+            ]
+
+        # Búsqueda optimizada: por código exacto sobre el índice; el regex por nombre (que no
+        # puede usar el índice) solo se intenta si el centro no tiene registros con su código
+        data = await alimentacion_collection.aggregate(pipeline({"codigo_centro": str(center_info["code"])})).to_list(1)
+        if not data:
+            name_filter = {"nombre_centro": {"$regex": re.escape(center_info["name"]), "$options": "i"}}
+            data = await alimentacion_collection.aggregate(pipeline(name_filter)).to_list(1)
         
         if not data or data[0]['count'] == 0:
             return {
@@ -154,16 +239,13 @@ async def get_alimentacion_data(db: Session, center_id: int, days: int = 30) ->
         logger.error(f"Error en get_alimentacion_data: {e}")
         return {"success": False, "error": str(e)}
 
-async def get_clima_data(db: Session, center_id: int, days: int = 7) -> Dict:
-    """Obtiene datos climáticos resumidos"""
+@cached_tool(CacheConfig.CLIMA_TTL, lambda f, center_info, start_date, end_date: f"clima:{center_info.get('id')}:{start_date:%Y%m%d%H%M}:{end_date:%Y%m%d%H%M}")
+async def get_clima_data(center_info: Dict, start_date: datetime, end_date: datetime) -> Dict:
+    """Obtiene datos climáticos resumidos (center_info viene resuelto desde el endpoint)"""
     try:
-        center_info = await get_center_info(db, center_id)
         if not center_info:
             return {"success": False, "error": "Centro no encontrado"}
         
-        end_date = datetime.utcnow()
-        start_date = end_date - timedelta(days=days)
-        
         query = {
             "codigo_centro": str(center_info["code"]),
             "fecha": {"$gte": start_date, "$lte": end_date}
@@ -171,6 +253,7 @@ async def get_clima_data(db: Session, center_id: int, days: int = 7) -> Dict:
         
         pipeline = [
             {"$match": query},
+            {"$project": {"temperatura": 1, "oxigeno": 1, "_id": 0}},
             {"$group": {
                 "_id": None,
                 "avg_temperatura": {"$avg": "$temperatura"},
@@ -201,6 +284,7 @@ async def get_clima_data(db: Session, center_id: int, days: int = 7) -> Dict:
         logger.error(f"Error en get_clima_data: {e}")
         return {"success": False, "error": str(e)}
 
+@cached_tool(CacheConfig.CENTERS_TTL, lambda f, db: "centers:all")
 async def get_centers_info(db: Session) -> Dict:
     """Obtiene información básica de centros"""
     try:
@@ -250,27 +334,26 @@ TOOLS = {
     )
 }
 
+# Palabras clave de selección por herramienta, compiladas una sola vez (en orden de prioridad):
+# informes para preguntas técnicas, luego datos de alimentación y clima, y centers si se menciona un centro
+_SELECTION_KEYWORDS = {
+    "report_analysis": frozenset({"informe", "reporte"}),
+    "alimentacion": frozenset({"alimentación", "ración", "comida"}),
+    "clima": frozenset({"clima", "temperatura", "oxígeno"}),
+    "centers": frozenset({"centro", "granja"}),
+}
+_SELECTION_PATTERNS = {
+    name: re.compile("|".join(map(re.escape, keywords)))
+    for name, keywords in _SELECTION_KEYWORDS.items()
+}
+
+@lru_cache(maxsize=1024)
+def _select_tools(question: str) -> tuple:
+    return tuple(name for name, pattern in _SELECTION_PATTERNS.items() if pattern.search(question))
+
 def select_tools_v2(question: str) -> List[str]:
     """Selección inteligente de herramientas con priorización"""
-    question = normalize_text(question)
-    selected = []
-    
-    # Priorizar herramientas específicas para preguntas técnicas
-    if "informe" in question or "reporte" in question:
-        selected.append("report_analysis")
-    
-    # Detección de necesidades de datos
-    if any(kw in question for kw in ["alimentación", "ración", "comida"]):
-        selected.append("alimentacion")
-    if any(kw in question for kw in ["clima", "temperatura", "oxígeno"]):
-        selected.append("clima")
-    
-    # Siempre incluir centers si se menciona un centro
-    if any(kw in question for kw in ["centro", "granja"]):
-        if "centers" not in selected:
-            selected.append("centers")
-    
-    return selected or ["centers"]
+    return list(_select_tools(normalize_text(question))) or ["centers"]
 
 async def prepare_context(tool_results: Dict, request: QuestionRequest) -> str:
     """Prepara un contexto optimizado para OpenAI"""
@@ -322,6 +405,11 @@ async def prepare_context(tool_results: Dict, request: QuestionRequest) -> str:
 
 def get_system_prompt(request: QuestionRequest) -> str:
     """Genera un prompt adaptado al nivel de análisis"""
+    return system_prompt_for_depth(request.analysis_depth)
+
+@lru_cache(maxsize=3)
+def system_prompt_for_depth(analysis_depth: str) -> str:
+    """Prompt de sistema por profundidad de análisis (solo hay tres, se construyen una vez)"""
     base_prompt = """Eres AquaExpert, un asistente especializado en acuicultura. Sigue estas reglas:
 
 1. CONTEXTO: Tienes acceso a datos de centros de cultivo
@@ -332,9 +420,9 @@ def get_system_prompt(request: QuestionRequest) -> str:
    - Datos relevantes
    - Conclusión o recomendación (si aplica)"""
     
-    if request.analysis_depth == "detailed":
+    if analysis_depth == "detailed":
         base_prompt += "\n\nINCLUYE:\n- Detalles técnicos\n- Comparaciones\n- Tendencias"
-    elif request.analysis_depth == "exhaustive":
+    elif analysis_depth == "exhaustive":
         base_prompt += "\n\nINCLUYE:\n- Análisis completo\n- Posibles causas\n- Recomendaciones técnicas\n- Referencias a estándares del sector"
     
     return base_prompt
@@ -355,17 +443,35 @@ async def analyze_question(
         logger.info(f"Herramientas seleccionadas: {selected_tools}")
         
         # 2. Obtención paralela de datos
+        # El centro se resuelve una sola vez y se comparte entre las herramientas que lo usan
+        center_info = None
+        if any(tool in ("alimentacion", "clima") for tool in selected_tools):
+            center_info = await get_center_info(db, request.center_id)
+
+        # Ventana temporal calculada una vez por petición y redondeada al minuto siguiente: las
+        # preguntas del mismo minuto comparten las claves de caché de alimentación y clima
+        window_end = start_time.replace(second=0, microsecond=0) + timedelta(minutes=1)
+
         tasks = []
         for tool in selected_tools:
             tool_config = TOOLS.get(tool)
             if tool_config:
-                # Manejo especial para centers que no necesita center_id ni days
+                # Manejo especial para centers (solo la sesión) e informes (solo el id del centro)
                 if tool == "centers":
                     tasks.append(tool_config.query_fn(db))
+                elif tool == "report_analysis":
+                    tasks.append(tool_config.query_fn(request.center_id))
                 else:
-                    tasks.append(tool_config.query_fn(db, request.center_id, tool_config.days))
+                    tasks.append(tool_config.query_fn(center_info, window_end - timedelta(days=tool_config.days), window_end))
         
-        tool_results = dict(zip(selected_tools, await asyncio.gather(*tasks)))
+        results = await asyncio.gather(*(run_tool_bounded(t) for t in tasks), return_exceptions=True)
+        tool_results = {}
+        for tool, result in zip(selected_tools, results):
+            if isinstance(result, Exception):
+                error = "Tiempo de espera agotado" if isinstance(result, asyncio.TimeoutError) else str(result)
+                logger.error(f"Error en herramienta {tool}: {error}")
+                result = {"success": False, "error": error}
+            tool_results[tool] = result
         
         # 3. Preparación de contexto optimizado
         context = await prepare_context(tool_results, request)
@@ -410,7 +516,7 @@ async def analyze_question(
             "processing_time_ms": int((datetime.utcnow() - start_time).total_seconds() * 1000)
         }
         
-        await chat_history_collection.insert_one(history_record)
+        record_history(history_record)
         
         return {
             "success": True,
@@ -425,7 +531,7 @@ async def analyze_question(
         
     except Exception as e:
         logger.error(f"Error en analyze_question: {e}")
-        await chat_history_collection.insert_one({
+        record_history({
             "analysis_id": analysis_id,
             "timestamp": datetime.utcnow(),
             "error": str(e),
@@ -464,7 +570,35 @@ async def submit_feedback_optimized(feedback: FeedbackModel):
             detail="Error procesando feedback"
         )
 
+@router.post("/cache/invalidate")
+async def invalidate_analysis_cache(current_user=Depends(has_permission("gestionar_configuracion"))):
+    """Vacía la caché de resultados de herramientas (llamar tras cargar nuevos datos)"""
+    # Siempre con namespace: sin él, aiocache ejecuta FLUSHDB y borra todo Redis. El backend
+    # borra las claves "<namespace>:*", es decir, las que empiezan con "analysis:"
+    await Cache(Cache.REDIS, **REDIS_CACHE_OPTIONS).clear(namespace=CacheConfig.KEY_PREFIX)
+    return {"success": True, "message": "Caché de análisis invalidada"}
+
 @router.on_event("startup")
 async def startup_tasks():
     """Tareas de inicio optimizadas"""
-    logger.info("Servicio de análisis optimizado listo")
\ No newline at end of file
+    global _history_writer_task
+    _history_writer_task = asyncio.create_task(history_writer())
+    # Índices compuestos con la fecha al final (filtro de rango), para que el $match use un IXSCAN
+    try:
+        await alimentacion_collection.create_index([("codigo_centro", 1), ("fecha", 1)], background=True)
+        await clima_collection.create_index([("codigo_centro", 1), ("fecha", 1)], background=True)
+    except Exception as e:
+        logger.warning(f"No se pudieron crear los índices de alimentación y clima: {e}")
+    logger.info("Servicio de análisis optimizado listo")
+
+@router.on_event("shutdown")
+async def shutdown_tasks():
+    """Detiene el escritor del historial guardando los registros pendientes"""
+    if _history_writer_task and not _history_writer_task.done():
+        _history_writer_task.cancel()
+        try:
+            await _history_writer_task
+        except asyncio.CancelledError:
+            pass
+    # Si el escritor no llegó a correr, la cola se vacía aquí
+    await flush_history([])
\ No newline at end of file
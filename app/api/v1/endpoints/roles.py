@@ -1,10 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload, lazyload
 from typing import List
 from app.core.database import get_db
-from app.models.models import Role, User, Permission
-from app.schemas.schemas import RoleCreate, RoleUpdate, RoleResponse, RoleWithPermissionsResponse
-from app.api.deps import get_current_active_user, has_permission
+from app.models.models import Role, User, role_permissions
+from app.schemas.schemas import RoleCreate, RoleUpdate, RoleResponse, RoleWithPermissionsResponse, RoleListAdapter
+from app.api.deps import get_current_active_user, has_permission, invalidate_permissions_cache, get_permission_ids
 
 router = APIRouter()
 
@@ -15,17 +17,18 @@ def create_role(
     current_user: User = Depends(has_permission("crear roles"))
 ):
     """Crear nuevo rol"""
-    existing_role = db.query(Role).filter(Role.name == role_data.name).first()
-    if existing_role:
+    # roles.name es único: un nombre repetido lo rechaza la base de datos al insertar
+    db_role = Role(**role_data.dict())
+    db.add(db_role)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Rol ya existe"
         )
-    
-    db_role = Role(**role_data.dict())
-    db.add(db_role)
-    db.commit()
-    db.refresh(db_role)
+    # Sin refresh: las columnas que faltan (created_at) se leen al serializar, sin recargar los permisos
     return db_role
 
 @router.get("/", response_model=List[RoleWithPermissionsResponse])
@@ -36,8 +39,9 @@ def get_roles(
     current_user: User = Depends(has_permission("ver roles"))
 ):
     """Obtener lista de roles con sus permisos"""
-    roles = db.query(Role).offset(skip).limit(limit).all()
-    return roles
+    # Los permisos de todos los roles se cargan en una sola consulta IN, no uno por rol
+    roles = db.query(Role).options(selectinload(Role.permissions)).offset(skip).limit(limit).all()
+    return ORJSONResponse(RoleListAdapter.dump_python(RoleListAdapter.validate_python(roles, from_attributes=True)))
 
 @router.get("/{role_id}", response_model=RoleResponse)
 def get_role(
@@ -62,7 +66,7 @@ def update_role(
     current_user: User = Depends(has_permission("editar roles"))
 ):
     """Actualizar rol"""
-    role = db.query(Role).filter(Role.id == role_id).first()
+    role = db.query(Role).options(lazyload(Role.permissions)).filter(Role.id == role_id).first()
     if not role:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -70,13 +74,17 @@ def update_role(
         )
     update_data = role_data.dict(exclude_unset=True)
     if "permissions" in update_data:
-        if update_data["permissions"] is not None:
-            permissions = db.query(Permission).filter(Permission.name.in_(update_data["permissions"])).all() if update_data["permissions"] else []
-            role.permissions = permissions
-        del update_data["permissions"]
+        names = update_data.pop("permissions")
+        if names is not None:
+            # Los permisos se reemplazan directamente en la tabla intermedia, con ids en caché
+            db.execute(role_permissions.delete().where(role_permissions.c.role_id == role.id))
+            permission_ids = get_permission_ids(db, names) if names else []
+            if permission_ids:
+                db.execute(role_permissions.insert(), [{"role_id": role.id, "permission_id": permission_id} for permission_id in permission_ids])
     for field, value in update_data.items():
         setattr(role, field, value)
     db.commit()
+    invalidate_permissions_cache()
     db.refresh(role)
     return role
 
@@ -96,4 +104,5 @@ def delete_role(
     
     db.delete(role)
     db.commit()
+    invalidate_permissions_cache()
     return {"message": "Rol eliminado"} 
\ No newline at end of file
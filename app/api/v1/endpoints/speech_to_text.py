@@ -1,41 +1,52 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, status, Request, Response
-import os
-from dotenv import load_dotenv
-from openai import AzureOpenAI # Importar AzureOpenAI
+from openai import AsyncAzureOpenAI
+import httpx
 import logging
-import tempfile
+from contextlib import AsyncExitStack
 from pydantic import BaseModel
 from fastapi.responses import StreamingResponse
-from io import BytesIO
+from starlette.background import BackgroundTask
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# Cargar variables de entorno
-load_dotenv()
-
 # Configuración de Azure OpenAI (reutilizando el cliente existente)
 from app.core.config import settings
 
+# Pool HTTP asíncrono compartido por ambos clientes: las llamadas a Whisper/TTS no bloquean el
+# event loop y reutilizan conexiones abiertas; los fallos de conexión se reintentan dos veces.
+# Los límites van en el transporte: httpx ignora limits= cuando se pasa transport=
+speech_http_client = httpx.AsyncClient(
+    timeout=60,
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    )
+)
+
 # Cliente de OpenAI específico para transcripción
-transcription_client = AzureOpenAI(
+transcription_client = AsyncAzureOpenAI(
     api_version=settings.azure_openai_transcription_api_version or settings.azure_openai_api_version,
     azure_endpoint=settings.azure_openai_transcription_endpoint or settings.azure_openai_endpoint,
     api_key=settings.azure_openai_transcription_api_key or settings.azure_openai_api_key,
-    http_client=None
+    http_client=speech_http_client
 )
 
 
 # Cliente de OpenAI para TTS
-tts_client = AzureOpenAI(
+tts_client = AsyncAzureOpenAI(
     api_version=settings.azure_openai_tts_api_version,
     azure_endpoint=settings.azure_openai_tts_endpoint,
     api_key=settings.azure_openai_tts_api_key,
-    http_client=None
+    http_client=speech_http_client
 )
 
+@router.on_event("shutdown")
+async def close_speech_http_client():
+    await speech_http_client.aclose()
+
 class SynthesizeRequest(BaseModel):
     text: str
     voice: str = "es-ES-ElviraNeural"  # Puedes cambiar la voz por defecto
@@ -43,45 +54,35 @@ class SynthesizeRequest(BaseModel):
     model: str = "gpt-4o-mini-tts"
   # Puedes cambiar el modelo si tienes otro deployment
 
+TTS_CHUNK_SIZE = 64 * 1024
+
 @router.post("/transcribe/")
 async def transcribe_audio(audio_file: UploadFile = File(...)):
     """
     Recibe un archivo de audio y lo transcribe a texto usando Azure OpenAI (Whisper).
     """
     try:
-        audio_content = await audio_file.read()
-        logger.info(f"Received audio file: {audio_file.filename}, size: {len(audio_content)} bytes")
+        # El audio se envía directamente a Whisper como (nombre, bytes, tipo), sin pasar por un
+        # archivo temporal en disco
+        audio_bytes = await audio_file.read()
+        logger.info(f"Received audio file: {audio_file.filename}, size: {len(audio_bytes)} bytes")
 
-        if not audio_content:
+        if not audio_bytes:
             logger.error("Received an empty audio file.")
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty audio file provided.")
 
-        # Usar tempfile para crear un archivo temporal seguro
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_audio_file:
-            temp_audio_file.write(audio_content)
-            file_location = temp_audio_file.name
-
-        logger.info(f"Temporary audio file created at: {file_location}, size: {os.path.getsize(file_location)} bytes")
-        
         # Transcribir audio usando Azure OpenAI (Whisper)
-        with open(file_location, "rb") as audio_fp:
-            transcription = transcription_client.audio.transcriptions.create(
-                model=settings.azure_openai_transcription_deployment, # Usar un deployment específico para transcripción
-                file=audio_fp
-            )
-        
+        transcription = await transcription_client.audio.transcriptions.create(
+            model=settings.azure_openai_transcription_deployment, # Usar un deployment específico para transcripción
+            file=(audio_file.filename or "audio.webm", audio_bytes, audio_file.content_type or "audio/webm")
+        )
+
         transcribed_text = transcription.text
         logger.info(f"Texto Transcrito por Whisper: {transcribed_text}")
 
-        # Eliminar el archivo temporal
-        os.remove(file_location)
-
         return {"transcribedText": transcribed_text}
     except Exception as e:
         logger.error(f"Error en la transcripción de audio con Whisper: {e}")
-        # Asegurar que el archivo temporal se elimine incluso si ocurre un error
-        if 'file_location' in locals() and os.path.exists(file_location):
-            os.remove(file_location)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error al procesar el audio: {str(e)}") 
 
 # --- NUEVO ENDPOINT: SÍNTESIS DE TEXTO A VOZ ---
@@ -93,15 +94,20 @@ async def synthesize_text(request: SynthesizeRequest):
     """
     try:
         logger.info(f"Texto a sintetizar: {request.text[:100]}... (voz: {request.voice}, formato: {request.response_format}, modelo: {request.model})")
-        audio_response = tts_client.audio.speech.create(
+        # El audio se reenvía al cliente a medida que llega del TTS, sin armar el mp3 completo en
+        # memoria; la conexión se cierra en segundo plano al terminar la respuesta
+        stack = AsyncExitStack()
+        audio_response = await stack.enter_async_context(tts_client.audio.speech.with_streaming_response.create(
             input=request.text,
             model=request.model,
             voice=request.voice,
             response_format=request.response_format
+        ))
+        return StreamingResponse(
+            audio_response.iter_bytes(chunk_size=TTS_CHUNK_SIZE),
+            media_type=f"audio/{request.response_format}",
+            background=BackgroundTask(stack.aclose)
         )
-        audio_bytes = audio_response.content
-        logger.info(f"Audio generado, tamaño: {len(audio_bytes)} bytes")
-        return StreamingResponse(BytesIO(audio_bytes), media_type=f"audio/{request.response_format}")
     except Exception as e:
         logger.error(f"Error en la síntesis de texto a voz: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error al sintetizar el texto: {str(e)}") 
\ No newline at end of file
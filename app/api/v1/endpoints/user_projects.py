@@ -1,13 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List
 from app.core.database import get_db
-from app.models.models import UserProject, User, Project
+from app.models.models import UserProject, User
 from app.schemas.schemas import UserProjectCreate, UserProjectUpdate, UserProjectResponse
 from app.api.deps import get_current_active_user, has_permission
 
 router = APIRouter()
 
+# Código de error de MySQL para una clave foránea inexistente (usuario o proyecto)
+MYSQL_FK_VIOLATION = 1452
+
 @router.post("/", response_model=UserProjectResponse)
 def create_user_project(
     user_project_data: UserProjectCreate,
@@ -15,32 +19,23 @@ def create_user_project(
     current_user: User = Depends(has_permission("assign_user_project"))
 ):
     """Asignar usuario a proyecto"""
-    # Verificar que usuario y proyecto existen
-    user = db.query(User).filter(User.id == user_project_data.user_id).first()
-    project = db.query(Project).filter(Project.id == user_project_data.project_id).first()
-    
-    if not user or not project:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Usuario o proyecto no encontrado"
-        )
-    
-    # Verificar que no esté ya asignado
-    existing_assignment = db.query(UserProject).filter(
-        UserProject.user_id == user_project_data.user_id,
-        UserProject.project_id == user_project_data.project_id
-    ).first()
-    
-    if existing_assignment:
+    # Sin consultas previas: las claves foráneas rechazan un usuario o proyecto inexistente y la
+    # restricción única uq_user_project una asignación repetida, incluso entre peticiones concurrentes
+    db_user_project = UserProject(**user_project_data.dict())
+    db.add(db_user_project)
+    try:
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        if e.orig.args[0] == MYSQL_FK_VIOLATION:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Usuario o proyecto no encontrado"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Usuario ya está asignado a este proyecto"
         )
-    
-    db_user_project = UserProject(**user_project_data.dict())
-    db.add(db_user_project)
-    db.commit()
-    db.refresh(db_user_project)
     return db_user_project
 
 @router.get("/", response_model=List[UserProjectResponse])
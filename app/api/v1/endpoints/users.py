@@ -1,18 +1,24 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select, bindparam, JSON
+from sqlalchemy.orm import Session, selectinload, raiseload, lazyload
 from typing import List
 from passlib.context import CryptContext
+from app.core.config import settings
 from app.core.database import get_db
-from app.models.models import User, Role
+from app.models.models import User, Role, user_roles
 from app.schemas.schemas import (
     UserCreate, UserUpdate, UserResponse, UserWithRolesResponse, UserFrontendResponse
 )
-from app.api.deps import get_current_active_user, has_permission
+from app.api.deps import get_current_active_user, has_permission, invalidate_permissions_cache, get_role_ids
 
 router = APIRouter()
 
+# Consulta de roles por nombre armada una sola vez; la lista de nombres se expande al ejecutar
+ROLES_BY_NAME = select(Role).where(Role.name.in_(bindparam("names", expanding=True)))
+
 # Configuración de encriptación
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
 
 def get_password_hash(password: str) -> str:
     """Genera hash de la contraseña"""
@@ -22,7 +28,8 @@ def get_password_hash(password: str) -> str:
 def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
     """Crear nuevo usuario"""
     # Verificar si el usuario ya existe
-    existing_user = db.query(User).filter(
+    # Solo interesa si existe: no se cargan los roles del usuario encontrado
+    existing_user = db.query(User).options(raiseload('*')).filter(
         (User.username == user_data.username) | (User.email == user_data.email)
     ).first()
     if existing_user:
@@ -40,11 +47,10 @@ def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
     )
     # Asignar roles si se reciben
     if user_data.roles:
-        roles = db.query(Role).filter(Role.name.in_(user_data.roles)).all()
-        db_user.roles = roles
+        db_user.roles = db.execute(ROLES_BY_NAME, {"names": user_data.roles}).scalars().all()
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
+    # Sin refresh: las columnas que faltan (created_at) se leen al serializar, sin recargar los roles
     return db_user
 
 @router.get("/", response_model=List[UserFrontendResponse])
@@ -55,21 +61,36 @@ def get_users(
     current_user: User = Depends(has_permission("ver usuario"))
 ):
     """Obtener lista de usuarios con sus roles para el frontend"""
-    users = db.query(User).offset(skip).limit(limit).all()
+    # Solo las columnas que usa el frontend, con los nombres de roles agregados en MySQL
+    # (JSON_ARRAYAGG, sin separador ni límite de longitud): una consulta y sin cargar objetos ORM
+    rows = (
+        db.query(
+            User.id,
+            User.username,
+            User.email,
+            User.is_active,
+            func.json_arrayagg(Role.name, type_=JSON).label("role_names")
+        )
+        .outerjoin(User.roles)
+        .group_by(User.id)
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
     
-    # Transformar los datos para el frontend
-    frontend_users = []
-    for user in users:
-        frontend_user = {
-            "id": user.id,
-            "name": user.username,  # Usar username como name
-            "email": user.email,
-            "roles": [{"name": role.name} for role in user.roles],
-            "status": "Activo" if user.is_active else "Inactivo"
+    # Transformar los datos para el frontend; ya tienen la forma de UserFrontendResponse, así que
+    # se serializan directo con orjson sin volver a validarlos
+    return ORJSONResponse([
+        {
+            "id": row.id,
+            "name": row.username,  # Usar username como name
+            "email": row.email,
+            # Sin roles el outer join agrega [null]
+            "roles": [{"name": name} for name in row.role_names or [] if name is not None],
+            "status": "Activo" if row.is_active else "Inactivo"
         }
-        frontend_users.append(frontend_user)
-    
-    return frontend_users
+        for row in rows
+    ])
 
 @router.get("/{user_id}", response_model=UserWithRolesResponse)
 def get_user(
@@ -78,7 +99,7 @@ def get_user(
     current_user: User = Depends(has_permission("ver usuario"))
 ):
     """Obtener usuario específico con sus roles"""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = db.query(User).options(selectinload(User.roles)).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -94,7 +115,7 @@ def update_user(
     current_user: User = Depends(get_current_active_user)
 ):
     """Actualizar usuario"""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = db.query(User).options(lazyload(User.roles)).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -106,13 +127,17 @@ def update_user(
     if "password" in update_data:
         update_data["password_hash"] = get_password_hash(update_data.pop("password"))
     if "roles" in update_data:
-        if update_data["roles"] is not None:
-            roles = db.query(Role).filter(Role.name.in_(update_data["roles"])).all() if update_data["roles"] else []
-            user.roles = roles
-        del update_data["roles"]
+        names = update_data.pop("roles")
+        if names is not None:
+            # Los roles se reemplazan directamente en la tabla intermedia, con ids en caché
+            db.execute(user_roles.delete().where(user_roles.c.user_id == user.id))
+            role_ids = get_role_ids(db, names) if names else []
+            if role_ids:
+                db.execute(user_roles.insert(), [{"user_id": user.id, "role_id": role_id} for role_id in role_ids])
     for field, value in update_data.items():
         setattr(user, field, value)
     db.commit()
+    invalidate_permissions_cache(user_id)
     db.refresh(user)
     return user
 
@@ -132,4 +157,5 @@ def delete_user(
     
     db.delete(user)
     db.commit()
+    invalidate_permissions_cache(user_id)
     return {"message": "Usuario eliminado"} 
\ No newline at end of file
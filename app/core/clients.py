@@ -0,0 +1,42 @@
+import os
+from urllib.parse import urlparse
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+from openai import AsyncAzureOpenAI
+
+from app.core.config import settings
+
+# Clientes compartidos por los routers: un solo pool de conexiones a MongoDB y a Azure OpenAI
+# por proceso, en vez de uno por módulo
+
+# Pool de MongoDB dimensionado según los núcleos disponibles
+MONGO_MAX_POOL_SIZE = min(100, 4 * (os.cpu_count() or 1))
+
+mongo_client = AsyncIOMotorClient(settings.mongo_uri, maxPoolSize=MONGO_MAX_POOL_SIZE)
+mongo_db = mongo_client[settings.mongo_db_name]
+
+# Conexiones HTTP persistentes hacia Azure OpenAI (se reutilizan TCP/TLS entre peticiones)
+openai_client = AsyncAzureOpenAI(
+    api_version=settings.azure_openai_api_version,
+    azure_endpoint=settings.azure_openai_endpoint,
+    api_key=settings.azure_openai_api_key,
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)),
+)
+
+# Parámetros de conexión de las cachés Redis de aiocache (no acepta una URL): se pasan a los
+# decoradores @cached y a los Cache(Cache.REDIS, ...)
+_redis_url = urlparse(settings.redis_url)
+REDIS_CACHE_OPTIONS = {
+    "endpoint": _redis_url.hostname or "localhost",
+    "port": _redis_url.port or 6379,
+    "db": int(_redis_url.path.lstrip("/") or 0),
+    "password": _redis_url.password,
+}
+
+# Dependencias de FastAPI que devuelven los clientes compartidos
+def get_mongo():
+    return mongo_db
+
+def get_openai():
+    return openai_client
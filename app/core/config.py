@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -18,6 +19,16 @@ class Settings(BaseSettings):
     db_pass: str = "Wi$3nS0rIA!"
     db_name: str = "fastapi_db"
     db_port: int = 3306
+
+    # Pool de conexiones de SQLAlchemy (ajustable por entorno)
+    db_pool_size: int = 20
+    db_max_overflow: int = 40
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 3600
+    db_pool_warmup: int = 5  # Conexiones que se abren al arrancar
+
+    # Hilos del threadpool donde FastAPI ejecuta los endpoints síncronos (por defecto son 40)
+    threadpool_size: int = 100
     
     # Configuración JWT
     jwt_secret: str = "your-super-secret-key-change-this-in-production"
@@ -28,7 +39,8 @@ class Settings(BaseSettings):
     cors_origins: list = ["http://10.20.7.101:5173", "http://10.20.7.102:5173", "https://wisensoria.iotlink.cl","https://apiwisensoria.iotlink.cl"]
     
     # Configuración de seguridad
-    bcrypt_rounds: int = 12
+    # Costo de bcrypt para hashes nuevos (los existentes se verifican con el costo con que se crearon)
+    bcrypt_rounds: int = 10
 
     # Configuración de Azure OpenAI
     azure_openai_endpoint: Optional[str] = None
@@ -54,11 +66,19 @@ class Settings(BaseSettings):
     mongo_uri: str
     mongo_db_name: str = "wisensor_db"
 
+    # Redis para las cachés de análisis (aiocache)
+    redis_url: str = "redis://localhost:6379/0"
+
     class Config:
         env_file = ".env"
         case_sensitive = False
         env_file_encoding = "utf-8"
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Devuelve la configuración, leyendo el entorno y el .env una sola vez por proceso."""
+    return Settings()
+
 # Instancia global de configuración
-settings = Settings()
+settings = get_settings()
  
\ No newline at end of file
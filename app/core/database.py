@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
@@ -10,9 +10,10 @@ DATABASE_URL = f"mysql+pymysql://{settings.db_user}:{settings.db_pass}@{settings
 engine = create_engine(
     DATABASE_URL,
     pool_pre_ping=True,
-    pool_recycle=300,
-    pool_size=5,
-    max_overflow=10,
+    pool_recycle=settings.db_pool_recycle,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
     echo=settings.debug
 )
 
@@ -32,4 +33,17 @@ def get_db():
 
 # Función para crear tablas
 def create_tables():
-    Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+    Base.metadata.create_all(bind=engine) 
+
+# Función para precalentar el pool: abre varias conexiones a la vez para que las primeras
+# peticiones no paguen el handshake con MySQL
+def warm_up_pool(connections: int):
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            opened.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            conn.close()
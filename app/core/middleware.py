@@ -0,0 +1,43 @@
+# Middleware ASGI livianos de la aplicación
+
+class PreflightMiddleware:
+    """
+    Responde los preflight CORS (OPTIONS con Origin y Access-Control-Request-Method) con cabeceras
+    precalculadas, sin pasar por CORSMiddleware ni por el enrutador. Solo actúa con cualquier
+    origen y sin credenciales (los mismos parámetros que CORSMiddleware); con otra configuración
+    deja pasar todo y CORSMiddleware responde. El resto de las peticiones sigue su curso normal.
+    """
+
+    def __init__(self, app, allow_origins, allow_methods, allow_credentials: bool = False, max_age: int = 600):
+        self.app = app
+        self.enabled = list(allow_origins) == ["*"] and not allow_credentials
+        self.allow_methods = frozenset(method.encode() for method in allow_methods)
+        self.headers = [
+            (b"access-control-allow-origin", b"*"),
+            (b"access-control-allow-methods", ", ".join(allow_methods).encode()),
+            (b"access-control-max-age", str(max_age).encode()),
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"content-length", b"2"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if self.enabled and scope["type"] == "http" and scope["method"] == "OPTIONS":
+            has_origin = False
+            request_method = request_headers = None
+            for name, value in scope["headers"]:
+                if name == b"origin":
+                    has_origin = True
+                elif name == b"access-control-request-method":
+                    request_method = value
+                elif name == b"access-control-request-headers":
+                    request_headers = value
+            # Un método no permitido lo rechaza CORSMiddleware como siempre
+            if has_origin and request_method in self.allow_methods:
+                headers = self.headers
+                if request_headers is not None:
+                    # Se aceptan todas las cabeceras: se devuelven las solicitadas
+                    headers = headers + [(b"access-control-allow-headers", request_headers)]
+                await send({"type": "http.response.start", "status": 200, "headers": headers})
+                await send({"type": "http.response.body", "body": b"OK"})
+                return
+        await self.app(scope, receive, send)
@@ -1,33 +1,66 @@
+import logging
+import anyio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.core.config import settings
-from app.core.database import create_tables
+from app.core.database import create_tables, warm_up_pool
+from app.core.middleware import PreflightMiddleware
 from app.api.v1.api import api_router
 # from apscheduler.schedulers.background import BackgroundScheduler
 # from apscheduler.triggers.cron import CronTrigger
 
 from .api.v1.endpoints.data import generar_resumen as generar_resumen
 
-# Crear tablas en la base de datos
-create_tables()
-
 # Crear aplicación FastAPI
 app = FastAPI(
     title=settings.app_name,
     description="Backend API para el sistema Wisensor",
     version=settings.app_version,
     debug=settings.debug,
-    redirect_slashes=False
+    redirect_slashes=False,
+    # Las respuestas JSON se serializan con orjson en vez del módulo json estándar
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS
+CORS_ALLOW_ORIGINS = ["*"]  # Permitir cualquier origen para acceso desde toda la red
+CORS_ALLOW_CREDENTIALS = False  # Debe ser False cuando allow_origins es "*"
+CORS_ALLOW_METHODS = ["GET", "POST", "PUT", "DELETE", "OPTIONS"]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Permitir cualquier origen para acceso desde toda la red
-    allow_credentials=False,  # Debe ser False cuando allow_origins es "*"
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_credentials=CORS_ALLOW_CREDENTIALS,
+    allow_methods=CORS_ALLOW_METHODS,
     allow_headers=["*"],
 )
+# Los preflight se responden antes de llegar a CORSMiddleware (se agrega después: queda por fuera)
+app.add_middleware(
+    PreflightMiddleware,
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_methods=CORS_ALLOW_METHODS,
+    allow_credentials=CORS_ALLOW_CREDENTIALS,
+)
+
+# Los endpoints síncronos (sesión SQLAlchemy síncrona) corren en el threadpool de anyio;
+# se amplía su límite para que la concurrencia no quede topada en 40 peticiones
+@app.on_event("startup")
+async def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_size
+
+# Las tablas se crean con scripts/create_tables.py al desplegar; solo en modo debug se crean al
+# arrancar, para no repetir el DDL en cada worker
+@app.on_event("startup")
+def create_tables_in_debug():
+    if settings.debug:
+        create_tables()
+
+@app.on_event("startup")
+def warm_up_db_pool():
+    try:
+        warm_up_pool(settings.db_pool_warmup)
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"No se pudo precalentar el pool de MySQL: {e}")
 
 # Incluir rutas de la API
 app.include_router(api_router, prefix="/api")
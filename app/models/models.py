@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Table, Float
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Table, Float, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.core.database import Base
@@ -9,14 +9,18 @@ user_roles = Table(
     'user_roles',
     Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('role_id', Integer, ForeignKey('roles.id'))
+    Column('role_id', Integer, ForeignKey('roles.id')),
+    Index('ix_user_roles_user_id', 'user_id'),
+    Index('ix_user_roles_role_id', 'role_id')
 )
 
 role_permissions = Table(
     'role_permissions',
     Base.metadata,
     Column('role_id', Integer, ForeignKey('roles.id')),
-    Column('permission_id', Integer, ForeignKey('permissions.id'))
+    Column('permission_id', Integer, ForeignKey('permissions.id')),
+    Index('ix_role_permissions_role_id', 'role_id'),
+    Index('ix_role_permissions_permission_id', 'permission_id')
 )
 
 class User(Base):
@@ -30,8 +34,9 @@ class User(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
-    # Relaciones
-    roles = relationship("Role", secondary=user_roles, back_populates="users")
+    # Relaciones (roles y permisos se cargan por lotes con una consulta IN: se recorren en login,
+    # permisos y en las respuestas de usuarios/roles)
+    roles = relationship("Role", secondary=user_roles, back_populates="users", lazy="selectin")
     projects = relationship("UserProject", back_populates="user")
 
 class Role(Base):
@@ -45,7 +50,7 @@ class Role(Base):
     
     # Relaciones
     users = relationship("User", secondary=user_roles, back_populates="roles")
-    permissions = relationship("Permission", secondary=role_permissions, back_populates="roles")
+    permissions = relationship("Permission", secondary=role_permissions, back_populates="roles", lazy="selectin")
 
 class Permission(Base):
     __tablename__ = "permissions"
@@ -74,10 +79,13 @@ class Project(Base):
 
 class UserProject(Base):
     __tablename__ = "user_projects"
+    # Un usuario se asigna una sola vez a cada proyecto (lo garantiza la base de datos); el índice
+    # de la restricción también cubre las búsquedas por user_id
+    __table_args__ = (UniqueConstraint('user_id', 'project_id', name='uq_user_project'),)
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    project_id = Column(Integer, ForeignKey('projects.id'), nullable=False)
+    project_id = Column(Integer, ForeignKey('projects.id'), nullable=False, index=True)
     role_in_project = Column(String(50))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -1,19 +1,41 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints, TypeAdapter
+from typing import Optional, List, Annotated, get_args, get_origin
 from datetime import datetime
 
+# Email validado con una expresión regular en lugar de EmailStr (evita email-validator y su
+# esquema de validación más pesado)
+Email = Annotated[str, StringConstraints(pattern=r"^[^@\s]+@[^@\s]+\.[^@\s]+$", max_length=254)]
+
+class Schema(BaseModel):
+    """Base de todos los schemas: el esquema de validación se arma al primer uso y no al importar,
+    y los campos extra se ignoran."""
+    model_config = ConfigDict(extra="ignore", defer_build=True)
+
+def from_orm_fast(cls, obj):
+    """Arma un schema de respuesta desde un objeto ORM sin validarlo (los datos vienen de la base,
+    no del cliente). Las listas de schemas anidados se arman de la misma forma."""
+    values = {}
+    for name, field in cls.model_fields.items():
+        value = getattr(obj, name)
+        if get_origin(field.annotation) is list and value is not None:
+            (item_cls,) = get_args(field.annotation)
+            if isinstance(item_cls, type) and issubclass(item_cls, BaseModel):
+                value = [from_orm_fast(item_cls, item) for item in value]
+        values[name] = value
+    return cls.model_construct(**values)
+
 # Schemas para User
-class UserBase(BaseModel):
+class UserBase(Schema):
     username: str
-    email: EmailStr
+    email: Email
 
 class UserCreate(UserBase):
     password: str
-    roles: Optional[List[str]] = []
+    roles: Optional[List[str]] = Field(default_factory=list)
 
-class UserUpdate(BaseModel):
+class UserUpdate(Schema):
     username: Optional[str] = None
-    email: Optional[EmailStr] = None
+    email: Optional[Email] = None
     password: Optional[str] = None
     is_active: Optional[bool] = None
     roles: Optional[List[str]] = None
@@ -24,18 +46,17 @@ class UserResponse(UserBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Schemas para Role
-class RoleBase(BaseModel):
+class RoleBase(Schema):
     name: str
     description: Optional[str] = None
 
 class RoleCreate(RoleBase):
     pass
 
-class RoleUpdate(BaseModel):
+class RoleUpdate(Schema):
     name: Optional[str] = None
     description: Optional[str] = None
     permissions: Optional[List[str]] = None
@@ -45,18 +66,17 @@ class RoleResponse(RoleBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Schemas para Permission
-class PermissionBase(BaseModel):
+class PermissionBase(Schema):
     name: str
     description: Optional[str] = None
 
 class PermissionCreate(PermissionBase):
     pass
 
-class PermissionUpdate(BaseModel):
+class PermissionUpdate(Schema):
     name: Optional[str] = None
     description: Optional[str] = None
 
@@ -65,11 +85,10 @@ class PermissionResponse(PermissionBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Schemas para Project
-class ProjectBase(BaseModel):
+class ProjectBase(Schema):
     name: str
     description: Optional[str] = None
     is_active: bool = True
@@ -77,7 +96,7 @@ class ProjectBase(BaseModel):
 class ProjectCreate(ProjectBase):
     pass
 
-class ProjectUpdate(BaseModel):
+class ProjectUpdate(Schema):
     name: Optional[str] = None
     description: Optional[str] = None
     is_active: Optional[bool] = None
@@ -87,11 +106,10 @@ class ProjectResponse(ProjectBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Schemas para UserProject
-class UserProjectBase(BaseModel):
+class UserProjectBase(Schema):
     user_id: int
     project_id: int
     role_in_project: Optional[str] = None
@@ -99,7 +117,7 @@ class UserProjectBase(BaseModel):
 class UserProjectCreate(UserProjectBase):
     pass
 
-class UserProjectUpdate(BaseModel):
+class UserProjectUpdate(Schema):
     role_in_project: Optional[str] = None
 
 class UserProjectResponse(UserProjectBase):
@@ -107,58 +125,59 @@ class UserProjectResponse(UserProjectBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Schemas para Auth
-class LoginRequest(BaseModel):
+class LoginRequest(Schema):
     email: str
     password: str
 
-class UserLoginResponse(BaseModel):
+class UserLoginResponse(Schema):
     id: int
     name: str
     email: str
     roles: List[str]
     permisos: List[str]
 
-class TokenResponse(BaseModel):
+class TokenResponse(Schema):
     token: str
     refresh_token: str  # Nuevo campo para el refresh token
     user: UserLoginResponse
 
 class UserWithRolesResponse(UserResponse):
-    roles: List[RoleResponse] = []
+    roles: List[RoleResponse] = Field(default_factory=list)
+
+class RoleName(Schema):
+    """Rol tal como lo recibe el frontend (solo el nombre)"""
+    name: str
 
-class UserFrontendResponse(BaseModel):
+class UserFrontendResponse(Schema):
     id: int
     name: str  # Usamos username como name
     email: str
-    roles: List[dict] = []  # Lista de roles con solo el nombre
+    roles: List[RoleName] = Field(default_factory=list)  # Lista de roles con solo el nombre
     status: str = "Activo"
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class RoleWithPermissionsResponse(RoleResponse):
-    permissions: List[PermissionResponse] = []
+    permissions: List[PermissionResponse] = Field(default_factory=list)
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # Schemas para InformeCentro
-class InformeCentroBase(BaseModel):
+class InformeCentroBase(Schema):
     center_id: int
     report_type: str
     file_path: str
     filename: str
-    is_analyzed: bool = False
+    is_analyzed: bool = False # Indica si el informe ha sido analizado
 
 class InformeCentroCreate(InformeCentroBase):
     pass
 
-class InformeCentroUpdate(BaseModel):
+class InformeCentroUpdate(Schema):
     report_type: Optional[str] = None
     file_path: Optional[str] = None
     filename: Optional[str] = None
@@ -168,14 +187,12 @@ class InformeCentroResponse(InformeCentroBase):
     id: int
     created_at: datetime
     updated_at: Optional[datetime] = None
-    is_analyzed: bool = False # Nuevo campo para indicar si el informe ha sido analizado
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # Schemas para Center
-class CenterBase(BaseModel):
+class CenterBase(Schema):
     name: str
     latitude: float
     longitude: float
@@ -186,7 +203,7 @@ class CenterBase(BaseModel):
 class CenterCreate(CenterBase):
     pass
 
-class CenterUpdate(BaseModel):
+class CenterUpdate(Schema):
     name: Optional[str] = None
     latitude: Optional[float] = None
     longitude: Optional[float] = None
@@ -198,7 +215,10 @@ class CenterResponse(CenterBase):
     id: int
     created_at: datetime
     updated_at: Optional[datetime] = None
-    informes: List[InformeCentroResponse] = [] # Añadido para incluir informes
+    informes: List[InformeCentroResponse] = Field(default_factory=list) # Añadido para incluir informes
+
+    model_config = ConfigDict(from_attributes=True)
 
-    class Config:
-        from_attributes = True 
\ No newline at end of file
+# Adaptadores de listas armados una sola vez, para serializar listados sin pasar por
+# jsonable_encoder
+RoleListAdapter = TypeAdapter(List[RoleWithPermissionsResponse])
@@ -0,0 +1,33 @@
+"""
+Agrega índices explícitos a las claves foráneas de user_roles, role_permissions y user_projects.
+
+create_tables() solo crea tablas nuevas, así que en bases existentes los índices se agregan con
+este script. En MySQL, el índice implícito que InnoDB creó para cada clave foránea se reemplaza
+por el nuevo.
+Uso: python -m migrations.versions.20261015_add_association_indexes
+"""
+
+from sqlalchemy import text
+from app.core.database import engine
+
+INDEXES = [
+    ("user_roles", "ix_user_roles_user_id", "user_id"),
+    ("user_roles", "ix_user_roles_role_id", "role_id"),
+    ("role_permissions", "ix_role_permissions_role_id", "role_id"),
+    ("role_permissions", "ix_role_permissions_permission_id", "permission_id"),
+    ("user_projects", "ix_user_projects_project_id", "project_id"),
+]
+
+def upgrade():
+    with engine.begin() as conn:
+        for table, name, column in INDEXES:
+            conn.execute(text(f"CREATE INDEX {name} ON {table} ({column})"))
+
+def downgrade():
+    with engine.begin() as conn:
+        for table, name, _ in INDEXES:
+            conn.execute(text(f"DROP INDEX {name} ON {table}"))
+
+if __name__ == "__main__":
+    upgrade()
+    print("✅ Índices de tablas intermedias creados")
@@ -0,0 +1,27 @@
+"""
+Agrega la restricción única uq_user_project (user_id, project_id) a user_projects.
+
+create_tables() solo crea tablas nuevas, así que en bases existentes la restricción se agrega
+con este script. Antes elimina las asignaciones duplicadas, conservando la de menor id.
+Uso: python -m migrations.versions.20261015_add_unique_user_project
+"""
+
+from sqlalchemy import text
+from app.core.database import engine
+
+def upgrade():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            DELETE up FROM user_projects up
+            JOIN user_projects keep
+              ON keep.user_id = up.user_id AND keep.project_id = up.project_id AND keep.id < up.id
+        """))
+        conn.execute(text("ALTER TABLE user_projects ADD CONSTRAINT uq_user_project UNIQUE (user_id, project_id)"))
+
+def downgrade():
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE user_projects DROP INDEX uq_user_project"))
+
+if __name__ == "__main__":
+    upgrade()
+    print("✅ Restricción uq_user_project creada")
@@ -3,13 +3,15 @@
 Script principal para ejecutar la aplicación FastAPI
 """
 
-import uvicorn
-from app.core.config import settings
 from dotenv import load_dotenv # Importar load_dotenv
 
-load_dotenv() # Cargar variables de entorno desde .env
-
 if __name__ == "__main__":
+    load_dotenv() # Cargar variables de entorno desde .env
+
+    # uvicorn y la configuración se importan recién aquí, con el .env ya cargado
+    import uvicorn
+    from app.core.config import settings
+
     print("🚀 Iniciando servidor FastAPI...")
     print(f"📡 Servidor corriendo en http://{settings.host}:{settings.port}")
     print("📚 Documentación disponible en http://localhost:3000/docs")
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+"""
+Script para crear las tablas que falten en la base de datos, sin tocar los datos existentes.
+Se ejecuta una vez por despliegue en lugar de en cada arranque de worker.
+Uso: python -m scripts.create_tables
+"""
+
+from app.core.database import create_tables
+
+if __name__ == "__main__":
+    create_tables()
+    print("✅ Tablas creadas")
@@ -3,11 +3,19 @@
 Script para inicializar la base de datos con datos de ejemplo
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sqlalchemy import exists, insert, select
 from sqlalchemy.orm import sessionmaker
 from app.core.database import engine, SessionLocal
 from app.models.models import User, Role, Permission, Project, UserProject, user_roles, role_permissions, Center, InformeCentro # Importar InformeCentro
 from app.api.v1.endpoints.auth import get_password_hash
 
+# Costo de bcrypt para las contraseñas de ejemplo: bajo por defecto, ya que son datos de desarrollo
+# (el costo queda guardado en cada hash, así que se verifican igual en el login)
+BCRYPT_SEED_COST = int(os.getenv("BCRYPT_SEED_COST", "4"))
+
 def init_db():
     """Inicializar base de datos con datos de ejemplo"""
     
@@ -16,149 +24,128 @@ def init_db():
     create_tables()
     print("✅ Tablas creadas")
     
+    # Los hashes de contraseñas (bcrypt, CPU pura que libera el GIL) se calculan en paralelo
+    # mientras se limpian y cargan las demás tablas
+    sample_users = [
+        ("admin", "admin@wisensor.com", "admin123"),
+        ("user1", "user1@wisensor.com", "user123"),
+        ("manager1", "manager1@wisensor.com", "manager123"),
+    ]
+    hash_executor = ThreadPoolExecutor(max_workers=len(sample_users))
+    password_hashes = hash_executor.map(
+        partial(get_password_hash, rounds=BCRYPT_SEED_COST),
+        [password for _, _, password in sample_users]
+    )
+    
     # Crear sesión
     db = SessionLocal()
     
     try:
-        # Verificar si ya hay datos
-        if db.query(User).first():
+        # Verificar si ya hay datos (SELECT EXISTS, sin traer ninguna fila)
+        if db.execute(select(exists(select(User.id)))).scalar():
             print("⚠️  La base de datos ya tiene datos. Forzando reinicialización...")
-            # Limpiar datos existentes en orden correcto (respetando FK constraints)
-            db.query(UserProject).delete()
-            db.query(Project).delete()
-            db.query(Center).delete() # Añadir eliminación de centros
-            db.query(InformeCentro).delete() # Añadir eliminación de informes de centro
-            # Eliminar relaciones muchos a muchos antes de eliminar las entidades principales
-            db.execute(user_roles.delete())
-            db.execute(role_permissions.delete())
-            db.query(Permission).delete()
-            db.query(Role).delete()
-            db.query(User).delete()
-            db.commit()
+            # Limpiar datos existentes en orden correcto (respetando FK constraints), dentro de la
+            # misma transacción que la carga de datos
+            for table in (
+                UserProject.__table__, Project.__table__,
+                InformeCentro.__table__, Center.__table__,
+                # Eliminar relaciones muchos a muchos antes de eliminar las entidades principales
+                user_roles, role_permissions,
+                Permission.__table__, Role.__table__, User.__table__,
+            ):
+                db.execute(table.delete())
             print("✅ Datos existentes eliminados")
         
         print("🚀 Inicializando base de datos con datos de ejemplo...")
         
+        # Cada tipo de fila se inserta en una sola sentencia (executemany); MySQL no tiene
+        # INSERT ... RETURNING, así que los ids se leen después con un SELECT por tabla. Todo se
+        # confirma con un único commit al final
+
         # Crear permisos con nombres que coinciden con el frontend
-        permissions = [
-            Permission(name="gestionar_configuracion", description="Gestionar configuración del sistema"),
-            Permission(name="crear empresas", description="Crear empresas"),
-            Permission(name="ver usuario", description="Ver usuarios"),
-            Permission(name="ver roles", description="Ver roles"),
-            Permission(name="ver inventario", description="Ver inventario"),
-            Permission(name="crear usuarios", description="Crear usuarios"),
-            Permission(name="editar usuarios", description="Editar usuarios"),
-            Permission(name="eliminar usuarios", description="Eliminar usuarios"),
-            Permission(name="crear roles", description="Crear roles"),
-            Permission(name="editar roles", description="Editar roles"),
-            Permission(name="eliminar roles", description="Eliminar roles"),
-            Permission(name="crear permisos", description="Crear permisos"),
-            Permission(name="editar permisos", description="Editar permisos"),
-            Permission(name="eliminar permisos", description="Eliminar permisos"),
-            Permission(name="crear proyectos", description="Crear proyectos"),
-            Permission(name="editar proyectos", description="Editar proyectos"),
-            Permission(name="eliminar proyectos", description="Eliminar proyectos"),
-            Permission(name="asignar usuarios", description="Asignar usuarios a proyectos"),
-            Permission(name="ver proyectos", description="Ver proyectos"),
+        permission_rows = [
+            {"name": "gestionar_configuracion", "description": "Gestionar configuración del sistema"},
+            {"name": "crear empresas", "description": "Crear empresas"},
+            {"name": "ver usuario", "description": "Ver usuarios"},
+            {"name": "ver roles", "description": "Ver roles"},
+            {"name": "ver inventario", "description": "Ver inventario"},
+            {"name": "crear usuarios", "description": "Crear usuarios"},
+            {"name": "editar usuarios", "description": "Editar usuarios"},
+            {"name": "eliminar usuarios", "description": "Eliminar usuarios"},
+            {"name": "crear roles", "description": "Crear roles"},
+            {"name": "editar roles", "description": "Editar roles"},
+            {"name": "eliminar roles", "description": "Eliminar roles"},
+            {"name": "crear permisos", "description": "Crear permisos"},
+            {"name": "editar permisos", "description": "Editar permisos"},
+            {"name": "eliminar permisos", "description": "Eliminar permisos"},
+            {"name": "crear proyectos", "description": "Crear proyectos"},
+            {"name": "editar proyectos", "description": "Editar proyectos"},
+            {"name": "eliminar proyectos", "description": "Eliminar proyectos"},
+            {"name": "asignar usuarios", "description": "Asignar usuarios a proyectos"},
+            {"name": "ver proyectos", "description": "Ver proyectos"},
         ]
         
-        for permission in permissions:
-            db.add(permission)
-        db.commit()
+        db.execute(insert(Permission), permission_rows)
+        permission_ids = dict(db.execute(select(Permission.name, Permission.id)).all())
         print("✅ Permisos creados")
         
         # Crear roles
-        admin_role = Role(
-            name="admin",
-            description="Administrador del sistema"
-        )
-        user_role = Role(
-            name="user",
-            description="Usuario estándar"
-        )
-        manager_role = Role(
-            name="manager",
-            description="Gerente de proyecto"
-        )
-        
-        db.add(admin_role)
-        db.add(user_role)
-        db.add(manager_role)
-        db.commit()
+        db.execute(insert(Role), [
+            {"name": "admin", "description": "Administrador del sistema"},
+            {"name": "user", "description": "Usuario estándar"},
+            {"name": "manager", "description": "Gerente de proyecto"},
+        ])
+        role_ids = dict(db.execute(select(Role.name, Role.id)).all())
         print("✅ Roles creados")
         
         # Asignar permisos a roles
-        admin_permissions = db.query(Permission).all()
-        user_permissions = db.query(Permission).filter(
-            Permission.name.in_([
-                "ver proyectos", "crear proyectos", "editar proyectos"
-            ])
-        ).all()
-        manager_permissions = db.query(Permission).filter(
-            Permission.name.in_([
+        role_permission_names = {
+            "admin": list(permission_ids),
+            "user": ["ver proyectos", "crear proyectos", "editar proyectos"],
+            "manager": [
                 "ver proyectos", "crear proyectos", "editar proyectos", "eliminar proyectos",
                 "asignar usuarios", "ver usuario", "ver roles"
-            ])
-        ).all()
-        
-        admin_role.permissions = admin_permissions
-        user_role.permissions = user_permissions
-        manager_role.permissions = manager_permissions
-        db.commit()
+            ],
+        }
+        db.execute(insert(role_permissions), [
+            {"role_id": role_ids[role], "permission_id": permission_ids[name]}
+            for role, names in role_permission_names.items()
+            for name in names
+        ])
         print("✅ Permisos asignados a roles")
         
         # Crear usuarios
-        admin_user = User(
-            username="admin",
-            email="admin@wisensor.com",
-            password_hash=get_password_hash("admin123")
-        )
-        user1 = User(
-            username="user1",
-            email="user1@wisensor.com",
-            password_hash=get_password_hash("user123")
-        )
-        manager1 = User(
-            username="manager1",
-            email="manager1@wisensor.com",
-            password_hash=get_password_hash("manager123")
-        )
-        
-        db.add(admin_user)
-        db.add(user1)
-        db.add(manager1)
-        db.commit()
+        db.execute(insert(User), [
+            {"username": username, "email": email, "password_hash": password_hash}
+            for (username, email, _), password_hash in zip(sample_users, password_hashes)
+        ])
+        user_ids = dict(db.execute(select(User.username, User.id)).all())
         print("✅ Usuarios creados")
         
         # Asignar roles a usuarios
-        admin_user.roles = [admin_role]
-        user1.roles = [user_role]
-        manager1.roles = [manager_role]
-        db.commit()
+        db.execute(insert(user_roles), [
+            {"user_id": user_ids["admin"], "role_id": role_ids["admin"]},
+            {"user_id": user_ids["user1"], "role_id": role_ids["user"]},
+            {"user_id": user_ids["manager1"], "role_id": role_ids["manager"]},
+        ])
         print("✅ Roles asignados a usuarios")
         
         # Crear proyectos
-        projects = [
-            Project(name="Proyecto A", description="Primer proyecto de ejemplo"),
-            Project(name="Proyecto B", description="Segundo proyecto de ejemplo"),
-            Project(name="Proyecto C", description="Tercer proyecto de ejemplo"),
-        ]
-        
-        for project in projects:
-            db.add(project)
-        db.commit()
+        db.execute(insert(Project), [
+            {"name": "Proyecto A", "description": "Primer proyecto de ejemplo"},
+            {"name": "Proyecto B", "description": "Segundo proyecto de ejemplo"},
+            {"name": "Proyecto C", "description": "Tercer proyecto de ejemplo"},
+        ])
+        project_ids = dict(db.execute(select(Project.name, Project.id)).all())
         print("✅ Proyectos creados")
         
         # Asignar usuarios a proyectos
-        user_project_assignments = [
-            UserProject(user_id=user1.id, project_id=projects[0].id, role_in_project="Desarrollador"),
-            UserProject(user_id=manager1.id, project_id=projects[0].id, role_in_project="Gerente"),
-            UserProject(user_id=user1.id, project_id=projects[1].id, role_in_project="Tester"),
-            UserProject(user_id=manager1.id, project_id=projects[1].id, role_in_project="Gerente"),
-        ]
-        
-        for assignment in user_project_assignments:
-            db.add(assignment)
+        db.execute(insert(UserProject), [
+            {"user_id": user_ids["user1"], "project_id": project_ids["Proyecto A"], "role_in_project": "Desarrollador"},
+            {"user_id": user_ids["manager1"], "project_id": project_ids["Proyecto A"], "role_in_project": "Gerente"},
+            {"user_id": user_ids["user1"], "project_id": project_ids["Proyecto B"], "role_in_project": "Tester"},
+            {"user_id": user_ids["manager1"], "project_id": project_ids["Proyecto B"], "role_in_project": "Gerente"},
+        ])
         db.commit()
         print("✅ Asignaciones usuario-proyecto creadas")
         
@@ -173,6 +160,7 @@ def init_db():
         db.rollback()
     finally:
         db.close()
+        hash_executor.shutdown()
 
 if __name__ == "__main__":
     init_db() 
\ No newline at end of file